@@ -0,0 +1,558 @@
+import asyncio
+import gc
+import random
+import sys
+import time
+import tracemalloc
+from aiohttp import WSMessage, WSMsgType
+import codec
+import json
+import rules
+from controllers import ActionsController
+from models import Arena, Game, Games, ROCK, PAPER, SCISSORS
+
+
+class FakeWS:
+    async def send_str(self, data):
+        pass
+
+    async def send_bytes(self, data):
+        pass
+
+
+# Стоимость подключения/отключения одного игрока
+# при уже подключенных N игроках
+def bench_connect(sizes=(1000, 10000, 100000), rounds=10000):
+    for size in sizes:
+        arena = Arena()
+        for i in range(1, size + 1):
+            arena.get_or_create_player({"id": i, "name": f"User_{i}"}, FakeWS())
+
+        sockets = [FakeWS() for _ in range(rounds)]
+        started = time.perf_counter()
+
+        # переподключение существующих игроков
+        for i, ws in enumerate(sockets):
+            arena.get_or_create_player({"id": i % size + 1, "name": None}, ws)
+
+        reconnect = (time.perf_counter() - started) / rounds
+        started = time.perf_counter()
+
+        # подключение и отключение новых игроков
+        for i, ws in enumerate(sockets):
+            uid = size + i + 1
+            arena.get_or_create_player({"id": uid, "name": f"User_{uid}"}, ws)
+            arena.remove_player(ws)
+
+        connect = (time.perf_counter() - started) / rounds
+
+        print(f"players={size:>7} reconnect={reconnect * 1e6:.2f}us "
+              f"connect+disconnect={connect * 1e6:.2f}us")
+
+
+# Поток mark_as_ready от случайных игроков, как в ActionsController
+def bench_matchmaking(players=100000, calls=100000):
+    arena = Arena()
+    for i in range(players):
+        p = arena.create_player(i + 1, f"User_{i}")
+        p.game_type = random.choice((1, 2))
+
+    matches = 0
+    started = time.perf_counter()
+
+    for _ in range(calls):
+        player = arena.get_player(random.randint(1, players))
+        if player.ready:
+            continue
+
+        rivals = arena.get_rivals(player)
+        if not rivals:
+            player.ready = True
+        else:
+            matches += 1
+
+    elapsed = time.perf_counter() - started
+    print(f"calls={calls} matches={matches} elapsed={elapsed:.3f}s "
+          f"calls/s={calls / elapsed:.0f} matches/s={matches / elapsed:.0f}")
+
+
+# Поиск игры игрока и отмена игр при 50k одновременных игр
+def bench_games(count=50000, lookups=100000):
+    arena = Arena()
+    games = Games()
+
+    for i in range(count):
+        player = arena.create_player(2 * i + 1)
+        rival = arena.create_player(2 * i + 2)
+        games.create_game(player, [rival])
+
+    players = list(arena)
+    started = time.perf_counter()
+
+    for _ in range(lookups):
+        games.find_game(random.choice(players))
+
+    lookup = (time.perf_counter() - started) / lookups
+
+    started = time.perf_counter()
+    for i in range(0, lookups, 2):
+        player, rival = players[i % len(players)], players[i % len(players) + 1]
+        game = games.find_game(player)
+        game.throw(player, ROCK)
+        game.throw(rival, PAPER)
+
+    throw = (time.perf_counter() - started) / (lookups / 2)
+
+    started = time.perf_counter()
+    for game in list(games.games):
+        games.remove_game(game)
+
+    remove = (time.perf_counter() - started) / count
+
+    print(f"games={count} find_game={lookup * 1e6:.2f}us "
+          f"round={throw * 1e6:.2f}us remove={remove * 1e6:.2f}us")
+
+
+# Пакетное разрешение раундов из упакованных бросков
+def bench_rules(rounds=1000000):
+    for players in (2, 3, 4, 6):
+        keys = [random.randrange(4 ** players) for _ in range(rounds)]
+        packed = bytes(keys) if players <= 4 else keys
+
+        started = time.perf_counter()
+        rules.resolve_batch(packed, players)
+        elapsed = time.perf_counter() - started
+
+        print(f"players={players} rounds={rounds} rounds/s={rounds / elapsed:,.0f}")
+
+
+# Память на одного подключенного игрока без игр,
+# сокеты создаются заранее и в замер не входят
+def bench_memory(count=100000):
+    sockets = [FakeWS() for _ in range(count)]
+    gc.collect()
+    tracemalloc.start()
+
+    arena = Arena()
+    for i, ws in enumerate(sockets):
+        player = arena.get_or_create_player({"id": i + 1, "name": f"User_{i + 1}"}, ws)
+        player.to_dict()
+
+    arena.changes.clear()
+    gc.collect()
+    used, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f"players={count} total={used / 2 ** 20:.1f}MiB bytes/player={used / count:.0f}")
+
+
+# Кодирование и декодирование типичных queue_updates и game_updates
+def bench_codec(lobby=100, rounds=20000):
+    arena = Arena()
+    for i in range(1, lobby + 1):
+        arena.create_player(i, f"User_{i}")
+
+    player, rival = arena.get_player(1), arena.get_player(2)
+    game = Games().create_game(player, [rival])
+    game.throw(player, ROCK)
+    game.throw(rival, PAPER)
+
+    messages = {
+        "queue_updates": {"action": "queue_updates", "result": "Done",
+                          "user": player.to_dict(), "queue": arena.names()},
+        "game_updates": {"action": "game_updates", "result": "Done", "game_stat": game.stat()},
+    }
+
+    class Stdlib:
+        library = "json (stdlib)"
+        encode = staticmethod(json.dumps)
+        decode = staticmethod(json.loads)
+
+    for c in (Stdlib, codec.JSON, codec.MSGPACK):
+        if c is None:
+            continue
+
+        for name, message in messages.items():
+            started = time.perf_counter()
+            for _ in range(rounds):
+                data = c.encode(message)
+            encode = rounds / (time.perf_counter() - started)
+
+            started = time.perf_counter()
+            for _ in range(rounds):
+                c.decode(data)
+            decode = rounds / (time.perf_counter() - started)
+
+            print(f"{c.library:<14} {name:<14} size={len(data):>5}B "
+                  f"encode/s={encode:>9,.0f} decode/s={decode:>9,.0f}")
+
+
+# Сообщений в секунду через ActionsController без сети
+def bench_actions(count=100000):
+    arena = Arena()
+    games = Games()
+    player = arena.get_or_create_player({"id": 1, "name": "User_1"}, FakeWS())
+    rival = arena.get_or_create_player({"id": 2, "name": "User_2"}, FakeWS())
+    games.create_game(player, [rival])
+    controller = ActionsController(arena, games, player, player.ws, player.codec)
+
+    frames = [WSMessage(WSMsgType.TEXT, json.dumps(m), None) for m in (
+        {"action": "change_name", "data": "User"},
+        {"action": "change_type", "data": 1},
+        {"action": "throw", "data": ROCK},
+        {"action": "start_new_round"},
+        {"action": "show_history", "data": {"limit": 10}},
+    )]
+
+    async def run():
+        started = time.perf_counter()
+        for i in range(count):
+            await controller.receive(frames[i % len(frames)])
+        elapsed = time.perf_counter() - started
+
+        arena.scheduler.handle.cancel()
+        print(f"messages={count} elapsed={elapsed:.3f}s messages/s={count / elapsed:,.0f}")
+
+    asyncio.run(run())
+
+
+# Те же действия по одному в кадре и пакетами по batch действий
+def bench_batch(count=100000, batch=5):
+    arena = Arena()
+    games = Games()
+    player = arena.get_or_create_player({"id": 1, "name": "User_1"}, FakeWS())
+    rival = arena.get_or_create_player({"id": 2, "name": "User_2"}, FakeWS())
+    games.create_game(player, [rival])
+    controller = ActionsController(arena, games, player, player.ws, player.codec)
+
+    actions = [
+        {"action": "change_type", "data": 1},
+        {"action": "throw", "data": ROCK},
+        {"action": "start_new_round"},
+        {"action": "throw", "data": PAPER},
+        {"action": "change_name", "data": "User"},
+    ]
+    single = [WSMessage(WSMsgType.TEXT, json.dumps(m), None) for m in actions]
+    batched = WSMessage(WSMsgType.TEXT, json.dumps({"action": "batch", "data": actions[:batch]}), None)
+
+    async def run():
+        started = time.perf_counter()
+        for i in range(count):
+            await controller.receive(single[i % len(single)])
+        one = count / (time.perf_counter() - started)
+
+        started = time.perf_counter()
+        for _ in range(count // batch):
+            await controller.receive(batched)
+        many = count / (time.perf_counter() - started)
+
+        arena.scheduler.handle.cancel()
+        print(f"actions/s: single={one:,.0f} batch of {batch}={many:,.0f}")
+
+    asyncio.run(run())
+
+
+# Стоимость раунда с сохранением в память и в SQLite: запись в базу
+# отложена, поэтому раунд не должен заметно дорожать
+def bench_storage(rounds=50000):
+    import os
+    import tempfile
+    from storage import MemoryStorage, SQLiteStorage
+
+    async def run(storage):
+        arena = Arena(storage)
+        player = arena.create_player(1)
+        rival = arena.create_player(2)
+        game = Games().create_game(player, [rival])
+
+        started = time.perf_counter()
+        for _ in range(rounds):
+            game.throw(player, ROCK)
+            game.throw(rival, PAPER)
+        elapsed = time.perf_counter() - started
+
+        started = time.perf_counter()
+        await storage.close()
+        flush = time.perf_counter() - started
+
+        print(f"{type(storage).__name__}: round={elapsed / rounds * 1e6:.2f}us flush={flush * 1e3:.1f}ms")
+
+    asyncio.run(run(MemoryStorage()))
+    asyncio.run(run(SQLiteStorage(os.path.join(tempfile.mkdtemp(), "bench.sqlite3"), interval=60)))
+
+
+# Стоимость раунда с журналом и время рестарта: снимок с players
+# игроками и live играми плюс хвост журнала из rounds раундов
+def bench_journal(players=100000, live=5000, rounds=100000):
+    import tempfile
+    from journal import Journal
+
+    async def run():
+        directory = tempfile.mkdtemp()
+        arena, games = Arena(), Games()
+        journal = Journal(directory, interval=0)
+        journal.restore(arena, games)
+
+        for i in range(1, players + 1):
+            arena.create_player(i)
+        live_games = [games.create_game(arena.get_player(2 * i + 1), [arena.get_player(2 * i + 2)])
+                      for i in range(live)]
+
+        started = time.perf_counter()
+        await journal.snapshot()
+        snapshot = time.perf_counter() - started
+
+        started = time.perf_counter()
+        for i in range(rounds // 2):
+            game = live_games[i % live]
+            game.throw(game.players[0], ROCK)
+            game.throw(game.players[1], PAPER)
+        elapsed = time.perf_counter() - started
+        journal.log.close()
+
+        started = time.perf_counter()
+        Journal(directory).replay(Arena(), Games())
+        restore = time.perf_counter() - started
+
+        print(f"players={players} games={live} round={elapsed / (rounds // 2) * 1e6:.2f}us "
+              f"snapshot={snapshot:.2f}s restore={restore:.2f}s (snapshot + {rounds} throws)")
+
+    asyncio.run(run())
+
+
+# Процессорное время брокера кластера на запрос: кадры воркера от clients
+# клиентов, ответы уходят в транспорт без сокета. Время брокера на запрос -
+# предел пропускной способности кластера при любом числе воркеров
+def bench_broker(count=200000, clients=100):
+    from cluster import HEADER, CONNECT, REQUEST, Broker
+
+    class Transport:
+        def write(self, data):
+            pass
+
+        def is_closing(self):
+            return False
+
+        async def drain(self):
+            pass
+
+        def close(self):
+            pass
+
+    def frame(kind, conn, payload):
+        return HEADER.pack(kind, conn, len(payload)) + payload
+
+    messages = [json.dumps(m).encode() for m in (
+        {"action": "show_history", "data": {"limit": 1}},
+        {"action": "change_type", "data": 1},
+        {"action": "throw", "data": ROCK},
+    )]
+    connects = b"".join(frame(CONNECT, conn, json.dumps({"session": {"id": conn, "name": f"User_{conn}"}}).encode())
+                        for conn in range(1, clients + 1))
+    requests = b"".join(frame(REQUEST, i % clients + 1, messages[i % len(messages)]) for i in range(count))
+
+    async def run():
+        broker = Broker()
+        reader = asyncio.StreamReader()
+        reader.feed_data(connects)
+        task = asyncio.ensure_future(broker.accept(reader, Transport()))
+        while len(broker.arena) < clients:
+            await asyncio.sleep(0)
+        await broker.arena.scheduler.flush()
+
+        started = time.process_time()
+        reader.feed_data(requests)
+        reader.feed_eof()
+        await task
+        elapsed = time.process_time() - started
+
+        print(f"requests={count} cpu/request={elapsed / count * 1e6:.2f}us "
+              f"(limit {count / elapsed:,.0f} requests/s)")
+
+    asyncio.run(run())
+
+
+
+# часть клиентов не читает сокет: прямая отправка против очередей
+# соединений
+def bench_outbox(players=1000, slow=10, delay=0.5):
+    from broadcast import Outbox
+
+    class SlowWS(FakeWS):
+        async def send_str(self, data):
+            await asyncio.sleep(delay)
+
+    async def run(wrap):
+        arena = Arena()
+        fast = []
+        for i in range(1, players + 1):
+            ws = wrap(SlowWS() if i % (players // slow) == 0 else FakeWS())
+            arena.get_or_create_player({"id": i, "name": f"User_{i}"}, ws)
+            if isinstance(ws, Outbox) and not isinstance(ws.ws, SlowWS):
+                fast.append(ws)
+
+        started = time.perf_counter()
+        await arena.broadcast()
+        await asyncio.gather(*(ws.task for ws in fast if ws.task))
+        elapsed = time.perf_counter() - started
+
+        for task in asyncio.all_tasks() - {asyncio.current_task()}:
+            task.cancel()
+        return elapsed
+
+    direct = asyncio.run(run(lambda ws: ws))
+    queued = asyncio.run(run(Outbox))
+    print(f"players={players} slow={slow} (send {delay}s): direct={direct * 1e3:.1f}ms queued={queued * 1e3:.1f}ms")
+
+
+# Стоимость сроков раундов при 100k живых игр: процессорное время цикла
+# событий, пока колесо таймеров крутится без срабатываний, раунд с
+# перестановкой таймера и массовое истечение срока
+def bench_timers(count=100000, idle=5.0, rounds=100000):
+    async def run():
+        arena = Arena()
+        games = Games(round_timeout=30, idle_timeout=300)
+        for i in range(count):
+            games.create_game(arena.create_player(2 * i + 1), [arena.create_player(2 * i + 2)])
+        await games.timers.start()
+
+        cpu = time.process_time()
+        await asyncio.sleep(idle)
+        cpu = time.process_time() - cpu
+
+        live = list(games.games)
+        started = time.perf_counter()
+        for i in range(rounds):
+            game = live[i % count]
+            game.throw(game.players[0], ROCK)
+            game.throw(game.players[1], PAPER)
+            game.start_new_round()
+        round_cost = (time.perf_counter() - started) / rounds
+
+        # у всех игр прошел срок раунда: раунды без бросков отменяются
+        started = time.perf_counter()
+        games.expire(live, time.monotonic() + 31)
+        expire = time.perf_counter() - started
+
+        await games.timers.stop()
+        for task in asyncio.all_tasks() - {asyncio.current_task()}:
+            task.cancel()
+
+        print(f"games={count} idle loop cpu={cpu / idle:.2%} round={round_cost * 1e6:.2f}us "
+              f"expire all={expire * 1e3:.0f}ms")
+
+    asyncio.run(run())
+
+
+# Рейтинг при players игроках: обновление после раунда, первая страница и
+# место игрока против сортировки всех игроков на каждый запрос
+def bench_leaderboard(players=100000, rounds=100000, queries=10000):
+    arena = Arena()
+    pool = [arena.create_player(i) for i in range(1, players + 1)]
+
+    started = time.perf_counter()
+    for i in range(rounds // 2):
+        winner, loser = random.sample(pool, 2)
+        game = Game(winner, [loser])
+        game.throw(winner, ROCK)
+        game.throw(loser, SCISSORS)
+    round_cost = (time.perf_counter() - started) / (rounds // 2)
+
+    leaderboard = arena.leaderboard
+    started = time.perf_counter()
+    for _ in range(queries):
+        leaderboard.page(0, 10)
+        leaderboard.rank(random.choice(pool).uid)
+    query = (time.perf_counter() - started) / queries
+
+    started = time.perf_counter()
+    ranked = sorted(arena, key=lambda p: (-p.wins, p.games, p.uid))
+    ranked.index(random.choice(pool))
+    full_sort = time.perf_counter() - started
+
+    print(f"players={players} ranked={len(leaderboard)} round={round_cost * 1e6:.2f}us "
+          f"top10+rank={query * 1e6:.2f}us full sort={full_sort * 1e3:.1f}ms")
+
+
+# Симуляция пакетного подбора по рейтингу в виртуальном времени: сначала
+# готовы ready игроков, проход раз в interval секунд, сыгравшие
+# возвращаются в пул через 10-60 секунд. Качество - разница рейтингов в
+# игре против случайных пар, время до игры и время прохода
+def bench_skill(ready=50000, passes=60, interval=1.0):
+    from matchmaking import SkillMatchmaker, rating
+
+    now = [0.0]
+    arena = Arena()
+    matchmaker = arena.matchmaker = SkillMatchmaker(clock=lambda: now[0])
+    since = {}
+    returns = {}
+
+    for uid in range(1, ready + 1):
+        games = random.randint(0, 300)
+        skill = random.betavariate(2, 2)
+        player = arena.create_player(uid, row={"wins": sum(random.random() < skill for _ in range(games)),
+                                               "games": games, "game_type": 1, "history": None})
+        player.ready = True
+        since[uid] = 0.0
+
+    pool = list(arena)
+    random_gaps = [abs(rating(a) - rating(b)) for a, b in (random.sample(pool, 2) for _ in range(10000))]
+
+    gaps, waits, elapsed, sizes, matched = [], [], [], [], []
+    for step in range(1, passes + 1):
+        now[0] = step * interval
+        for player in returns.pop(step, ()):
+            player.ready = True
+            since[player.uid] = now[0]
+
+        sizes.append(matchmaker.ready_count(1))
+        started = time.perf_counter()
+        groups = matchmaker.match()
+        elapsed.append(time.perf_counter() - started)
+        matched.append(len(groups))
+
+        for group in groups:
+            ratings = [rating(p) for p in group]
+            gaps.append(max(ratings) - min(ratings))
+            back = step + random.randint(10, 60)
+            for player in group:
+                waits.append(now[0] - since[player.uid])
+                returns.setdefault(back, []).append(player)
+
+    def quantile(values, q):
+        return sorted(values)[int(len(values) * q)]
+
+    print(f"first pass: ready={sizes[0]} games={matched[0]} "
+          f"time={elapsed[0] * 1e3:.1f}ms")
+    print(f"steady: ready p50={quantile(sizes[10:], 0.5)} pass p50={quantile(elapsed[10:], 0.5) * 1e3:.1f}ms")
+    print(f"rating gap: mean={sum(gaps) / len(gaps):.1f} p99={quantile(gaps, 0.99)} "
+          f"(random pairs: mean={sum(random_gaps) / len(random_gaps):.1f} p99={quantile(random_gaps, 0.99)})")
+    print(f"time to match: p50={quantile(waits, 0.5):.0f}s p99={quantile(waits, 0.99):.0f}s "
+          f"max={max(waits):.0f}s, waiting at end={matchmaker.ready_count(1)}")
+
+
+BENCHMARKS = {
+    "connect": bench_connect,
+    "matchmaking": bench_matchmaking,
+    "games": bench_games,
+    "rules": bench_rules,
+    "memory": bench_memory,
+    "codec": bench_codec,
+    "actions": bench_actions,
+    "batch": bench_batch,
+    "storage": bench_storage,
+    "journal": bench_journal,
+    "broker": bench_broker,
+    "outbox": bench_outbox,
+    "timers": bench_timers,
+    "leaderboard": bench_leaderboard,
+    "skill": bench_skill,
+}
+
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or list(BENCHMARKS)
+
+    for name in names:
+        print(f"== {name}")
+        BENCHMARKS[name]()
@@ -0,0 +1,232 @@
+import asyncio
+import logging
+import time
+import weakref
+from collections import deque
+import codec
+import settings
+from metrics import BROADCAST_FAILURES, BROADCAST_MESSAGES, REGISTRY
+
+# Одновременно отправляемых сообщений и таймаут отправки в один сокет
+SEND_CONCURRENCY = 64
+SEND_TIMEOUT = 5
+
+log = logging.getLogger('rps')
+
+
+# latest - полный снимок лобби: в очереди соединения остается только
+# последний. Очередь (Outbox, RemoteWS брокера) принимает сообщение сразу
+async def send(ws, data, timeout=None, latest=False):
+    put = getattr(ws, "put", None)
+    if put is not None:
+        return put(data, latest)
+
+    try:
+        await asyncio.wait_for(codec.send(ws, data), timeout or SEND_TIMEOUT)
+        return True
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        # ошибка одного сокета не должна мешать остальным
+        log.debug("broadcast to %r failed: %r", ws, e)
+        return False
+
+
+# Рассылка уже сериализованных сообщений: messages - итератор пар (ws, data),
+# data - str для текстовых кадров или bytes для бинарных.
+# Работает не более concurrency отправителей, медленный сокет
+# задерживает только свой слот. Возвращает число неудачных отправок.
+async def fan_out(messages, concurrency=None, timeout=None, latest=False):
+    concurrency = concurrency or SEND_CONCURRENCY
+    if hasattr(messages, '__len__'):
+        concurrency = min(concurrency, len(messages))
+
+    messages = iter(messages)
+    sent = failed = 0
+
+    async def worker():
+        nonlocal sent, failed
+        for ws, data in messages:
+            sent += 1
+            if not await send(ws, data, timeout, latest):
+                failed += 1
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+    BROADCAST_MESSAGES.inc(sent)
+    if failed:
+        BROADCAST_FAILURES.inc(failed)
+    return failed
+
+
+# Глубина очереди в момент постановки сообщения
+OUTBOX_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512)
+
+OUTBOX_DEPTH = REGISTRY.histogram("rps_outbox_depth", "Outbound queue depth per connection on enqueue",
+                                  buckets=OUTBOX_BUCKETS)
+OUTBOX_REPLACED = REGISTRY.counter("rps_outbox_replaced_total", "Lobby snapshots superseded before sending")
+OUTBOX_DISCONNECTS = REGISTRY.counter("rps_outbox_disconnects_total", "Slow clients disconnected", ("reason",))
+
+# живые очереди процесса для метрик
+OUTBOXES = weakref.WeakSet()
+
+REGISTRY.gauge("rps_outbox_queued", "Messages waiting in outbound queues",
+               collect=lambda: [((), sum(len(outbox) for outbox in OUTBOXES))])
+REGISTRY.gauge("rps_outbox_max_depth", "Deepest outbound queue",
+               collect=lambda: [((), max((len(outbox) for outbox in OUTBOXES), default=0))])
+
+
+# Очередь исходящих сообщений соединения. Рассылки только кладут в нее
+# сообщение, в сокет их пишет задача соединения, которая живет, пока
+# очередь не пуста: медленный клиент задерживает только себя.
+# Клиент отключается, если в очереди больше limit сообщений или текущая
+# отправка идет дольше SEND_TIMEOUT (проверяется при постановке нового
+# сообщения, чтобы не заводить таймер на каждую отправку)
+class Outbox:
+    def __init__(self, ws, limit=None):
+        self.ws = ws
+        self.limit = limit or settings.OUTBOX_LIMIT
+        # элементы - [data], снимок лобби заменяется на месте
+        self.queue = deque()
+        self.latest = None
+        self.task = None
+        self.sending = None
+        self.closed = False
+        OUTBOXES.add(self)
+
+    def __len__(self):
+        return len(self.queue)
+
+    # интерфейс сокета для codec.send: ответы контроллера идут той же
+    # очередью и не обгоняют рассылки
+    async def send_str(self, data):
+        if not self.put(data):
+            raise ConnectionResetError("connection is closed")
+
+    async def send_bytes(self, data):
+        if not self.put(data):
+            raise ConnectionResetError("connection is closed")
+
+    def put(self, data, latest=False):
+        if self.closed:
+            return False
+
+        if self.sending is not None and time.monotonic() - self.sending > SEND_TIMEOUT:
+            self.disconnect("timeout")
+            return False
+
+        if latest and self.latest is not None:
+            self.latest[0] = data
+            OUTBOX_REPLACED.inc()
+            return True
+
+        if len(self.queue) >= self.limit:
+            self.disconnect("overflow")
+            return False
+
+        entry = [data]
+        if latest:
+            self.latest = entry
+        self.queue.append(entry)
+        OUTBOX_DEPTH.observe(len(self.queue))
+
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.write())
+        return True
+
+    async def write(self):
+        try:
+            while self.queue:
+                entry = self.queue.popleft()
+                if entry is self.latest:
+                    self.latest = None
+                self.sending = time.monotonic()
+                await codec.send(self.ws, entry[0])
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # клиент ушел: соединение закроет его обработчик
+            log.debug("send to %r failed: %r", self.ws, e)
+            self.discard()
+        finally:
+            self.task = None
+            self.sending = None
+
+    def discard(self):
+        self.closed = True
+        self.queue.clear()
+        self.latest = None
+
+    def disconnect(self, reason):
+        OUTBOX_DISCONNECTS.inc(1, reason)
+        log.warning("slow client disconnected", extra={"event": "slow_client", "reason": reason})
+        self.discard()
+        asyncio.ensure_future(self.ws.close())
+
+    async def close(self):
+        self.discard()
+        if self.task is not None:
+            self.task.cancel()
+        await self.ws.close()
+
+
+# Склеивает запросы на рассылку, пришедшие в течение окна window,
+# в одну отправку. Каждый новый запрос сдвигает отправку, но не дальше
+# max_delay от первого несделанного запроса. Рассылки не перекрываются:
+# запрос во время отправки выполняется сразу после нее.
+class BroadcastScheduler:
+    def __init__(self, callback, window=None, max_delay=None):
+        self.callback = callback
+        self.window = settings.BROADCAST_WINDOW if window is None else window
+        self.max_delay = settings.BROADCAST_MAX_DELAY if max_delay is None else max_delay
+        self.handle = None
+        self.task = None
+        self.first = None
+        self.pending = False
+        self.requested = 0
+        self.sent = 0
+
+    @property
+    def coalesced(self):
+        return self.requested - self.sent
+
+    def schedule(self):
+        loop = asyncio.get_event_loop()
+        now = loop.time()
+        self.requested += 1
+
+        if self.first is None:
+            self.first = now
+        if self.handle:
+            self.handle.cancel()
+
+        self.handle = loop.call_at(min(now + self.window, self.first + self.max_delay), self.fire)
+
+    def fire(self):
+        self.handle = None
+        self.first = None
+
+        if self.task and not self.task.done():
+            self.pending = True
+        else:
+            self.task = asyncio.ensure_future(self.run())
+
+    async def run(self):
+        while True:
+            self.sent += 1
+            try:
+                await self.callback()
+            except Exception:
+                log.exception("scheduled broadcast failed")
+
+            if not self.pending:
+                break
+            self.pending = False
+
+    # немедленная рассылка всего накопленного
+    async def flush(self):
+        if self.handle:
+            self.handle.cancel()
+            self.fire()
+        if self.task:
+            await self.task
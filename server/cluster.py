@@ -0,0 +1,379 @@
+import asyncio
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import struct
+import time
+from aiohttp import web
+import broadcast
+import settings
+from codec import negotiate
+from controllers import ActionsController, CodecWSController
+from journal import close_state, create_state
+from logs import setup_logging
+from matchmaking import BatchMatcher
+from metrics import metrics_handler, register_state
+from profiling import install_signal
+from reaper import Reaper
+from models import Arena, Games, Player
+
+# Несколько воркеров aiohttp на одном порту (SO_REUSEPORT) держат сокеты
+# клиентов, а лобби и игры живут в одном процессе-брокере. Воркеры сами
+# декодируют и проверяют кадры клиентов и отвечают на ошибки, брокеру по
+# unix-сокету уходят только проверенные запросы. Брокер выполняет их
+# теми же контроллерами (состояние общее, поэтому обработчики - в нем)
+# и присылает обратно кадры для клиентов.
+
+# Кадр: тип, номер соединения в воркере, длина данных
+HEADER = struct.Struct('!BII')
+
+# воркер -> брокер
+CONNECT = 1
+REQUEST = 2
+CLOSE = 3
+NEW_PLAYER = 4
+# брокер -> воркер
+SEND_TEXT = 5
+SEND_BYTES = 6
+DISCONNECT = 7
+PLAYER = 8
+# флаг SEND_*: снимок лобби, в очереди клиента остается только последний
+LATEST = 0x80
+
+log = logging.getLogger('rps')
+
+
+# Сколько байт читать из сокета за раз
+READ_SIZE = 2 ** 16
+
+
+# Кадры из потока: за одно чтение разбирается все, что уже пришло,
+# без двух ожиданий на каждый кадр
+async def read_frames(reader):
+    buffer = b""
+    while True:
+        data = await reader.read(READ_SIZE)
+        if not data:
+            raise asyncio.IncompleteReadError(buffer, None)
+
+        buffer += data
+        position = 0
+        while len(buffer) - position >= HEADER.size:
+            kind, conn, size = HEADER.unpack_from(buffer, position)
+            end = position + HEADER.size + size
+            if end > len(buffer):
+                break
+
+            yield kind, conn, buffer[position + HEADER.size:end]
+            position = end
+
+        buffer = buffer[position:]
+
+
+def write_frame(writer, kind, conn, payload=b""):
+    writer.write(HEADER.pack(kind, conn, len(payload)) + payload)
+
+
+# Кадры, записанные за одну итерацию цикла событий, уходят в сокет одной
+# записью: иначе на каждый ответ клиенту - свой системный вызов
+class FrameWriter:
+    def __init__(self, writer):
+        self.writer = writer
+        self.chunks = []
+
+    def write(self, data):
+        if not self.chunks:
+            asyncio.get_running_loop().call_soon(self.flush)
+        self.chunks.append(data)
+
+    def flush(self):
+        if self.chunks and not self.writer.is_closing():
+            self.writer.write(b"".join(self.chunks))
+        self.chunks = []
+
+    async def drain(self):
+        await self.writer.drain()
+
+    def is_closing(self):
+        return self.writer.is_closing()
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+# Сокет клиента другого процесса с точки зрения брокера
+class RemoteWS:
+    def __init__(self, writer, conn):
+        self.writer = writer
+        self.conn = conn
+        self.closed = False
+
+    async def send_str(self, data):
+        await self.send(SEND_TEXT, data.encode())
+
+    async def send_bytes(self, data):
+        await self.send(SEND_BYTES, data)
+
+    # рассылки пишут кадр без ожидания: очередь клиента держит воркер
+    def put(self, data, latest=False):
+        if self.closed or self.writer.is_closing():
+            return False
+
+        kind, payload = (SEND_TEXT, data.encode()) if isinstance(data, str) else (SEND_BYTES, data)
+        write_frame(self.writer, kind | LATEST if latest else kind, self.conn, payload)
+        return True
+
+    async def send(self, kind, payload):
+        if self.closed or self.writer.is_closing():
+            raise ConnectionResetError("connection is closed")
+
+        write_frame(self.writer, kind, self.conn, payload)
+        await self.writer.drain()
+
+    async def close(self):
+        if not self.closed:
+            self.closed = True
+            if not self.writer.is_closing():
+                write_frame(self.writer, DISCONNECT, self.conn)
+
+
+class Broker:
+    def __init__(self, arena=None, games=None):
+        # пустые арена и игры ложны (__len__), поэтому проверка на None
+        self.arena = arena if arena is not None else Arena()
+        self.games = games if games is not None else Games()
+
+    async def serve(self, path):
+        if os.path.exists(path):
+            os.unlink(path)
+        return await asyncio.start_unix_server(self.accept, path)
+
+    # кадры одного воркера обрабатываются по порядку
+    async def accept(self, reader, writer):
+        writer = FrameWriter(writer)
+        controllers = {}
+
+        try:
+            async for kind, conn, payload in read_frames(reader):
+                if kind == CONNECT:
+                    info = json.loads(payload)
+                    controllers[conn] = await ActionsController.connect(
+                        self.arena, self.games, info["session"], RemoteWS(writer, conn),
+                        negotiate(info.get("protocol")), info.get("lobby_deltas", False))
+
+                # запрос уже проверен воркером, кадр клиента передается как есть
+                elif kind == REQUEST:
+                    controller = controllers.get(conn)
+                    if controller:
+                        await controller.process(payload, controller.execute)
+
+                # uid нового игрока выдает брокер: только он знает всех
+                # игроков и хранилище
+                elif kind == NEW_PLAYER:
+                    player = self.arena.create_player()
+                    write_frame(writer, PLAYER, conn, json.dumps({"id": player.uid, "name": player.name}).encode())
+
+                elif kind == CLOSE:
+                    controller = controllers.pop(conn, None)
+                    if controller:
+                        controller.ws.closed = True
+                        await controller.close()
+
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            # воркер отключился: все его клиенты считаются ушедшими
+            for controller in controllers.values():
+                controller.ws.closed = True
+                await controller.close()
+            writer.close()
+
+
+# Контроллер соединения в воркере: декодирует и проверяет кадры тем же
+# кодом, что и брокер, ошибки отправляет клиенту сам, а проверенный кадр
+# пересылает брокеру без повторного кодирования. player - копия игрока
+# сессии, нужна только для uid в логах и времени последнего сообщения
+class ProxyController(CodecWSController):
+    dispatch = ActionsController.dispatch
+
+    def __init__(self, link, conn, player, ws, codec):
+        super().__init__(None, None, player, ws, codec)
+        self.link = link
+        self.conn = conn
+
+    async def receive(self, message):
+        self.validate(self.decode(message))
+        await self.link.request(self.conn, message.data)
+
+
+# Соединение воркера с брокером
+class BrokerLink:
+    def __init__(self, path):
+        self.path = path
+        self.sockets = {}
+        self.ids = itertools.count(1)
+        # номер запроса -> future ответа брокера
+        self.pending = {}
+        self.reader = None
+        self.writer = None
+        self.task = None
+
+    async def start(self, app=None):
+        self.reader, writer = await asyncio.open_unix_connection(self.path)
+        self.writer = FrameWriter(writer)
+        self.task = asyncio.ensure_future(self.listen())
+
+    async def stop(self, app=None):
+        if self.task:
+            self.task.cancel()
+        if self.writer:
+            self.writer.close()
+
+    async def listen(self):
+        try:
+            async for kind, conn, payload in read_frames(self.reader):
+                if kind == PLAYER:
+                    future = self.pending.pop(conn, None)
+                    if future is not None and not future.done():
+                        future.set_result(json.loads(payload))
+                    continue
+
+                ws = self.sockets.get(conn)
+                if ws is None:
+                    continue
+
+                latest = bool(kind & LATEST)
+                kind &= ~LATEST
+
+                if kind == SEND_TEXT:
+                    await broadcast.send(ws, payload.decode(), latest=latest)
+                elif kind == SEND_BYTES:
+                    await broadcast.send(ws, payload, latest=latest)
+                elif kind == DISCONNECT:
+                    asyncio.ensure_future(ws.close())
+        except (asyncio.IncompleteReadError, ConnectionError):
+            log.error("broker connection lost")
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionResetError("broker connection lost"))
+            self.pending.clear()
+            for ws in list(self.sockets.values()):
+                await ws.close()
+
+    # Новый игрок в арене брокера: словарь с id и name для сессии
+    async def new_player(self):
+        request = next(self.ids)
+        future = self.pending[request] = asyncio.get_running_loop().create_future()
+        try:
+            write_frame(self.writer, NEW_PLAYER, request)
+            await self.writer.drain()
+            return await future
+        finally:
+            self.pending.pop(request, None)
+
+    # Соединение клиента, возвращается контроллер для его кадров
+    async def connect(self, ws, session, protocol=None, lobby_deltas=False):
+        conn = next(self.ids)
+        self.sockets[conn] = ws
+
+        info = {"session": session, "protocol": protocol, "lobby_deltas": lobby_deltas}
+        write_frame(self.writer, CONNECT, conn, json.dumps(info).encode())
+        await self.writer.drain()
+        return ProxyController(self, conn, Player(session["id"], session["name"]), ws, negotiate(protocol))
+
+    async def request(self, conn, data):
+        write_frame(self.writer, REQUEST, conn, data.encode() if isinstance(data, str) else data)
+        await self.writer.drain()
+
+    async def disconnect(self, conn):
+        if self.sockets.pop(conn, None) is not None and not self.writer.is_closing():
+            write_frame(self.writer, CLOSE, conn)
+            await self.writer.drain()
+
+
+def run_broker(path):
+    setup_logging()
+
+    async def main():
+        broker = Broker(*create_state())
+        server = await broker.serve(path)
+
+        # арена живет в брокере, ее метрики отдаются отдельным портом
+        register_state(broker.arena, broker.games)
+        await install_signal()
+        reaper = Reaper(broker.arena, broker.games)
+        await reaper.start()
+        await broker.games.timers.start()
+        matcher = BatchMatcher(broker.arena, broker.games)
+        await matcher.start()
+        runner = None
+        if settings.BROKER_METRICS_PORT:
+            app = web.Application()
+            app.add_routes([web.get('/metrics', metrics_handler)])
+            runner = web.AppRunner(app)
+            await runner.setup()
+            await web.TCPSite(runner, port=settings.BROKER_METRICS_PORT).start()
+
+        # по SIGTERM/SIGINT дописываем хранилище и выходим
+        stopped = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, stopped.set)
+
+        async with server:
+            await stopped.wait()
+
+        await reaper.stop()
+        await broker.games.timers.stop()
+        await matcher.stop()
+        if runner is not None:
+            await runner.cleanup()
+        await close_state(broker.arena)
+
+    asyncio.run(main())
+
+
+def run_worker(create_app, port, path):
+    setup_logging()
+    web.run_app(create_app(link=BrokerLink(path)), port=port, reuse_port=True)
+
+
+# Брокер и workers воркеров на одном порту; возвращается, когда
+# все процессы завершены
+def run_cluster(create_app, workers, port, path):
+    broker = multiprocessing.Process(target=run_broker, args=(path,), name="broker")
+    broker.start()
+
+    # воркеры подключаются к брокеру сразу при старте
+    deadline = time.monotonic() + 10
+    while not os.path.exists(path):
+        if time.monotonic() > deadline or not broker.is_alive():
+            broker.terminate()
+            raise RuntimeError("broker did not start")
+        time.sleep(0.05)
+
+    processes = [broker] + [
+        multiprocessing.Process(target=run_worker, args=(create_app, port, path), name=f"worker-{i}")
+        for i in range(workers)
+    ]
+    for process in processes[1:]:
+        process.start()
+
+    def stop(*args):
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+
+    signal.signal(signal.SIGTERM, stop)
+
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        stop()
+        for process in processes:
+            process.join()
@@ -0,0 +1,103 @@
+import json
+
+# Быстрые библиотеки необязательны: используется первая установленная
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class CodecError(Exception):
+    pass
+
+
+# Текстовые кадры JSON. Сообщения из частей собираются без повторной
+# сериализации уже закодированных значений (join)
+class JsonCodec:
+    protocol = "rps.json"
+    binary = False
+
+    def __init__(self):
+        if orjson:
+            self.library = "orjson"
+        elif ujson:
+            self.library = "ujson"
+        else:
+            self.library = "json"
+
+    def encode(self, obj):
+        if orjson:
+            return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+        if ujson:
+            return ujson.dumps(obj, ensure_ascii=False)
+        return json.dumps(obj)
+
+    def decode(self, data):
+        try:
+            if orjson:
+                return orjson.loads(data)
+            if ujson:
+                return ujson.loads(data)
+            return json.loads(data)
+        except ValueError:
+            raise CodecError("message not serializable")
+
+    # fields - пары (ключ, закодированное значение)
+    def join(self, fields):
+        return "{" + ",".join(f'"{key}":{value}' for key, value in fields) + "}"
+
+
+# Бинарные кадры MessagePack, включаются подпротоколом rps.msgpack
+class MsgpackCodec:
+    protocol = "rps.msgpack"
+    binary = True
+    library = "msgpack"
+
+    def encode(self, obj):
+        return msgpack.packb(obj, use_bin_type=True, strict_types=False)
+
+    def decode(self, data):
+        if isinstance(data, str):
+            raise CodecError("binary frame expected")
+        try:
+            return msgpack.unpackb(data, raw=False, strict_map_key=False)
+        except (ValueError, msgpack.ExtraData, msgpack.FormatError, msgpack.StackError):
+            raise CodecError("message not serializable")
+
+    # map в msgpack - заголовок и подряд идущие ключи и значения
+    def join(self, fields):
+        fields = list(fields)
+        if len(fields) > 15:
+            header = b"\xde" + len(fields).to_bytes(2, "big")
+        else:
+            header = bytes([0x80 | len(fields)])
+        return header + b"".join(msgpack.packb(key) + value for key, value in fields)
+
+
+JSON = JsonCodec()
+MSGPACK = MsgpackCodec() if msgpack else None
+
+CODECS = {codec.protocol: codec for codec in (JSON, MSGPACK) if codec}
+# подпротоколы, предлагаемые клиенту при подключении
+PROTOCOLS = tuple(CODECS)
+
+
+def negotiate(protocol):
+    return CODECS.get(protocol, JSON)
+
+
+async def send(ws, data):
+    if isinstance(data, str):
+        await ws.send_str(data)
+    else:
+        await ws.send_bytes(data)
@@ -1,6 +1,16 @@
-import json
+import logging
+import time
+import broadcast
+import settings
 from aiohttp import WSMsgType
-from serializers import serialize_request
+from codec import CodecError
+from logs import log_context
+from metrics import ACTION_ERRORS, ACTION_SECONDS
+from profiling import PROFILER, timed
+from serializers import REQUEST_SCHEMA, BAD_REQUEST, NOT_SERIALIZABLE, UNKNOWN_ACTION, \
+    RequestError, request_action
+
+log = logging.getLogger('rps')
 
 
 class WSException(Exception):
@@ -8,84 +18,260 @@ class WSException(Exception):
         self.message = message
 
     def __repr__(self):
-        str(self.message)
+        return str(self.message)
 
 
+# Сессия соединения: создается один раз на сокет и обрабатывает
+# все его сообщения
 class WSController:
-    error_body = {"result": "Fail", "data": None}
+    # action -> (проверка, обработчик), см. build_dispatch
+    dispatch = {}
+
+    def __init__(self, arena, games, player, ws, codec):
+        self.arena = arena
+        self.games = games
+        self.player = player
+        self.ws = ws
+        self.codec = codec
+        # внутри пакета действий: ответы обработчиков и игры, которые
+        # нужно разослать в конце пакета (см. batch)
+        self.replies = None
+        self.updated = None
+
+    # Подключение игрока из сессии: session - словарь с id и name,
+    # lobby_deltas - клиент получает снимок лобби и дальше только дельты
+    @classmethod
+    @timed
+    async def connect(cls, arena, games, session, ws, codec, lobby_deltas=False):
+        player = arena.get_or_create_player(session, ws, codec)
+        arena.schedule_broadcast()
+        log.info("connected", extra={"event": "connect", "uid": player.uid, "protocol": codec.protocol})
+
+        if lobby_deltas:
+            player.lobby_deltas = True
+            await arena.send_snapshot(player)
+
+        return cls(arena, games, player, ws, codec)
+
+    # Обработка кадра с ответом об ошибке в тот же сокет.
+    # receive - разбор кадра, по умолчанию с декодированием и проверкой
+    async def process(self, message, receive=None):
+        self.player.seen = time.monotonic()
+        # записи лога при обработке кадра получают uid и действие
+        token = log_context.set({"uid": self.player.uid})
+        try:
+            await (receive or self.receive)(message)
+        except WSException as e:
+            await self.send(e.message)
+        except Exception:
+            log.exception("unhandled error", extra={"event": "error"})
+            await self.send({"result": "Fail", "data": "Unknown error"})
+        finally:
+            log_context.reset(token)
+
+    @timed
+    async def close(self):
+        game = self.current_game()
+
+        if game:
+            await self.games.cancel_game(game)
+
+        self.arena.detach(self.player, self.ws)
+        self.arena.schedule_broadcast()
+        log.info("disconnected", extra={"event": "disconnect", "uid": self.player.uid})
+
+    def client_error(self, msg, code=BAD_REQUEST):
+        ACTION_ERRORS.inc(1, code)
+        raise WSException({"result": "Fail", "data": msg, "code": code})
 
-    def __init__(self, message, request):
+    def decode(self, message):
         if message.type == WSMsgType.ERROR:
-            self.client_error("unknown")
-
-        self.request = request
-        self.message = message.data
-        self.arena = getattr(request.app, 'arena')
-        self.games = getattr(request.app, 'games')
-        self.player = getattr(request, 'user')
-
-    def client_error(self, msg):
-        self.error_body["data"] = msg
-        raise WSException(self.error_body)
-
-    @serialize_request
-    async def handle(self):
-        method = getattr(self, self.message["action"], None)
-        if not method:
-            self.client_error("Unsupported action")
-        else:
-            await method(**self.message)
+            self.client_error("unknown", BAD_REQUEST)
+        return message.data
+
+    async def receive(self, message):
+        await self.handle(self.decode(message))
 
+    # Кадр, который уже декодировал и проверил воркер кластера
+    async def execute(self, data):
+        message = self.codec.decode(data)
+        action = message["action"]
+        self.log_action(action)
+        await self.run(action, self.dispatch[action][1], message)
 
-class JsonWSController(WSController):
-    def __init__(self, message, request):
-        super().__init__(message, request)
+    async def handle(self, message):
+        action, handler = self.validate(message)
+        await self.run(action, handler, message)
 
+    # Действие и обработчик сообщения, ошибка - WSException для клиента
+    def validate(self, message):
         try:
-            self.message = json.loads(self.message)
-        except json.JSONDecodeError:
-            raise self.client_error("message not serializable")
+            action = request_action(message)
+            self.log_action(action)
 
+            entry = self.dispatch.get(action)
+            if entry is None:
+                raise RequestError(UNKNOWN_ACTION, "Unsupported action")
+
+            validator, handler = entry
+            validator(message)
+        except RequestError as e:
+            self.client_error(e.message, e.code)
+
+        return action, handler
+
+    # записи лога в очереди держат ссылку на словарь контекста,
+    # поэтому он заменяется, а не меняется
+    def log_action(self, action):
+        context = log_context.get()
+        if context is not None:
+            log_context.set(dict(context, action=action))
+
+    async def run(self, action, handler, message):
+        started = time.perf_counter()
+        try:
+            await handler(self, **message)
+        finally:
+            elapsed = time.perf_counter() - started
+            ACTION_SECONDS.observe(elapsed, action)
+            if PROFILER.running:
+                PROFILER.record(handler.__qualname__, elapsed)
 
-class ActionsController(JsonWSController):
+    # ответ в закрытое соединение просто не доставляется
+    async def send(self, message):
+        if self.replies is not None:
+            self.replies.append(message)
+            return
+        await broadcast.send(self.ws, self.codec.encode(message))
+
+    async def broadcast_game(self, game):
+        if self.updated is not None:
+            self.updated[game.id] = game
+            return
+        await game.broadcast()
+
+    # игру игрока мог создать другой контроллер или пакетный подбор,
+    # поэтому она ищется при каждом действии
+    def current_game(self):
+        return self.games.find_game(self.player)
+
+
+# Кадры декодируются кодеком, согласованным с клиентом при подключении
+class CodecWSController(WSController):
+    def decode(self, message):
+        try:
+            return self.codec.decode(super().decode(message))
+        except CodecError as e:
+            self.client_error(str(e), NOT_SERIALIZABLE)
+
+
+class ActionsController(CodecWSController):
     async def mark_as_ready(self, **kwargs):
         rivals = self.arena.get_rivals(self.player)
 
         if not rivals:
             self.player.ready = True
-            await self.arena.broadcast()
         else:
             game = self.games.create_game(self.player, rivals)
+            await self.broadcast_game(game)
 
-            await game.broadcast()
-            await self.arena.broadcast(exclude = rivals + [self.player])
+        self.arena.schedule_broadcast()
 
     async def throw(self, **kwargs):
-        game = self.games.find_game(self.player)
+        game = self.current_game()
         if game:
             game.throw(self.player, kwargs["data"])
-            await game.broadcast()
+            log.info("throw", extra={"event": "throw", "game": game.id, "throw": kwargs["data"]})
+            await self.broadcast_game(game)
 
     async def start_new_round(self, **kwargs):
-        game = self.games.find_game(self.player)
+        game = self.current_game()
         if game:
             game.start_new_round()
-            await game.broadcast()
+            await self.broadcast_game(game)
 
     async def cancel_game(self, **kwargs):
-        game = self.games.find_game(self.player)
+        game = self.current_game()
         if game:
             await self.games.cancel_game(game)
 
-        await self.arena.broadcast()
+        self.arena.schedule_broadcast()
 
     async def show_history(self, **kwargs):
-        await self.player.ws.send_json(self.player.history)
+        page = kwargs.get("data") or {}
+        offset = page.get("offset", 0)
+        limit = min(page.get("limit", settings.HISTORY_LIMIT), settings.HISTORY_LIMIT)
+
+        await self.send({
+            "action": "history_updates",
+            "result": "Done",
+            "offset": offset,
+            "total": self.player.history_size(),
+            "history": self.player.history_page(offset, limit)
+        })
+
+    # страница рейтинга и место самого игрока
+    async def show_leaderboard(self, **kwargs):
+        page = kwargs.get("data") or {}
+        offset = page.get("offset", 0)
+        limit = min(page.get("limit", 10), settings.LEADERBOARD_LIMIT)
+        leaderboard = self.arena.leaderboard
+
+        await self.send({
+            "action": "leaderboard_updates",
+            "result": "Done",
+            "score": leaderboard.score,
+            "offset": offset,
+            "total": len(leaderboard),
+            "rank": leaderboard.rank(self.player.uid),
+            "leaders": leaderboard.page(offset, limit)
+        })
 
     async def change_name(self, **kwargs):
         self.player.name = kwargs["data"]
-        await self.arena.broadcast()
+        self.arena.schedule_broadcast()
 
     async def change_type(self, **kwargs):
         self.player.game_type = kwargs["data"]
-        await self.arena.broadcast()
\ No newline at end of file
+        self.arena.schedule_broadcast()
+
+    # Пакет действий в одном кадре: действия проверяются и выполняются по
+    # порядку, ошибка одного не останавливает остальные. Клиент получает
+    # один ответ с результатом каждого действия, обновления игр
+    # рассылаются по одному разу после пакета, лобби - общей рассылкой
+    async def batch(self, **kwargs):
+        results = []
+        self.updated = {}
+        try:
+            for message in kwargs["data"]:
+                self.replies = []
+                try:
+                    await self.handle(message)
+                    result = {"action": message["action"], "result": "Done"}
+                except WSException as e:
+                    result = dict(e.message, action=message.get("action") if isinstance(message, dict) else None)
+
+                if self.replies:
+                    result["reply"] = self.replies[0] if len(self.replies) == 1 else self.replies
+                results.append(result)
+        finally:
+            self.replies = None
+            updated, self.updated = self.updated, None
+
+            await self.send({"action": "batch_results", "result": "Done", "results": results})
+            # отмененная в пакете игра уже разослана cancel_game
+            for game in updated.values():
+                if self.games.get_game(game.id) is game:
+                    await game.broadcast()
+
+    # переход на дельты лобби или восстановление после пропуска версии
+    async def resync(self, **kwargs):
+        self.player.lobby_deltas = True
+        await self.arena.send_snapshot(self.player)
+
+
+def build_dispatch(controller, schema=REQUEST_SCHEMA):
+    return {action: (validator, getattr(controller, action)) for action, validator in schema.items()}
+
+
+ActionsController.dispatch = build_dispatch(ActionsController)
@@ -0,0 +1,407 @@
+import asyncio
+import logging
+import mmap
+import os
+import struct
+import sys
+import time
+import settings
+from codec import JSON
+from models import Arena, Game, Games, TIE
+from rules import CODES, THROWS
+from storage import MemoryStorage, create_storage
+
+log = logging.getLogger('rps')
+
+# Журнал событий арены и игр для быстрого рестарта.
+# Состояние периодически пишется снимком snapshot-N.json, события после
+# него - в журналы journal-N.log, journal-N+1.log... При старте читается
+# последний снимок и проигрываются только журналы после него.
+
+# Запись журнала: тип, длина данных, данные
+HEADER = struct.Struct('!BH')
+
+# типы записей; 0 - конец записанной части файла
+JOIN = 1
+LEAVE = 2
+PLAYER = 3
+GAME = 4
+THROW = 5
+ROUND = 6
+NEW_ROUND = 7
+CANCEL = 8
+
+# uid, wins, games, game_type + имя
+JOIN_DATA = struct.Struct('!qIIB')
+# uid
+LEAVE_DATA = struct.Struct('!q')
+# uid, game_type + имя
+PLAYER_DATA = struct.Struct('!qB')
+# id игры, число игроков + uid игроков
+GAME_DATA = struct.Struct('!IB')
+UID = struct.Struct('!q')
+# id игры, uid, код броска
+THROW_DATA = struct.Struct('!IqB')
+# id игры, время раунда, победитель (-1 - ничья)
+ROUND_DATA = struct.Struct('!Idq')
+GAME_ID = struct.Struct('!I')
+
+SNAPSHOT = "snapshot-%08d.json"
+LOG = "journal-%08d.log"
+
+
+def generations(directory, pattern):
+    prefix, suffix = pattern.split("%08d")
+    found = []
+    for name in os.listdir(directory):
+        number = name[len(prefix):-len(suffix)]
+        if name.startswith(prefix) and name.endswith(suffix) and number.isdigit():
+            found.append(int(number))
+    return sorted(found)
+
+
+# Файл журнала, отображенный в память. Место выделяется кусками по
+# chunk байт, свободный хвост заполнен нулями. Записанное в отображение
+# переживает падение процесса (страницы остаются в кеше ядра), на диск
+# оно сбрасывается в flush: журнал вызывает его раз в flush_interval
+# секунд после записи, чтобы сбой машины терял не больше этого окна
+class LogFile:
+    def __init__(self, path, chunk=None):
+        self.path = path
+        self.chunk = chunk or settings.JOURNAL_CHUNK
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        self.file = os.fdopen(fd, "r+b")
+        size = os.fstat(fd).st_size
+        if size == 0:
+            size = self.chunk
+            self.file.truncate(size)
+
+        self.map = mmap.mmap(fd, size)
+        self.position = sum(HEADER.size + len(data) for _, data in read_records(self.map))
+
+    def append(self, kind, data):
+        end = self.position + HEADER.size + len(data)
+        if end > len(self.map):
+            self.grow(end)
+
+        HEADER.pack_into(self.map, self.position, kind, len(data))
+        self.map[self.position + HEADER.size:end] = data
+        self.position = end
+
+    def grow(self, size):
+        size = (size // self.chunk + 1) * self.chunk
+        self.map.close()
+        self.file.truncate(size)
+        self.map = mmap.mmap(self.file.fileno(), size)
+
+    def flush(self):
+        self.map.flush()
+
+    def close(self):
+        self.map.flush()
+        self.map.close()
+        self.file.close()
+
+
+# Записи подряд до нулевого заголовка или оборванной записи
+def read_records(buffer):
+    position, size = 0, len(buffer)
+
+    while position + HEADER.size <= size:
+        kind, length = HEADER.unpack_from(buffer, position)
+        start = position + HEADER.size
+        if kind == 0 or start + length > size:
+            break
+
+        yield kind, bytes(buffer[start:start + length])
+        position = start + length
+
+
+def read_log(path):
+    with open(path, "rb") as f:
+        return list(read_records(f.read()))
+
+
+class Journal:
+    def __init__(self, directory, interval=None, flush_interval=None):
+        self.directory = directory
+        self.interval = settings.JOURNAL_SNAPSHOT_INTERVAL if interval is None else interval
+        self.flush_interval = settings.JOURNAL_FLUSH_INTERVAL if flush_interval is None else flush_interval
+        self.generation = 0
+        self.log = None
+        self.arena = None
+        self.games = None
+        self.handle = None
+        self.flush_handle = None
+
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, pattern, generation):
+        return os.path.join(self.directory, pattern % generation)
+
+    # Загрузка снимка и хвоста журнала в пустые arena и games.
+    # check - сверять победителей раундов с Game.play
+    def replay(self, arena, games, check=False):
+        stats = {"events": 0, "rounds": 0, "mismatches": 0}
+
+        # при проигрывании в хранилище ничего не пишется: статистика
+        # и история там уже есть, раунды записались бы повторно
+        storage, arena.storage = arena.storage, MemoryStorage()
+        try:
+            snapshots = generations(self.directory, SNAPSHOT)
+            if snapshots:
+                self.generation = snapshots[-1]
+                with open(self.path(SNAPSHOT, self.generation), "rb") as f:
+                    load_snapshot(arena, games, JSON.decode(f.read()))
+
+            logs = [g for g in generations(self.directory, LOG) if g >= self.generation]
+            for generation in logs:
+                for kind, data in read_log(self.path(LOG, generation)):
+                    apply(arena, games, kind, data, storage, stats if check else None)
+                    stats["events"] += 1
+
+            if logs:
+                self.generation = logs[-1]
+        finally:
+            arena.storage = storage
+
+        return stats
+
+    # Восстановление с последующей записью изменений в журнал
+    def restore(self, arena, games):
+        stats = self.replay(arena, games)
+
+        self.arena, self.games = arena, games
+        arena.journal = games.journal = self
+        for game in games.games:
+            game.journal = self
+
+        self.log = LogFile(self.path(LOG, self.generation))
+        return stats
+
+    def write(self, kind, data):
+        self.log.append(kind, data)
+        self.schedule()
+
+    def schedule(self):
+        snapshot = self.handle is None and self.interval
+        flush = self.flush_handle is None and self.flush_interval
+        if not snapshot and not flush:
+            return
+
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+
+        if snapshot:
+            self.handle = loop.call_later(self.interval, self.start_snapshot)
+        if flush:
+            self.flush_handle = loop.call_later(self.flush_interval, self.flush)
+
+    def flush(self):
+        self.flush_handle = None
+        self.log.flush()
+
+    def start_snapshot(self):
+        self.handle = None
+        asyncio.ensure_future(self.snapshot())
+
+    # Снимок состояния кодируется в цикле событий, тогда же журнал
+    # переключается на новый файл; запись снимка идет в потоке
+    async def snapshot(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+
+        data = JSON.encode(dump_snapshot(self.arena, self.games))
+
+        self.generation += 1
+        generation = self.generation
+        self.log.close()
+        self.log = LogFile(self.path(LOG, generation))
+
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(None, self.write_snapshot, data, generation)
+        except Exception:
+            log.exception("journal snapshot failed")
+
+    def write_snapshot(self, data, generation):
+        path = self.path(SNAPSHOT, generation)
+        with open(path + ".tmp", "w") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+
+        # старые снимки и журналы больше не нужны
+        for old in generations(self.directory, SNAPSHOT):
+            if old < generation:
+                os.unlink(self.path(SNAPSHOT, old))
+        for old in generations(self.directory, LOG):
+            if old < generation:
+                os.unlink(self.path(LOG, old))
+
+    async def close(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        await self.snapshot()
+        self.log.close()
+
+    def player_joined(self, player):
+        name = player.name.encode()
+        self.write(JOIN, JOIN_DATA.pack(player.uid, player.wins, player.games, player.game_type) + name)
+
+    def player_left(self, player):
+        self.write(LEAVE, LEAVE_DATA.pack(player.uid))
+
+    def player_changed(self, player):
+        self.write(PLAYER, PLAYER_DATA.pack(player.uid, player.game_type) + player.name.encode())
+
+    def game_created(self, game):
+        self.write(GAME, GAME_DATA.pack(game.id, len(game.players)) +
+                   b"".join(UID.pack(p.uid) for p in game.players))
+
+    def throw(self, game, uid, value):
+        self.write(THROW, THROW_DATA.pack(game.id, uid, CODES[value]))
+
+    def round(self, game, created):
+        self.write(ROUND, ROUND_DATA.pack(game.id, created, -1 if game.winner == TIE else game.winner))
+
+    def new_round(self, game):
+        self.write(NEW_ROUND, GAME_ID.pack(game.id))
+
+    def game_canceled(self, game):
+        self.write(CANCEL, GAME_ID.pack(game.id))
+
+
+def dump_snapshot(arena, games):
+    return {
+        "last_game": games.last_id,
+        "players": [[p.uid, p.name, p.wins, p.games, p.game_type, list(p.history) if p.history else None]
+                    for p in arena],
+        "games": [[g.id, g.status, g.round, g.winner, [p.uid for p in g.players], list(g.throws.items())]
+                  for g in games.games],
+    }
+
+
+def load_snapshot(arena, games, snapshot):
+    for uid, name, wins, game_count, game_type, history in snapshot["players"]:
+        arena.create_player(uid, name, row={
+            "wins": wins, "games": game_count, "game_type": game_type,
+            "history": [(h[0], h[1], h[2], tuple(h[3]), h[4]) for h in history] if history else None,
+        })
+
+    for game_id, status, game_round, winner, uids, throws in snapshot["games"]:
+        players = [arena.get_player(uid) for uid in uids]
+        # снимок старой версии мог застать удаленного игрока в игре:
+        # такую игру некому продолжать, ее события в журнале пропускаются
+        if None in players:
+            log.warning("game %s skipped: player left", game_id)
+            continue
+
+        game = games.create_game(players[0], players[1:], game_id)
+        game.status, game.round, game.winner = status, game_round, winner
+        game.throws = dict(throws)
+
+    games.last_id = max(games.last_id, snapshot["last_game"])
+
+
+def apply(arena, games, kind, data, storage, stats=None):
+    # события игры, пропущенной при загрузке снимка (id игры - в начале)
+    if kind in (THROW, ROUND, NEW_ROUND, CANCEL) and games.get_game(*GAME_ID.unpack_from(data)) is None:
+        return
+
+    if kind == JOIN:
+        uid, wins, game_count, game_type = JOIN_DATA.unpack_from(data)
+        name = data[JOIN_DATA.size:].decode()
+        # история вернувшегося игрока - в хранилище, как и при подключении
+        row = storage.load_player(uid) or {"history": None}
+        row.update(wins=wins, games=game_count, game_type=game_type)
+        arena.create_player(uid, name, row=row)
+
+    elif kind == LEAVE:
+        player = arena.get_player(*LEAVE_DATA.unpack(data))
+        if player is not None:
+            arena.evict(player)
+
+    elif kind == PLAYER:
+        uid, game_type = PLAYER_DATA.unpack_from(data)
+        player = arena.get_player(uid)
+        player.name = data[PLAYER_DATA.size:].decode()
+        player.game_type = game_type
+
+    elif kind == GAME:
+        game_id, count = GAME_DATA.unpack_from(data)
+        uids = [UID.unpack_from(data, GAME_DATA.size + i * UID.size)[0] for i in range(count)]
+        players = [arena.get_player(uid) for uid in uids]
+        games.create_game(players[0], players[1:], game_id)
+
+    elif kind == THROW:
+        game_id, uid, code = THROW_DATA.unpack(data)
+        games.get_game(game_id).add_throw(uid, THROWS[code])
+
+    elif kind == ROUND:
+        game_id, created, winner = ROUND_DATA.unpack(data)
+        game = games.get_game(game_id)
+        winner = TIE if winner == -1 else winner
+        if stats is not None:
+            stats["rounds"] += 1
+            if check_round(game) != winner:
+                stats["mismatches"] += 1
+                log.error("game %s round %s: logged winner %s, expected %s",
+                          game_id, game.round, winner, check_round(game))
+        game.winner = winner
+        game.finish(created)
+
+    elif kind == NEW_ROUND:
+        games.get_game(*GAME_ID.unpack(data)).start_new_round()
+
+    elif kind == CANCEL:
+        game = games.get_game(*GAME_ID.unpack(data))
+        game.status = "canceled"
+        games.remove_game(game)
+
+
+# Победитель раунда заново по Game.play: единственный игрок
+# с выигрышным броском
+def check_round(game):
+    winning = Game.play(game.throws.values())
+    winners = [uid for uid, throw in game.throws.items() if throw == winning]
+    return winners[0] if len(winners) == 1 else TIE
+
+
+# Арена и игры процесса; при включенном журнале - восстановленные из него
+def create_state():
+    arena, games = Arena(create_storage()), Games()
+
+    if settings.JOURNAL:
+        started = time.perf_counter()
+        Journal(settings.JOURNAL).restore(arena, games)
+        log.info("restored %s players and %s games in %.2fs",
+                 len(arena), len(games), time.perf_counter() - started)
+
+    return arena, games
+
+
+async def close_state(arena):
+    if arena.journal is not None:
+        await arena.journal.close()
+    await arena.storage.close()
+
+
+# Проверка журнала без сервера: python journal.py <каталог>
+if __name__ == '__main__':
+    directory = sys.argv[1] if len(sys.argv) > 1 else settings.JOURNAL
+    arena, games = Arena(), Games()
+
+    started = time.perf_counter()
+    stats = Journal(directory).replay(arena, games, check=True)
+    elapsed = time.perf_counter() - started
+
+    print(f"players={len(arena)} games={len(games)} events={stats['events']} "
+          f"rounds={stats['rounds']} mismatches={stats['mismatches']} elapsed={elapsed:.2f}s")
+    sys.exit(1 if stats["mismatches"] else 0)
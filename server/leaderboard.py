@@ -0,0 +1,74 @@
+from sortedcontainers import SortedList
+import settings
+
+WINS = "wins"
+WIN_RATE = "win_rate"
+
+
+# Рейтинг игроков, поддерживается по мере завершения раундов: ключи
+# сортировки лежат в SortedList, поэтому место игрока и страница рейтинга
+# находятся за O(log N) без сортировки всех игроков.
+#   wins     - больше побед выше, при равенстве выше тот, у кого меньше игр
+#   win_rate - доля побед у сыгравших не меньше min_games игр
+# Ушедшие из арены игроки остаются в рейтинге с последней статистикой.
+class Leaderboard:
+    def __init__(self, score=None, min_games=None):
+        self.score = score or settings.LEADERBOARD_SCORE
+        self.min_games = settings.LEADERBOARD_MIN_GAMES if min_games is None else min_games
+        self.order = SortedList()
+        # uid -> (ключ, имя, победы, игры)
+        self.entries = {}
+
+    def __len__(self):
+        return len(self.order)
+
+    # ключ растет от первого места к последнему, uid делает его уникальным
+    def key(self, uid, wins, games):
+        if self.score == WIN_RATE:
+            if games < max(self.min_games, 1):
+                return None
+            return -wins / games, -games, uid
+
+        if not games:
+            return None
+        return -wins, games, uid
+
+    def update(self, player):
+        self.set(player.uid, player.name, player.wins, player.games)
+
+    def set(self, uid, name, wins, games):
+        key = self.key(uid, wins, games)
+        if key is None:
+            return
+
+        entry = self.entries.get(uid)
+        if entry is not None:
+            self.order.remove(entry[0])
+
+        self.order.add(key)
+        self.entries[uid] = (key, name, wins, games)
+
+    # строки (uid, name, wins, games) из хранилища: после рестарта в
+    # рейтинге и те, кто еще не подключался
+    def load(self, rows):
+        for row in rows:
+            self.set(*row)
+
+    def rename(self, player):
+        entry = self.entries.get(player.uid)
+        if entry is not None:
+            self.entries[player.uid] = (entry[0], player.name) + entry[2:]
+
+    # место игрока начиная с 1, None - игрок еще не в рейтинге
+    def rank(self, uid):
+        entry = self.entries.get(uid)
+        if entry is None:
+            return None
+        return self.order.index(entry[0]) + 1
+
+    def page(self, offset=0, limit=10):
+        rows = []
+        for rank, key in enumerate(self.order.islice(offset, offset + limit), offset + 1):
+            _, name, wins, games = self.entries[key[-1]]
+            rows.append({"rank": rank, "uid": key[-1], "name": name, "wins": wins, "games": games})
+        return rows
@@ -0,0 +1,368 @@
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import platform
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import aiohttp
+from aiohttp import web
+from codec import JSON
+
+# Нагрузочные тесты по настоящему протоколу websocket с куки сессии.
+#   scenario - приложение запускается в этом же процессе, тысячи клиентов
+#              проходят сценарий игры; задержки, сообщения в секунду
+#              и память сохраняются в JSON для сравнения между коммитами
+#   scaling  - сервер запускается отдельным процессом с разным числом
+#              воркеров, меряется пропускная способность и процессорное
+#              время брокера и воркеров на ответ
+
+# Сколько ждать ответа на действие, секунды
+REPLY_TIMEOUT = 30
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def wait_port(port, timeout=20):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError(f"server did not start on port {port}")
+
+
+def start_server(port, workers):
+    directory = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, RPS_BROKER_SOCKET=os.path.join(tempfile.mkdtemp(), "broker.sock"))
+    return subprocess.Popen([sys.executable, "server.py", "--port", str(port), "--workers", str(workers)],
+                            cwd=directory, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def children(pid):
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            return [int(child) for child in f.read().split()]
+    except OSError:
+        return []
+
+
+# Процессорное время процесса (user + system), секунды
+def cpu_time(pid):
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+class Client:
+    def __init__(self, url, query=""):
+        self.url = url
+        self.query = query
+        # куки для адреса 127.0.0.1 принимаются только с unsafe=True
+        self.session = aiohttp.ClientSession(cookie_jar=aiohttp.CookieJar(unsafe=True))
+        self.ws = None
+
+    async def connect(self):
+        # index создает сессию, ее куки уходят при подключении к /ws
+        async with self.session.get(self.url + "/"):
+            pass
+        self.ws = await self.session.ws_connect(self.url + "/ws" + self.query)
+
+    async def request(self, message, action):
+        await self.ws.send_json(message)
+        while True:
+            reply = await self.ws.receive_json()
+            if reply.get("action") == action:
+                return reply
+
+    async def close(self):
+        if self.ws is not None:
+            await self.ws.close()
+        await self.session.close()
+
+
+# Клиент сценария: задержка действия - время от отправки до первого
+# сообщения, в котором виден его результат
+class ProtocolClient(Client):
+    def __init__(self, url, query, latencies):
+        super().__init__(url, query)
+        self.latencies = latencies
+        self.uid = None
+        self.sent = 0
+        self.received = 0
+
+    async def receive(self):
+        # разбор ответов на клиенте тоже занимает общий цикл событий
+        message = await self.ws.receive_json(loads=JSON.decode, timeout=REPLY_TIMEOUT)
+        self.received += 1
+        if "user" in message:
+            self.uid = message["user"]["uid"]
+        return message
+
+    async def wait(self, predicate):
+        while True:
+            message = await self.receive()
+            if predicate(message):
+                return message
+
+    async def act(self, name, message, predicate):
+        started = time.perf_counter()
+        await self.ws.send_json(message)
+        self.sent += 1
+        reply = await self.wait(predicate)
+        self.latencies.setdefault(name, []).append(time.perf_counter() - started)
+        return reply
+
+    async def connect(self):
+        started = time.perf_counter()
+        await super().connect()
+        # uid игрока приходит в первой рассылке лобби или в снимке
+        await self.wait(lambda m: self.uid is not None)
+        self.latencies.setdefault("connect", []).append(time.perf_counter() - started)
+
+    def game(self, message, status=None, game_round=None, thrown=False):
+        if message.get("action") != "game_updates":
+            return False
+
+        stat = message["game_stat"]
+        if stat["status"] == "canceled":
+            raise RuntimeError("game canceled")
+        return (status is None or stat["status"] == status) and \
+               (game_round is None or stat["round"] >= game_round) and \
+               (not thrown or str(self.uid) in stat["throws"] or stat["status"] == "finished")
+
+    async def play(self, rounds, throws):
+        await self.act("mark_as_ready", {"action": "mark_as_ready"}, lambda m: self.game(m))
+
+        for game_round in range(1, rounds + 1):
+            throw = throws[(self.uid + game_round) % len(throws)]
+            reply = await self.act("throw", {"action": "throw", "data": throw},
+                                   lambda m: self.game(m, game_round=game_round, thrown=True))
+            # бросок соперника мог завершить раунд в том же сообщении
+            if not self.game(reply, "finished", game_round):
+                await self.wait(lambda m: self.game(m, "finished", game_round))
+
+            if game_round < rounds:
+                await self.act("start_new_round", {"action": "start_new_round"},
+                               lambda m: self.game(m, game_round=game_round + 1))
+
+    async def close(self):
+        started = time.perf_counter()
+        await super().close()
+        self.latencies.setdefault("disconnect", []).append(time.perf_counter() - started)
+
+    async def rename(self):
+        name = f"Bot_{self.uid}"
+        await self.act("change_name", {"action": "change_name", "data": name},
+                       lambda m: m.get("user", {}).get("name") == name)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def rss():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * resource.getpagesize()
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Приложение в этом процессе: клиенты и сервер делят один цикл событий
+# и одно ядро, поэтому задержки включают работу клиентов
+async def scenario(clients, rounds, lobby_deltas):
+    from server import create_app
+
+    app = create_app()
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    port = free_port()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+
+    latencies = {}
+    url = f"http://127.0.0.1:{port}"
+    pool = [ProtocolClient(url, "?lobby=delta" if lobby_deltas else "", latencies) for _ in range(clients)]
+    throws = ("ROCK", "PAPER", "SCISSORS")
+    memory = {"before": rss()}
+
+    started = time.perf_counter()
+    try:
+        # фазы идут по очереди для всех клиентов: иначе отключение
+        # соперника отменяет игру посреди раундов
+        await asyncio.gather(*(c.connect() for c in pool))
+        memory["connected"] = rss()
+        await asyncio.gather(*(c.play(rounds, throws) for c in pool))
+        await asyncio.gather(*(c.rename() for c in pool))
+    finally:
+        elapsed = time.perf_counter() - started
+        await asyncio.gather(*(c.close() for c in pool))
+        await runner.cleanup()
+
+    messages = sum(c.sent + c.received for c in pool)
+
+    return {
+        "latency": {
+            name: {"count": len(values), "p50": percentile(values, 0.5), "p99": percentile(values, 0.99)}
+            for name, values in latencies.items()
+        },
+        "messages": messages,
+        "messages_per_second": messages / elapsed,
+        "elapsed": elapsed,
+        "rss_mb": rss() / 2 ** 20,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10,
+        "bytes_per_client": (memory["connected"] - memory["before"]) / clients,
+    }
+
+
+def print_results(results):
+    for name, entry in results["latency"].items():
+        print(f"{name:>16}: n={entry['count']} p50={entry['p50'] * 1e3:.2f}ms p99={entry['p99'] * 1e3:.2f}ms")
+    print(f"messages={results['messages']} messages/s={results['messages_per_second']:,.0f} "
+          f"elapsed={results['elapsed']:.2f}s rss={results['rss_mb']:.1f}MB "
+          f"peak={results['peak_rss_mb']:.1f}MB per client={results['bytes_per_client'] / 1024:.1f}KB")
+
+
+# Сравнение с сохраненным прогоном: регрессия - рост p99 или памяти либо
+# падение сообщений в секунду больше чем на tolerance
+def compare(baseline, current, tolerance):
+    regressions = []
+
+    def check(name, before, after, higher_is_better=False):
+        if not before:
+            return
+        change = (after - before) / before
+        worse = -change if higher_is_better else change
+        mark = "REGRESSION" if worse > tolerance else "ok"
+        print(f"{name:>28}: {before:.6g} -> {after:.6g} ({change:+.1%}) {mark}")
+        if worse > tolerance:
+            regressions.append(name)
+
+    for name, entry in current["latency"].items():
+        if name in baseline["latency"]:
+            check(f"{name} p99", baseline["latency"][name]["p99"], entry["p99"])
+    check("messages_per_second", baseline["messages_per_second"], current["messages_per_second"], True)
+    check("bytes_per_client", baseline["bytes_per_client"], current["bytes_per_client"])
+
+    return regressions
+
+
+# Каждый клиент запрашивает историю и ждет ответа: ответы в секунду
+# по всем клиентам показывают пропускную способность пути
+# клиент -> воркер -> брокер -> воркер -> клиент
+async def throughput(port, clients, duration):
+    url = f"http://127.0.0.1:{port}"
+    pool = [Client(url) for _ in range(clients)]
+    await asyncio.gather(*(c.connect() for c in pool))
+
+    replies = 0
+    deadline = time.monotonic() + duration
+
+    async def run(client):
+        nonlocal replies
+        while time.monotonic() < deadline:
+            await client.request({"action": "show_history", "data": {"limit": 1}}, "history_updates")
+            replies += 1
+
+    started = time.monotonic()
+    await asyncio.gather(*(run(c) for c in pool))
+    elapsed = time.monotonic() - started
+
+    await asyncio.gather(*(c.close() for c in pool))
+    return replies, elapsed
+
+
+async def scaling(workers, clients, duration):
+    for count in workers:
+        port = free_port()
+        server = start_server(port, count)
+        try:
+            await wait_port(port)
+            await asyncio.sleep(0.5)
+
+            # в кластере первым запускается брокер, за ним воркеры
+            processes = sorted(children(server.pid)) or [server.pid]
+            before = [cpu_time(pid) for pid in processes]
+            replies, elapsed = await throughput(port, clients, duration)
+            used = [(cpu_time(pid) - started) / replies * 1e6 for pid, started in zip(processes, before)]
+
+            # время брокера на ответ - предел кластера при любом числе ядер
+            if len(processes) > 1:
+                cpu = f"cpu/reply: broker={used[0]:.0f}us (limit {1e6 / used[0]:,.0f} replies/s) " \
+                      f"workers={sum(used[1:]):.0f}us"
+            else:
+                cpu = f"cpu/reply={used[0]:.0f}us"
+            print(f"workers={count} clients={clients} replies/s={replies / elapsed:,.0f} {cpu}")
+        finally:
+            server.terminate()
+            server.wait()
+
+
+def run_scenario(args):
+    if args.clients % 2:
+        raise SystemExit("clients must be even: players are matched in pairs")
+
+    results = asyncio.run(scenario(args.clients, args.rounds, args.lobby == "delta"))
+    print_results(results)
+
+    report = {
+        "commit": git_commit(),
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "params": {"clients": args.clients, "rounds": args.rounds, "lobby": args.lobby},
+        "results": results,
+    }
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline["params"] != report["params"]:
+            print(f"warning: baseline params differ: {baseline['params']}")
+        if compare(baseline["results"], results, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    command = commands.add_parser("scenario", help="in-process game scenario with latency percentiles")
+    command.add_argument('--clients', type=int, default=1000)
+    command.add_argument('--rounds', type=int, default=5)
+    command.add_argument('--lobby', choices=["full", "delta"], default="full")
+    command.add_argument('--output', help="save results as JSON")
+    command.add_argument('--compare', help="JSON of a previous run; exit 1 on regression")
+    command.add_argument('--tolerance', type=float, default=0.2)
+
+    command = commands.add_parser("scaling", help="throughput of a server process per worker count")
+    command.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    command.add_argument('--clients', type=int, default=200)
+    command.add_argument('--duration', type=float, default=10)
+
+    args = parser.parse_args()
+    if args.command == "scenario":
+        run_scenario(args)
+    else:
+        asyncio.run(scaling(args.workers, args.clients, args.duration))
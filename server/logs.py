@@ -1,14 +1,139 @@
+import atexit
+import contextvars
+import copy
+import json
 import logging
-from logging.handlers import RotatingFileHandler
+import multiprocessing
+import os
+import queue
+import random
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+import settings
 
+# Логирование настраивается один раз на процесс: логгер только кладет
+# записи в очередь, в файл их пишет фоновый поток QueueListener.
+# Записи - строки JSON с контекстом запроса (uid игрока, действие)
+# и полями из extra.
+
+# Контекст текущего запроса, словарь полей или None. Словарь не меняется
+# после set: подготовленные записи ссылаются на него до записи в файл
+log_context = contextvars.ContextVar("log_context", default=None)
+
+# Атрибуты LogRecord, которые не являются полями extra
+RECORD_FIELDS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "context"}
+
+# имя логгера -> (pid, QueueListener)
+listeners = {}
+
+
+# Запись подготавливается в потоке, где ее создали: там доступен
+# контекст запроса, а аргументы и исключение еще живы
+class ContextQueueHandler(QueueHandler):
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        record.context = log_context.get()
+
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+
+        return record
+
+
+# Частые события (extra={"event": ...}) пишутся с заданной долей
+class SamplingFilter(logging.Filter):
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record):
+        rate = self.rates.get(getattr(record, "event", None))
+        return rate is None or random.random() < rate
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "process": record.processName,
+            "message": record.getMessage(),
+        }
+
+        context = getattr(record, "context", None)
+        if context:
+            entry.update(context)
+
+        for key, value in vars(record).items():
+            if key not in RECORD_FIELDS:
+                entry[key] = value
+
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+# "throw=0.01,connect=0.5" -> {"throw": 0.01, "connect": 0.5}
+def parse_sampling(value):
+    rates = {}
+    for item in filter(None, value.split(",")):
+        event, rate = item.split("=")
+        rates[event.strip()] = float(rate)
+    return rates
+
+
+# Файл лога процесса в каталоге логов: в кластере у брокера и каждого
+# воркера свой
+def log_path(name, directory=None):
+    process = multiprocessing.current_process().name
+    if process != "MainProcess":
+        base, ext = os.path.splitext(name)
+        name = f"{base}-{process}{ext}"
+
+    return os.path.join(settings.LOG_DIR if directory is None else directory, name)
+
+
+# handlers - куда пишет фоновый поток, по умолчанию файл settings.LOG_FILE
+# в каталоге settings.LOG_DIR. Повторный вызов в том же процессе ничего не меняет; в дочернем процессе
+# после fork очередь и поток создаются заново
+def setup_logging(name="rps", handlers=None, level=None, sampling=None):
+    started = listeners.get(name)
+    if started is not None and started[0] == os.getpid():
+        return started[1]
 
-def create_log(name):
     log = logging.getLogger(name)
-    formatter = logging.Formatter('%(asctime)s %(levelname)s - %(message)s')
-    file_handler = RotatingFileHandler('{}.log'.format(name), maxBytes=5*1024*1024, backupCount=1)
+    for handler in list(log.handlers):
+        if isinstance(handler, QueueHandler):
+            log.removeHandler(handler)
+
+    if handlers is None:
+        path = log_path(settings.LOG_FILE)
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        handler = RotatingFileHandler(path, maxBytes=5 * 1024 * 1024, backupCount=1)
+        handler.setFormatter(JsonFormatter())
+        handlers = [handler]
+
+    records = queue.SimpleQueue()
+    handler = ContextQueueHandler(records)
+    handler.addFilter(SamplingFilter(parse_sampling(settings.LOG_SAMPLING) if sampling is None else sampling))
+
+    listener = QueueListener(records, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(stop_logging, name)
+
+    log.addHandler(handler)
+    log.setLevel(level or settings.LOG_LEVEL)
+    log.propagate = False
+
+    listeners[name] = (os.getpid(), listener)
+    return listener
 
-    file_handler.setFormatter(formatter)
-    log.setLevel(logging.DEBUG)
-    log.addHandler(file_handler)
 
-    return log
+# Дописывает очередь и останавливает поток
+def stop_logging(name="rps"):
+    started = listeners.pop(name, None)
+    if started is not None and started[0] == os.getpid():
+        started[1].stop()
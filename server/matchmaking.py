@@ -0,0 +1,268 @@
+import asyncio
+import logging
+import random
+import time
+import settings
+from metrics import REGISTRY
+
+log = logging.getLogger('rps')
+
+MATCH_SECONDS = REGISTRY.histogram("rps_match_pass_seconds", "Batch matchmaking pass time")
+MATCH_WAIT_SECONDS = REGISTRY.histogram("rps_match_wait_seconds", "Longest wait from ready to match in a game",
+                                        buckets=(0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300))
+MATCH_GAP = REGISTRY.histogram("rps_match_rating_gap", "Rating spread within a matched game",
+                               buckets=(10, 25, 50, 100, 200, 500, 1000))
+
+
+# Множество с O(1) вставкой, удалением и случайной выборкой:
+# элементы лежат в списке, позиции - в словаре uid -> индекс
+class ReadyPool:
+    def __init__(self):
+        self.items = []
+        self.positions = {}
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, player):
+        return player.uid in self.positions
+
+    def add(self, player):
+        if player.uid in self.positions:
+            return
+
+        self.positions[player.uid] = len(self.items)
+        self.items.append(player)
+
+    def discard(self, player):
+        index = self.positions.pop(player.uid, None)
+        if index is None:
+            return
+
+        # на место удаляемого ставим последний элемент
+        last = self.items.pop()
+        if index < len(self.items):
+            self.items[index] = last
+            self.positions[last.uid] = index
+
+    def sample(self, count, exclude=None):
+        available = len(self.items) - (1 if exclude is not None and exclude in self else 0)
+        if available < count:
+            return None
+
+        # выборка без повторов; при малом пуле перебираем всех
+        if available <= count * 2:
+            candidates = [p for p in self.items if p is not exclude]
+            return random.sample(candidates, count)
+
+        chosen = {}
+        while len(chosen) < count:
+            player = self.items[random.randrange(len(self.items))]
+            if player is not exclude:
+                chosen[player.uid] = player
+
+        return list(chosen.values())
+
+
+# Пулы готовых к игре игроков, отдельный пул для каждого типа игры
+class Matchmaker:
+    def __init__(self):
+        self.pools = {}
+
+    def pool(self, game_type):
+        pool = self.pools.get(game_type)
+        if pool is None:
+            pool = self.pools[game_type] = ReadyPool()
+        return pool
+
+    def update(self, player, game_type=None):
+        # game_type - прежний тип игры, если он изменился
+        if game_type is not None and game_type != player.game_type:
+            self.pool(game_type).discard(player)
+
+        if player.ready:
+            self.pool(player.game_type).add(player)
+        else:
+            self.pool(player.game_type).discard(player)
+
+    def remove(self, player):
+        self.pool(player.game_type).discard(player)
+
+    def ready_count(self, game_type):
+        return len(self.pool(game_type))
+
+    def get_rivals(self, gamer):
+        rivals = self.pool(gamer.game_type).sample(gamer.game_type, exclude=gamer)
+        if not rivals:
+            return None
+
+        for r in rivals:
+            r.ready = False
+
+        return rivals
+
+
+# Рейтинг из статистики игрока: доля побед, сглаженная одной победой и
+# одним поражением, по шкале 0..1000. Меняется с каждым раундом
+def rating(player):
+    return 1000 * (player.wins + 1) // (player.games + 2)
+
+
+# Готовые игроки в корзинах рейтинга шириной width. Запись игрока -
+# кортеж (рейтинг, время готовности, uid, игрок): корзина - словарь
+# uid -> запись, вставка и удаление O(1), обход по возрастанию рейтинга
+# сортирует только номера корзин и записи внутри корзины
+class RatedPool:
+    def __init__(self, width, clock=time.monotonic):
+        self.width = width
+        self.clock = clock
+        self.buckets = {}
+        self.entries = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, player):
+        return player.uid in self.entries
+
+    # повторное добавление переносит игрока в корзину нового рейтинга,
+    # время ожидания сохраняется
+    def add(self, player):
+        value = rating(player)
+        entry = self.entries.get(player.uid)
+        if entry is not None:
+            if entry[0] == value:
+                return
+            self.unlink(entry)
+            since = entry[1]
+        else:
+            since = self.clock()
+
+        entry = self.entries[player.uid] = (value, since, player.uid, player)
+        self.buckets.setdefault(value // self.width, {})[player.uid] = entry
+
+    def discard(self, player):
+        entry = self.entries.pop(player.uid, None)
+        if entry is not None:
+            self.unlink(entry)
+
+    def unlink(self, entry):
+        index = entry[0] // self.width
+        bucket = self.buckets[index]
+        del bucket[entry[2]]
+        if not bucket:
+            del self.buckets[index]
+
+    def ordered(self):
+        entries = []
+        for index in sorted(self.buckets):
+            entries.extend(sorted(self.buckets[index].values()))
+        return entries
+
+
+# Подбор по рейтингу: готовые игроки ждут пакетного прохода match, который
+# разбивает пул на как можно больше игр из соседей по рейтингу. Игроки
+# подходят друг другу, если пересекаются их окна рейтинга: окно - gap
+# плюс gap_per_second за каждую секунду ожидания, но не больше max_gap
+class SkillMatchmaker(Matchmaker):
+    def __init__(self, width=None, gap=None, gap_per_second=None, max_gap=None, clock=time.monotonic):
+        super().__init__()
+        self.width = width or settings.MATCH_BUCKET
+        self.gap = settings.MATCH_GAP if gap is None else gap
+        self.gap_per_second = settings.MATCH_GAP_PER_SECOND if gap_per_second is None else gap_per_second
+        self.max_gap = settings.MATCH_MAX_GAP if max_gap is None else max_gap
+        self.clock = clock
+
+    def pool(self, game_type):
+        pool = self.pools.get(game_type)
+        if pool is None:
+            pool = self.pools[game_type] = RatedPool(self.width, self.clock)
+        return pool
+
+    # по запросу соперники не ищутся: игрок ждет прохода match
+    def get_rivals(self, gamer):
+        return None
+
+    def window(self, waited):
+        return min(self.gap + self.gap_per_second * waited, self.max_gap)
+
+    # Группы игроков (по game_type + 1) для новых игр. Жадный проход по
+    # возрастанию рейтинга: группа из подряд идущих игроков берется, если
+    # совместимы крайние из них, иначе самый слабый ждет следующего прохода.
+    # Из пулов игроков убирает сброс ready, как и в get_rivals
+    def match(self, now=None):
+        now = now or self.clock()
+        gap, per_second, max_gap = self.gap, self.gap_per_second, self.max_gap
+        groups = []
+
+        for game_type, pool in self.pools.items():
+            size = game_type + 1
+            entries = pool.ordered()
+            i = 0
+
+            while i + size <= len(entries):
+                low, high = entries[i], entries[i + size - 1]
+                # раньше готов - меньше since - шире окно
+                allowed = min(gap + per_second * (now - low[1]), max_gap) + \
+                    min(gap + per_second * (now - high[1]), max_gap)
+
+                if high[0] - low[0] <= allowed:
+                    group = entries[i:i + size]
+                    MATCH_GAP.observe(high[0] - low[0])
+                    MATCH_WAIT_SECONDS.observe(now - min(entry[1] for entry in group))
+                    groups.append([entry[3] for entry in group])
+                    i += size
+                else:
+                    i += 1
+
+        for group in groups:
+            for player in group:
+                player.ready = False
+
+        return groups
+
+
+def create_matchmaker():
+    if settings.MATCHMAKER == "skill":
+        return SkillMatchmaker()
+    return Matchmaker()
+
+
+# Пакетный подбор раз в interval секунд в процессе, где живет арена;
+# при случайном подборе ничего не делает
+class BatchMatcher:
+    def __init__(self, arena, games, interval=None):
+        self.arena = arena
+        self.games = games
+        self.interval = settings.MATCH_INTERVAL if interval is None else interval
+        self.handle = None
+
+    async def start(self, app=None):
+        if isinstance(self.arena.matchmaker, SkillMatchmaker):
+            self.schedule()
+
+    async def stop(self, app=None):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+
+    def schedule(self):
+        self.handle = asyncio.get_running_loop().call_later(self.interval, self.run)
+
+    def run(self):
+        self.schedule()
+        try:
+            self.match()
+        except Exception:
+            log.exception("matchmaking pass failed")
+
+    def match(self):
+        with MATCH_SECONDS.time():
+            groups = self.arena.matchmaker.match()
+        if not groups:
+            return []
+
+        games = [self.games.create_game(group[0], group[1:]) for group in groups]
+        self.arena.schedule_broadcast()
+        asyncio.ensure_future(self.games.broadcast(games))
+        return games
@@ -0,0 +1,156 @@
+import time
+from bisect import bisect_left
+from aiohttp import web
+
+# Метрики процесса в текстовом формате Prometheus. Счетчики и гистограммы
+# обновляются на горячем пути, поэтому наблюдение - поиск корзины и два
+# сложения; состояние арены (сокеты, игры, готовые игроки) считается
+# только при запросе /metrics.
+
+# Границы корзин гистограмм задержек, секунды
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                   0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, values)) + "}"
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+
+    def inc(self, amount=1, *labels):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        for labels, value in self.values.items():
+            yield self.name + format_labels(self.labels, labels), value
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # значения меток -> [счетчики корзин (последняя - +Inf), сумма]
+        self.values = {}
+
+    def observe(self, value, *labels):
+        entry = self.values.get(labels)
+        if entry is None:
+            entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+
+        entry[0][bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    # время выполнения блока: with histogram.time("label"):
+    def time(self, *labels):
+        return Timer(self, labels)
+
+    def samples(self):
+        for labels, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                yield self.name + "_bucket" + format_labels(self.labels + ("le",), labels + (le,)), cumulative
+
+            yield self.name + "_sum" + format_labels(self.labels, labels), total
+            yield self.name + "_count" + format_labels(self.labels, labels), cumulative
+
+
+class Timer:
+    __slots__ = ("histogram", "labels", "started")
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+
+    def __exit__(self, *args):
+        self.histogram.observe(time.perf_counter() - self.started, *self.labels)
+
+
+# Значение считается при каждом запросе метрик: collect возвращает
+# пары (значения меток, число)
+class Gauge:
+    def __init__(self, name, help, labels=(), collect=None, kind="gauge"):
+        self.kind = kind
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.collect = collect
+
+    def samples(self):
+        for labels, value in self.collect():
+            yield self.name + format_labels(self.labels, labels), value
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def gauge(self, name, help, labels=(), collect=None, kind="gauge"):
+        return self.register(Gauge(name, help, labels, collect, kind))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for sample, value in metric.samples():
+                lines.append(f"{sample} {value}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+ACTION_SECONDS = REGISTRY.histogram("rps_action_seconds", "Action handling time", ("action",))
+ACTION_ERRORS = REGISTRY.counter("rps_action_errors_total", "Rejected client messages", ("code",))
+BROADCAST_SECONDS = REGISTRY.histogram("rps_broadcast_seconds", "Broadcast time", ("kind",))
+BROADCAST_MESSAGES = REGISTRY.counter("rps_broadcast_messages_total", "Messages sent by broadcasts")
+BROADCAST_FAILURES = REGISTRY.counter("rps_broadcast_failures_total", "Messages that failed to send")
+GET_RIVALS_SECONDS = REGISTRY.histogram("rps_get_rivals_seconds", "Rival selection time")
+
+
+# Метрики состояния арены и игр процесса, где они живут
+def register_state(arena, games, registry=REGISTRY):
+    registry.gauge("rps_players", "Known players", collect=lambda: [((), len(arena))])
+    registry.gauge("rps_sockets", "Connected sockets", collect=lambda: [((), len(arena.sockets))])
+    registry.gauge("rps_detached_players", "Players waiting to reconnect", collect=lambda: [((), len(arena.detached))])
+    registry.gauge("rps_games", "Live games", collect=lambda: [((), len(games))])
+    registry.gauge("rps_ready_players", "Players waiting for a game", ("game_type",),
+                   collect=lambda: [((game_type,), len(pool)) for game_type, pool in arena.matchmaker.pools.items()])
+    # счетчики планировщика рассылок лобби
+    registry.gauge("rps_lobby_broadcasts_requested_total", "Lobby broadcasts requested",
+                   collect=lambda: [((), arena.scheduler.requested)], kind="counter")
+    registry.gauge("rps_lobby_broadcasts_sent_total", "Lobby broadcasts sent after coalescing",
+                   collect=lambda: [((), arena.scheduler.sent)], kind="counter")
+
+
+async def metrics_handler(request):
+    return web.Response(body=REGISTRY.render().encode(),
+                        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
@@ -1,133 +1,552 @@
+import asyncio
 import datetime
-import random
+import time
 import uuid
-
-PASS = "PASS"
-ROCK = "ROCK"
-PAPER = "PAPER"
-SCISSORS = "SCISSORS"
-TIE = "TIE"
+import settings
+from collections import deque
+from itertools import islice
+from broadcast import BroadcastScheduler, fan_out
+from codec import JSON
+from leaderboard import Leaderboard
+from matchmaking import create_matchmaker
+from metrics import BROADCAST_SECONDS, GET_RIVALS_SECONDS
+from storage import MemoryStorage
+from timers import TimerWheel
+from rules import PASS, ROCK, PAPER, SCISSORS, TIE, CODES, THROWS, NO_WINNER, WINNING, mask_of, outcome_table
+
+LOBBY_SET = "set"
+LOBBY_REMOVE = "remove"
+QUEUE_UPDATES = "queue_updates"
+QUEUE_DELTA = "queue_delta"
+GAME_UPDATES = "game_updates"
 
 
 class Player:
+    __slots__ = ("listener", "uid", "_name", "ws", "lobby_deltas", "_wins", "_games",
+                 "_ready", "_game_type", "history", "version", "codec", "_encoded", "seen")
+
     def __init__(self, uid=None, name=None, ws=None):
-        self.uid = uid if uid else int(str(uuid.uuid1().int)[-6:])
-        self.name = name if name else f"User_{self.uid}"
+        # Арена подписывается на изменения ready и game_type,
+        # чтобы поддерживать пулы готовых игроков
+        self.listener = None
+        self.uid = uid if uid else self.new_uid()
+        self._name = name if name else f"User_{self.uid}"
         self.ws = ws
-        self.wins = 0
-        self.games = 0
-        self.ready = False
-        self.game_type = 1
-        self.history = []
+        # клиент подписан на дельты лобби вместо полных снимков
+        self.lobby_deltas = False
+        self._wins = 0
+        self._games = 0
+        self._ready = False
+        self._game_type = 1
+        # кольцевой буфер записей раундов, создается с первой записью
+        self.history = None
+        # кодек соединения, версия сериализуемых полей и кеш encode
+        self.codec = JSON
+        self.version = 0
+        self._encoded = None
+        # время последнего сообщения от клиента (time.monotonic)
+        self.seen = 0.0
+
+    @staticmethod
+    def new_uid():
+        return int(str(uuid.uuid1().int)[-6:])
+
+    def changed(self, field, old):
+        self.version += 1
+        self._encoded = None
+        if self.listener:
+            self.listener.player_changed(self, field, old)
+
+    @property
+    def name(self):
+        return self._name
+
+    @name.setter
+    def name(self, value):
+        old, self._name = self._name, value
+        if old != value:
+            self.changed("name", old)
+
+    @property
+    def ready(self):
+        return self._ready
+
+    @ready.setter
+    def ready(self, value):
+        old, self._ready = self._ready, value
+        if old != value:
+            self.changed("ready", old)
+
+    @property
+    def game_type(self):
+        return self._game_type
+
+    @game_type.setter
+    def game_type(self, value):
+        old, self._game_type = self._game_type, value
+        if old != value:
+            self.changed("game_type", old)
+
+    @property
+    def wins(self):
+        return self._wins
+
+    @property
+    def games(self):
+        return self._games
+
+    def record_round(self, record, won):
+        self._games += 1
+        if won:
+            self._wins += 1
+
+        if self.history is None:
+            self.history = deque(maxlen=settings.HISTORY_LIMIT)
+        self.history.append(record)
+
+        # для раунда вместо прежнего значения передается его запись
+        self.changed("round", record)
+
+    # восстановление сохраненного игрока, row - строка хранилища
+    def restore(self, row):
+        self._wins = row["wins"]
+        self._games = row["games"]
+        self._game_type = row["game_type"]
+
+        if row["history"]:
+            self.history = deque(row["history"], maxlen=settings.HISTORY_LIMIT)
+
+    # history - записи от старых к новым для старого клиента из static,
+    # который рисует историю из данных игрока. Клиенты с дельтами лобби
+    # запрашивают ее через show_history
+    def to_dict(self, history=False):
+        user = {
+            "uid": self.uid,
+            "name": self._name,
+            "wins": self._wins,
+            "games": self._games,
+            "ready": self._ready,
+            "game_type": self._game_type,
+        }
+        if history:
+            user["history"] = [format_history(r) for r in self.history] if self.history else []
+        return user
+
+    def encode(self, codec=None):
+        codec = codec or self.codec
+        history = not self.lobby_deltas
+        if self._encoded is None or self._encoded[0] is not codec or self._encoded[1] != history:
+            self._encoded = (codec, history, codec.encode(self.to_dict(history)))
+        return self._encoded[2]
+
+    def history_size(self):
+        return len(self.history) if self.history else 0
+
+    # страница истории, начиная с самых свежих записей
+    def history_page(self, offset=0, limit=None):
+        if not self.history:
+            return []
+
+        limit = settings.HISTORY_LIMIT if limit is None else limit
+        return [format_history(r) for r in islice(reversed(self.history), offset, offset + limit)]
 
-    def to_dict(self):
-        return {key: val for key, val in self.__dict__.items() if key != 'ws'}
+
+def format_history(record):
+    created, status, game_round, participants, winner = record
+    return f"{datetime.datetime.fromtimestamp(created)} game {status} rounds #{game_round} " \
+           f"participants: {list(participants)} winner: {winner}\n"
 
 
 class Arena:
-    def __init__(self):
-        self.players = []
-        self.current_index = 0
+    def __init__(self, storage=None, journal=None):
+        # Индексы игроков: uid -> Player (порядок вставки сохраняется)
+        # и id(ws) -> Player для поиска по сокету (только живые соединения)
+        self.by_uid = {}
+        self.sockets = {}
+        # игроки без соединения: uid -> время отключения, от старых к новым
+        self.detached = {}
+        self.matchmaker = create_matchmaker()
+        self.leaderboard = Leaderboard()
+        # Версия лобби и изменения с последней рассылки: uid -> SET | REMOVE
+        self.seq = 0
+        self.changes = {}
+        self.scheduler = BroadcastScheduler(self.broadcast)
+        self.storage = storage or MemoryStorage()
+        self.journal = journal
+        self.leaderboard.load(self.storage.rows())
+
+    # игроки (Player) в порядке создания; индекс по uid - by_uid
+    @property
+    def players(self):
+        return self.by_uid.values()
 
     def __iter__(self):
-        return self
-
-    def __next__(self):
-        self.current_index += 1
+        return iter(self.by_uid.values())
+
+    def __len__(self):
+        return len(self.by_uid)
+
+    def attach(self, player, ws, codec=None):
+        if player.ws is not None:
+            self.sockets.pop(id(player.ws), None)
+
+        player.ws = ws
+        player.codec = codec or JSON
+        player.lobby_deltas = False
+
+        if ws is not None:
+            self.sockets[id(ws)] = player
+            self.detached.pop(player.uid, None)
+            player.seen = time.monotonic()
+        elif player.uid not in self.detached:
+            self.detached[player.uid] = time.monotonic()
+
+    # Сокет закрыт: рассылки больше не идут в него, игрок уходит из пулов
+    # готовых и удаляется из арены, если не вернется (см. Reaper)
+    def detach(self, player, ws):
+        if player.ws is not ws or self.by_uid.get(player.uid) is not player:
+            return
 
-        if len(self.players) == 0 or self.current_index > len(self.players):
-            raise StopIteration
+        player.ready = False
+        self.attach(player, None)
+
+    def create_player(self, uid=None, name=None, ws=None, row=None):
+        if uid is None:
+            # короткие случайные uid могут совпасть с уже выданными: и у
+            # игроков арены, и у ушедших или игроков до рестарта, чья
+            # статистика осталась в хранилище
+            uid = Player.new_uid()
+            while not uid or uid in self.by_uid or self.storage.exists(uid):
+                uid = Player.new_uid()
+
+        player = Player(uid, name)
+        if row is not None:
+            player.restore(row)
+            self.leaderboard.update(player)
+        else:
+            self.storage.save_player(player)
 
-        return self.players[self.current_index - 1]
+        if self.journal is not None:
+            self.journal.player_joined(player)
 
-    def create_player(self, uid=None, name=None, ws=None):
-        player = Player(uid, name, ws)
-        self.players.append(player)
+        player.listener = self
+        self.by_uid[player.uid] = player
+        self.matchmaker.update(player)
+        self.changes[player.uid] = LOBBY_SET
+        self.attach(player, ws)
         return player
 
-    def get_or_create_player(self, session, ws):
-        player = [u for u in self.players if u.uid == session["id"]]
+    def get_player(self, uid):
+        return self.by_uid.get(uid)
 
-        if not len(player):
-            player = self.create_player(session["id"], session["name"], ws)
+    def get_or_create_player(self, session, ws, codec=None):
+        player = self.by_uid.get(session["id"])
+
+        if player is None:
+            # вернувшийся после рестарта игрок поднимается из хранилища
+            row = self.storage.load_player(session["id"])
+            name = row["name"] if row else session["name"]
+            player = self.create_player(session["id"], name, ws, row)
+            player.codec = codec or JSON
         else:
-            player = player[0]
-            player.ws = ws
+            self.attach(player, ws, codec)
 
         return player
 
     def remove_player(self, ws):
-        self.players = list(filter(lambda u: u.ws is not ws, self.players))
+        player = self.sockets.pop(id(ws), None)
+
+        if player is not None and self.by_uid.get(player.uid) is player:
+            self.evict(player)
+
+    # Статистика игрока уже в хранилище: при возвращении он поднимается
+    # оттуда в get_or_create_player
+    def evict(self, player):
+        del self.by_uid[player.uid]
+        self.detached.pop(player.uid, None)
+        if player.ws is not None:
+            self.sockets.pop(id(player.ws), None)
+
+        self.matchmaker.remove(player)
+        player.listener = None
+        self.changes[player.uid] = LOBBY_REMOVE
+        self.storage.player_left(player)
+        if self.journal is not None:
+            self.journal.player_left(player)
+
+    # Игроки, отключенные дольше grace секунд; удаляет их evict
+    def expired_detached(self, grace, now=None):
+        deadline = (now or time.monotonic()) - grace
+        expired = []
+
+        for uid, left in self.detached.items():
+            if left > deadline:
+                break
+            expired.append(self.by_uid[uid])
+
+        return expired
+
+    def player_changed(self, player, field, old):
+        if field == "ready":
+            self.matchmaker.update(player)
+        elif field == "game_type":
+            self.matchmaker.update(player, old)
+
+        if field in ("name", "ready"):
+            self.changes[player.uid] = LOBBY_SET
+
+        if field in ("name", "game_type") and self.journal is not None:
+            self.journal.player_changed(player)
+
+        if field == "round":
+            # рейтинг готового игрока мог перенести его в другую корзину
+            self.matchmaker.update(player)
+            self.leaderboard.update(player)
+            self.storage.add_history(player, old)
+        elif field == "name":
+            self.leaderboard.rename(player)
+        if field != "ready":
+            self.storage.save_player(player)
 
     def names(self):
         return [[u.name, u.ready] for u in self.players]
 
-    def get_rivals(self, gamer):
-        def rival(g):
-            return g is not gamer and g.ready and g.game_type == gamer.game_type
+    def lobby(self):
+        return [[u.uid, u.name, u.ready] for u in self.players]
 
-        all_rivals = list(filter(rival, self.players))
+    def snapshot(self, player):
+        return player.codec.encode({
+            "action": "queue_snapshot",
+            "result": "Done",
+            "seq": self.seq,
+            "user": player.to_dict(),
+            "queue": self.lobby()
+        })
 
-        if len(all_rivals) < gamer.game_type:
-            return None
+    def delta(self):
+        changes = []
 
-        elif len(all_rivals) == gamer.game_type:
-            for r in all_rivals:
-                r.ready = False
-            return all_rivals
+        for uid, op in self.changes.items():
+            player = self.by_uid.get(uid)
+            if op == LOBBY_SET and player is not None:
+                changes.append({"op": LOBBY_SET, "uid": uid, "name": player.name, "ready": player.ready})
+            else:
+                changes.append({"op": LOBBY_REMOVE, "uid": uid})
 
-        else:
-            rivals = [random.choice(all_rivals) for _ in range(gamer.game_type)]
-            for r in rivals:
-                r.ready = False
-            return rivals
+        self.seq += 1
+        self.changes = {}
 
-    async def broadcast(self, recipients=None, exclude=None):
-        players = recipients if recipients else self.players
+        return changes
 
-        for player in players:
-            if exclude and player in exclude:
-                continue
+    def schedule_broadcast(self):
+        self.scheduler.schedule()
 
-            await player.ws.send_json({
-                "action": "queue_updates",
-                "result": "Done",
-                "user": player.to_dict(),
-                "queue": self.names()
-            })
+    async def send_snapshot(self, player):
+        await fan_out([(player.ws, self.snapshot(player))])
+
+    def get_rivals(self, gamer):
+        with GET_RIVALS_SECONDS.time():
+            return self.matchmaker.get_rivals(gamer)
+
+    # recipients и exclude ограничивают только полные снимки для старых
+    # клиентов; дельты получают все подписчики, иначе в версиях будут дыры
+    async def broadcast(self, recipients=None, exclude=None):
+        with BROADCAST_SECONDS.time("lobby"):
+            await self.send_lobby(recipients, exclude)
+
+    async def send_lobby(self, recipients=None, exclude=None):
+        # сообщения собираются по мере отправки, а игроки могут
+        # подключиться посреди рассылки: обходим копию списка.
+        # Рассылка идет только по живым соединениям
+        subscribers = list(self.sockets.values())
+        players = recipients if recipients else subscribers
+        exclude = set(id(p) for p in exclude) if exclude else ()
+
+        changed = set(self.changes)
+        changes = self.delta() if changed else None
+        names = self.names()
+
+        # общие части сообщений сериализуются один раз для каждого кодека
+        shared = {}
+
+        def parts(codec):
+            encoded = shared.get(codec)
+            if encoded is None:
+                encoded = shared[codec] = {
+                    "queue_updates": codec.encode(QUEUE_UPDATES),
+                    "queue_delta": codec.encode(QUEUE_DELTA),
+                    "result": codec.encode("Done"),
+                    "queue": codec.encode(names),
+                    "seq": codec.encode(self.seq),
+                    "changes": codec.encode(changes),
+                }
+                encoded["delta"] = codec.join([
+                    ("action", encoded["queue_delta"]), ("result", encoded["result"]),
+                    ("seq", encoded["seq"]), ("changes", encoded["changes"]),
+                ])
+            return encoded
+
+        def snapshots():
+            for player in players:
+                if player.ws is None or player.lobby_deltas or id(player) in exclude:
+                    continue
+
+                p = parts(player.codec)
+                yield player.ws, player.codec.join([
+                    ("action", p["queue_updates"]), ("result", p["result"]),
+                    ("user", player.encode()), ("queue", p["queue"]),
+                ])
+
+        def deltas():
+            for player in subscribers:
+                if player.ws is None or not player.lobby_deltas:
+                    continue
+
+                p = parts(player.codec)
+                if player.uid in changed:
+                    yield player.ws, player.codec.join([
+                        ("action", p["queue_delta"]), ("result", p["result"]), ("seq", p["seq"]),
+                        ("changes", p["changes"]), ("user", player.encode()),
+                    ])
+                else:
+                    yield player.ws, p["delta"]
+
+        # из полных снимков в очереди соединения нужен только последний,
+        # дельты доходят все
+        await fan_out(snapshots(), latest=True)
+        if changes is not None:
+            await fan_out(deltas())
 
 
 class Games:
-    def __init__(self):
-        self.games = []
-
-    def create_game(self, user, rivals):
-        game = Game(user, rivals)
-        self.games.append(game)
+    def __init__(self, journal=None, round_timeout=None, idle_timeout=None):
+        # живые игры, индексы id -> игра и uid игрока -> игра
+        self.games = set()
+        self.ids = {}
+        self.players = {}
+        self.last_id = 0
+        self.journal = journal
+        # сроки игр: одно колесо таймеров на все игры, у игры не больше
+        # одного таймера (см. deadline)
+        self.round_timeout = settings.ROUND_TIMEOUT if round_timeout is None else round_timeout
+        self.idle_timeout = settings.GAME_IDLE_TIMEOUT if idle_timeout is None else idle_timeout
+        self.timers = TimerWheel(self.expire)
+
+    def __len__(self):
+        return len(self.games)
+
+    # game_id задается при восстановлении из журнала
+    def create_game(self, user, rivals, game_id=None):
+        if game_id is None:
+            game_id = self.last_id + 1
+        self.last_id = max(self.last_id, game_id)
+
+        game = Game(user, rivals, game_id, self.journal, self)
+        self.games.add(game)
+        self.ids[game.id] = game
+
+        for player in game.players:
+            self.players[player.uid] = game
+
+        if self.journal is not None:
+            self.journal.game_created(game)
+
+        self.schedule(game)
         return game
 
+    def get_game(self, game_id):
+        return self.ids.get(game_id)
+
     def find_game(self, gamer):
-        game = [g for g in self.games if g.user_in_game(gamer.uid)]
-        return game[0] if len(game) else None
+        return self.players.get(gamer.uid)
+
+    def remove_game(self, game):
+        self.games.discard(game)
+        self.ids.pop(game.id, None)
+        self.timers.cancel(game)
+
+        for player in game.players:
+            if self.players.get(player.uid) is game:
+                del self.players[player.uid]
 
     async def cancel_game(self, game):
-        game.status = "canceled"
+        self.close_game(game)
         await game.broadcast()
 
-        self.games.remove(game)
+    def close_game(self, game):
+        game.status = "canceled"
+        self.remove_game(game)
+
+        if self.journal is not None:
+            self.journal.game_canceled(game)
+
+    # Раунд ждет бросков round_timeout секунд от начала, завершенный
+    # раунд ждет следующего idle_timeout секунд; без срока раунда
+    # незавершенная игра тоже живет idle_timeout (0 - без срока)
+    def deadline(self, game):
+        if game.status == "finished":
+            timeout = self.idle_timeout
+        else:
+            timeout = self.round_timeout or self.idle_timeout
+        return game.changed + timeout if timeout else None
+
+    # Таймер переставляется в начале и в конце раунда, броски колесо
+    # не трогают
+    def schedule(self, game, now=None):
+        deadline = self.deadline(game)
+        if deadline is not None and self.ids.get(game.id) is game:
+            self.timers.schedule(game, deadline - (now or time.monotonic()))
+
+    def expire(self, games, now=None):
+        now = now or time.monotonic()
+        changed = []
+
+        for game in games:
+            deadline = self.deadline(game)
+            if deadline is None:
+                continue
+            if deadline > now:
+                self.schedule(game, now)
+                continue
+
+            # кто не бросил вовремя, пасует, даже если не бросил никто;
+            # простаивающую игру отменяет idle_timeout
+            if game.status != "finished" and self.round_timeout:
+                for player in game.players:
+                    if player.uid not in game.throws:
+                        game.throw(player, PASS)
+            else:
+                self.close_game(game)
+            changed.append(game)
+
+        if changed:
+            asyncio.ensure_future(self.broadcast(changed))
+
+    async def broadcast(self, games):
+        for game in games:
+            await game.broadcast()
 
 
 class Game:
-    def __init__(self, user, rivals: list):
+    __slots__ = ("id", "journal", "games", "status", "round", "winner", "throws", "players", "changed",
+                 "_encoded", "_key")
+
+    # games - список игр, который следит за сроками раундов
+    def __init__(self, user, rivals: list, game_id=None, journal=None, games=None):
+        self.id = game_id
+        self.journal = journal
+        self.games = games
         self.status = "started"
+        # начало раунда или его завершение (time.monotonic), от него
+        # отсчитываются сроки игры
+        self.changed = time.monotonic()
         self.round = 1
         self.winner = None
         self.throws = {}
         self.players = list(rivals)
         self.players.insert(0, user)
-
-    def user_in_game(self, uid):
-        return bool([g for g in self.players if g.uid == uid])
+        self._encoded = {}
+        self._key = None
 
     def stat(self):
         players = []
@@ -147,105 +566,101 @@ class Game:
             "players": players
         }
 
+    # Сообщение game_updates пересобирается только при изменении игры:
+    # статус, раунд и число бросков меняются при каждом ходе,
+    # версии игроков - при смене имени и статистики
+    def encode(self, codec=JSON):
+        key = (self.status, self.round, len(self.throws), tuple(p.version for p in self.players))
+
+        if key != self._key:
+            self._key = key
+            self._encoded = {}
+
+        encoded = self._encoded.get(codec)
+        if encoded is None:
+            encoded = self._encoded[codec] = codec.encode({
+                "action": GAME_UPDATES,
+                "result": "Done",
+                "game_stat": self.stat()
+            })
+
+        return encoded
+
     def throw(self, user, value):
+        if not self.add_throw(user.uid, value):
+            return
+
+        if self.journal is not None:
+            self.journal.throw(self, user.uid, value)
+
+        if len(self.throws) == len(self.players):
+            self.resolve()
+
+    # Бросок без подведения итогов раунда, False - повторный ход
+    def add_throw(self, uid, value):
         if self.status == "finished":
             self.reset()
         else:
             self.process()
 
         # Игнорируем второй ход одного игрока рамках одного раунда
-        if user.uid in self.throws:
-            return
-        self.throws[user.uid] = value
-
-        if len(self.throws) == len(self.players):
-            if len(self.players) == 2:
-                self.two_players()
-            elif len(self.players) == 3:
-                self.three_players()
+        if uid in self.throws:
+            return False
+        self.throws[uid] = value
+        return True
 
     def start_new_round(self):
         # Если раунд еше не завершен игнорируем команду
         if self.status == "finished":
             self.reset()
+            if self.journal is not None:
+                self.journal.new_round(self)
 
-    def two_players(self):
-        winning_throw = self.play(self.throws.values())
-        if winning_throw == TIE:
-            self.winner = TIE
-
-        for player in self.players:
-            player.games += 1
-            if self.throws[player.uid] == winning_throw:
-                self.winner = player.uid
-                player.wins += 1
-
-        self.finish()
-
-    def three_players(self):
-        winners = []
-        winning_throw = self.play(self.throws.values())
-
-        for player in self.players:
-            player.games += 1
-            if self.throws[player.uid] == winning_throw:
-                winners.append(player)
-
-        if len(winners) == 1:
-            self.winner = winners[0].uid
-            winners[0].wins += 1
-        else:
-            self.winner = TIE
+    # Исход раунда по таблице: побеждает единственный игрок
+    # с выигрышным броском, иначе ничья
+    def resolve(self):
+        codes = [CODES[self.throws[p.uid]] for p in self.players]
+        index = outcome_table(len(self.players)).resolve(codes)
 
+        self.winner = TIE if index == NO_WINNER else self.players[index].uid
         self.finish()
 
     def process(self):
         self.status = "processing"
 
-    def finish(self):
+    # created - время раунда, при проигрывании журнала берется из него
+    def finish(self, created=None):
         self.status = "finished"
-        self.log()
+        self.changed = time.monotonic()
+        if self.games is not None:
+            self.games.schedule(self)
+        created = created or time.time()
+
+        if self.journal is not None:
+            self.journal.round(self, created)
+        self.log(created)
 
     def reset(self):
         self.round += 1
         self.status = "processing"
+        self.changed = time.monotonic()
+        if self.games is not None:
+            self.games.schedule(self)
         self.throws = {}
         self.winner = None
 
-    def log(self):
-        participants = [g.name for g in self.players]
-        entry = f"{datetime.datetime.now()} game {self.status} rounds #{self.round} " \
-                f"participants: {participants} winner: {self.winner}\n"
+    def log(self, created):
+        # одна запись на раунд, общая для всех участников
+        record = (created, self.status, self.round, tuple(g.name for g in self.players), self.winner)
 
         for gamer in self.players:
-            gamer.history.append(entry)
+            gamer.record_round(record, gamer.uid == self.winner)
 
     @staticmethod
     def play(throws):
-        throws = list(set(throws))
-        if len(throws) == 1:
-            return TIE
-
-        if PASS in throws:
-            throws.remove(PASS)
-        if len(throws) == 1:
-            return throws[0]
-        if len(throws) == 3:
-            return TIE
-
-        if (throws[0] == ROCK and throws[1] == SCISSORS) \
-                or (throws[0] == SCISSORS and throws[1] == PAPER) \
-                or (throws[0] == PAPER and throws[1] == ROCK):
-            return throws[0]
-        else:
-            return throws[1]
+        winning = WINNING[mask_of(CODES[t] for t in throws)]
+        return TIE if winning is None else THROWS[winning]
 
     async def broadcast(self):
-        stat = self.stat()
-
-        for gamer in self.players:
-            await gamer.ws.send_json({
-                "action": "game_updates",
-                "result": "Done",
-                "game_stat": stat
-            })
+        with BROADCAST_SECONDS.time("game"):
+            await fan_out([(gamer.ws, self.encode(gamer.codec)) for gamer in self.players if gamer.ws is not None])
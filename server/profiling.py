@@ -0,0 +1,162 @@
+import asyncio
+import cProfile
+import functools
+import hmac
+import io
+import logging
+import os
+import pstats
+import signal
+import time
+from aiohttp import web
+import settings
+
+log = logging.getLogger('rps')
+
+# Профилирование работающего сервера на заданное время: cProfile потока
+# цикла событий, отчеты asyncio о медленных колбэках (режим отладки цикла)
+# и время обработчиков из controllers.py и views.py. Результат - файл
+# .prof для pstats/snakeviz и текстовый отчет рядом с ним.
+# Запускается запросом POST /admin/profile с токеном или сигналом SIGUSR1.
+
+
+# Собирает предупреждения asyncio "Executing ... took N seconds"
+class SlowCallbacks(logging.Handler):
+    def __init__(self):
+        super().__init__(logging.WARNING)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record.getMessage())
+
+
+class Profiler:
+    def __init__(self):
+        self.profile = None
+        # обработчик -> [вызовы, суммарное время, максимум]
+        self.timings = {}
+
+    @property
+    def running(self):
+        return self.profile is not None
+
+    def record(self, name, elapsed):
+        entry = self.timings.get(name)
+        if entry is None:
+            self.timings[name] = [1, elapsed, elapsed]
+        else:
+            entry[0] += 1
+            entry[1] += elapsed
+            if elapsed > entry[2]:
+                entry[2] = elapsed
+
+    async def run(self, duration, directory=None):
+        if self.running:
+            raise RuntimeError("profiling is already running")
+
+        loop = asyncio.get_running_loop()
+        debug, slow_duration = loop.get_debug(), loop.slow_callback_duration
+        slow = SlowCallbacks()
+        asyncio_log = logging.getLogger("asyncio")
+
+        self.timings = {}
+        self.profile = cProfile.Profile()
+        asyncio_log.addHandler(slow)
+        loop.set_debug(True)
+        loop.slow_callback_duration = settings.PROFILE_SLOW_CALLBACK
+
+        log.info("profiling started", extra={"event": "profile", "duration": duration})
+        self.profile.enable()
+        try:
+            await asyncio.sleep(duration)
+        finally:
+            self.profile.disable()
+            loop.set_debug(debug)
+            loop.slow_callback_duration = slow_duration
+            asyncio_log.removeHandler(slow)
+            profile, self.profile = self.profile, None
+
+        # запись файлов не занимает цикл событий
+        return await loop.run_in_executor(None, self.dump, profile, self.timings, slow.records,
+                                          directory or settings.PROFILE_DIR, duration)
+
+    def dump(self, profile, timings, slow, directory, duration):
+        os.makedirs(directory, exist_ok=True)
+        base = os.path.join(directory, f"profile-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}")
+        profile.dump_stats(base + ".prof")
+
+        handlers = {
+            name: {"calls": calls, "total": round(total, 6), "mean": round(total / calls, 6), "max": round(peak, 6)}
+            for name, (calls, total, peak) in sorted(timings.items(), key=lambda item: -item[1][1])
+        }
+
+        report = io.StringIO()
+        report.write(f"duration: {duration}s\n\nhandlers (calls, total, mean, max, seconds):\n")
+        for name, entry in handlers.items():
+            report.write(f"  {name}: {entry['calls']} {entry['total']} {entry['mean']} {entry['max']}\n")
+
+        report.write(f"\nslow callbacks (> {settings.PROFILE_SLOW_CALLBACK}s): {len(slow)}\n")
+        for message in slow:
+            report.write(f"  {message}\n")
+
+        report.write("\n")
+        pstats.Stats(profile, stream=report).sort_stats("cumulative").print_stats(40)
+
+        with open(base + ".txt", "w") as f:
+            f.write(report.getvalue())
+
+        return {"profile": base + ".prof", "report": base + ".txt",
+                "handlers": handlers, "slow_callbacks": len(slow)}
+
+
+PROFILER = Profiler()
+
+
+# Время обработчика записывается, только пока идет профилирование
+def timed(func):
+    name = func.__qualname__
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        if PROFILER.profile is None:
+            return await func(*args, **kwargs)
+
+        started = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            PROFILER.record(name, time.perf_counter() - started)
+
+    return wrapper
+
+
+# POST /admin/profile?duration=секунды, заголовок X-Admin-Token;
+# ответ приходит по окончании профилирования
+async def profile_handler(request):
+    token = request.headers.get("X-Admin-Token", "")
+    if not settings.ADMIN_TOKEN or not hmac.compare_digest(token, settings.ADMIN_TOKEN):
+        raise web.HTTPForbidden()
+
+    try:
+        duration = float(request.query.get("duration", settings.PROFILE_DURATION))
+    except ValueError:
+        raise web.HTTPBadRequest(text="duration must be a number")
+    if not 0 < duration <= settings.PROFILE_MAX_DURATION:
+        raise web.HTTPBadRequest(text=f"duration must be in (0, {settings.PROFILE_MAX_DURATION}]")
+
+    if PROFILER.running:
+        raise web.HTTPConflict(text="profiling is already running")
+
+    return web.json_response(await PROFILER.run(duration))
+
+
+def start_profiling(duration=None):
+    if PROFILER.running:
+        log.warning("profiling is already running")
+        return
+    asyncio.ensure_future(PROFILER.run(duration or settings.PROFILE_DURATION))
+
+
+# SIGUSR1 запускает профилирование процесса на PROFILE_DURATION секунд
+async def install_signal(app=None):
+    asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, start_profiling)
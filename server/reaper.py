@@ -0,0 +1,83 @@
+import asyncio
+import logging
+import time
+import settings
+from metrics import REGISTRY
+
+log = logging.getLogger('rps')
+
+EVICTED = REGISTRY.counter("rps_evicted_players_total", "Players removed after the reconnect grace period")
+IDLE_CLOSED = REGISTRY.counter("rps_idle_closed_total", "Connections closed for inactivity")
+
+
+# Фоновая уборка арены: раз в interval секунд удаляет игроков,
+# отключенных дольше grace, и закрывает соединения, от которых не было
+# сообщений дольше idle секунд (0 - не закрывать). Оборванные соединения
+# без закрытия находит heartbeat websocket (settings.HEARTBEAT)
+class Reaper:
+    def __init__(self, arena, games, interval=None, grace=None, idle=None):
+        self.arena = arena
+        self.games = games
+        self.interval = settings.REAPER_INTERVAL if interval is None else interval
+        self.grace = settings.EVICT_GRACE if grace is None else grace
+        self.idle = settings.IDLE_TIMEOUT if idle is None else idle
+        self.handle = None
+        self.task = None
+
+    async def start(self, app=None):
+        self.schedule()
+
+    async def stop(self, app=None):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+        if self.task is not None:
+            await self.task
+
+    def schedule(self):
+        self.handle = asyncio.get_running_loop().call_later(self.interval, self.run)
+
+    def run(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self.reap())
+        self.schedule()
+
+    async def reap(self, now=None):
+        now = now or time.monotonic()
+        closed = self.close_idle(now) if self.idle else 0
+        evicted = self.arena.expired_detached(self.grace, now)
+
+        # игры ушедших игроков, восстановленные из журнала, ждать некому.
+        # Игра закрывается до удаления игрока и без ожиданий между ними:
+        # иначе снимок журнала увидел бы удаленного игрока в живой игре
+        canceled = []
+        for player in evicted:
+            game = self.games.find_game(player)
+            if game is not None:
+                self.games.close_game(game)
+                canceled.append(game)
+            self.arena.evict(player)
+
+        await self.games.broadcast(canceled)
+
+        if evicted:
+            EVICTED.inc(len(evicted))
+            self.arena.schedule_broadcast()
+        if closed or evicted:
+            log.info("reaped", extra={"event": "reap", "idle_closed": closed, "evicted": len(evicted)})
+
+        return closed, len(evicted)
+
+    # Соединение отключается от рассылок сразу, закрывается в фоне
+    def close_idle(self, now):
+        deadline = now - self.idle
+        idle = [player for player in self.arena.sockets.values() if player.seen < deadline]
+
+        for player in idle:
+            ws = player.ws
+            self.arena.detach(player, ws)
+            asyncio.ensure_future(ws.close())
+
+        if idle:
+            IDLE_CLOSED.inc(len(idle))
+        return len(idle)
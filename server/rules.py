@@ -0,0 +1,109 @@
+from functools import lru_cache
+
+PASS = "PASS"
+ROCK = "ROCK"
+PAPER = "PAPER"
+SCISSORS = "SCISSORS"
+TIE = "TIE"
+
+# Коды бросков: 2 бита на бросок
+THROWS = (PASS, ROCK, PAPER, SCISSORS)
+CODES = {throw: code for code, throw in enumerate(THROWS)}
+BEATS = {CODES[ROCK]: CODES[SCISSORS], CODES[SCISSORS]: CODES[PAPER], CODES[PAPER]: CODES[ROCK]}
+
+# Ничья в таблицах исходов
+NO_WINNER = 255
+# Для скольких игроков раунд целиком кодируется одним ключом таблицы (4^8 записей)
+MAX_PACKED_PLAYERS = 8
+
+
+def winning_code(mask):
+    codes = [code for code in range(4) if mask & (1 << code)]
+
+    if len(codes) <= 1:
+        return None
+
+    if CODES[PASS] in codes:
+        codes.remove(CODES[PASS])
+    if len(codes) == 1:
+        return codes[0]
+    if len(codes) == 3:
+        return None
+
+    first, second = codes
+    return first if BEATS[first] == second else second
+
+
+# Выигрышный бросок по множеству бросков раунда (битовая маска кодов)
+WINNING = tuple(winning_code(mask) for mask in range(16))
+
+
+def pack(codes):
+    key = 0
+    for i, code in enumerate(codes):
+        key |= code << (2 * i)
+    return key
+
+
+def unpack(key, players):
+    return [(key >> (2 * i)) & 3 for i in range(players)]
+
+
+def mask_of(codes):
+    mask = 0
+    for code in codes:
+        mask |= 1 << code
+    return mask
+
+
+# Индекс единственного игрока с выигрышным броском, иначе NO_WINNER
+def winner_index(codes):
+    winning = WINNING[mask_of(codes)]
+    if winning is None:
+        return NO_WINNER
+
+    winners = [i for i, code in enumerate(codes) if code == winning]
+    return winners[0] if len(winners) == 1 else NO_WINNER
+
+
+class OutcomeTable:
+    def __init__(self, players):
+        self.players = players
+        self.table = None
+        self.translation = None
+
+        # для небольших игр исход раунда - одно обращение к таблице
+        if players <= MAX_PACKED_PLAYERS:
+            self.table = bytes(winner_index(unpack(key, players)) for key in range(4 ** players))
+        if players <= 4:
+            self.translation = self.table.ljust(256, bytes([NO_WINNER]))
+
+    def resolve(self, codes):
+        if self.table is not None:
+            return self.table[pack(codes)]
+        return winner_index(codes)
+
+    # packed - раунды, упакованные pack(); для игр до 4 игроков
+    # раунд занимает байт и весь массив обрабатывается bytes.translate
+    def resolve_batch(self, packed):
+        if self.table is None:
+            return bytes(winner_index(unpack(key, self.players)) for key in packed)
+
+        if self.translation is not None and isinstance(packed, (bytes, bytearray)):
+            return packed.translate(self.translation)
+
+        table = self.table
+        return bytes(table[key] for key in packed)
+
+
+@lru_cache(maxsize=None)
+def outcome_table(players):
+    return OutcomeTable(players)
+
+
+def resolve(codes):
+    return outcome_table(len(codes)).resolve(codes)
+
+
+def resolve_batch(packed, players):
+    return outcome_table(players).resolve_batch(packed)
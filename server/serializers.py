@@ -7,38 +7,138 @@ CANCEL_GAME = 'cancel_game'
 SHOW_HISTORY = 'show_history'
 CHANGE_NAME = 'change_name'
 CHANGE_TYPE = 'change_type'
+RESYNC = 'resync'
+SHOW_LEADERBOARD = 'show_leaderboard'
+BATCH = 'batch'
 QUEUE_UPDATES = 'queue_updates'
+QUEUE_SNAPSHOT = 'queue_snapshot'
+QUEUE_DELTA = 'queue_delta'
+HISTORY_UPDATES = 'history_updates'
+LEADERBOARD_UPDATES = 'leaderboard_updates'
+BATCH_RESULTS = 'batch_results'
 GAME_UPDATES = 'game_updates'
 PASS = "PASS"
 ROCK = "ROCK"
 PAPER = "PAPER"
 SCISSORS = "SCISSORS"
 TIE = "TIE"
+LOBBY_SET = "set"
+LOBBY_REMOVE = "remove"
 
 
-def serialize_request(method):
-    async def wrapper(self, *args, **kwargs):
-        assert isinstance(self.message, dict), "Request is not serializable"
-        assert "action" in self.message, "Field 'action' is absent"
-        assert self.message["action"] in [THROW, MARK_AS_READY, START_NEW_ROUND, CANCEL_GAME,
-                                          SHOW_HISTORY, CHANGE_NAME, CHANGE_TYPE], "Unknown action"
+# Коды ошибок запроса
+BAD_REQUEST = 'bad_request'
+NOT_SERIALIZABLE = 'not_serializable'
+NOT_AN_OBJECT = 'not_an_object'
+MISSING_ACTION = 'missing_action'
+UNKNOWN_ACTION = 'unknown_action'
+MISSING_DATA = 'missing_data'
+INVALID_DATA = 'invalid_data'
 
-        if self.message["action"] == THROW:
-            assert "data" in self.message, "Field 'data' is absent in throw action"
-            assert self.message["data"] in [PASS, ROCK, PAPER, SCISSORS], "Unsupported throw"
+MAX_NAME_LENGTH = 20
+MAX_BATCH_SIZE = 32
+THROWS = frozenset([PASS, ROCK, PAPER, SCISSORS])
+GAME_TYPES = frozenset([1, 2])
 
-        if self.message["action"] == CHANGE_NAME:
-            assert "data" in self.message, "Field 'data' is absent in change_name action"
-            assert isinstance(self.message["data"], str), "Name must be string"
-            assert len(self.message["data"]) < 20, "Name must be less then 20 characters"
 
-        if self.message["action"] == CHANGE_TYPE:
-            assert "data" in self.message, "Field 'data' is absent in change_type action"
-            assert self.message["data"] in [1, 2], "Wrong game type value"
+class RequestError(Exception):
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+        self.message = message
 
-        return await method(self, *args, **kwargs)
 
-    return wrapper
+def is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def require_data(message):
+    if "data" not in message:
+        raise RequestError(MISSING_DATA, f"Field 'data' is absent in {message['action']} action")
+    return message["data"]
+
+
+def no_data(message):
+    pass
+
+
+def validate_throw(message):
+    data = require_data(message)
+    if not isinstance(data, str) or data not in THROWS:
+        raise RequestError(INVALID_DATA, "Unsupported throw")
+
+
+def validate_change_name(message):
+    data = require_data(message)
+    if not isinstance(data, str):
+        raise RequestError(INVALID_DATA, "Name must be string")
+    if len(data) >= MAX_NAME_LENGTH:
+        raise RequestError(INVALID_DATA, "Name must be less then 20 characters")
+
+
+def validate_change_type(message):
+    data = require_data(message)
+    if not is_int(data) or data not in GAME_TYPES:
+        raise RequestError(INVALID_DATA, "Wrong game type value")
+
+
+# Страница: необязательный объект {"offset": n, "limit": n}
+def validate_page(message):
+    page = message.get("data")
+    if page is None:
+        return
+
+    if not isinstance(page, dict):
+        raise RequestError(INVALID_DATA, f"Field 'data' must be object in {message['action']} action")
+
+    for field in ("offset", "limit"):
+        if field in page and not (is_int(page[field]) and page[field] >= 0):
+            raise RequestError(INVALID_DATA, f"Field '{field}' must be non-negative integer")
+
+
+# Действия пакета проверяются по одному при выполнении
+def validate_batch(message):
+    data = require_data(message)
+    if not isinstance(data, list) or not data:
+        raise RequestError(INVALID_DATA, "Field 'data' must be non-empty list in batch action")
+    if len(data) > MAX_BATCH_SIZE:
+        raise RequestError(INVALID_DATA, f"Batch must contain at most {MAX_BATCH_SIZE} actions")
+    if any(isinstance(item, dict) and item.get("action") == BATCH for item in data):
+        raise RequestError(INVALID_DATA, "Nested batches are not supported")
+
+
+# Схема запросов: action -> проверка полей, собирается один раз при импорте
+REQUEST_SCHEMA = {
+    THROW: validate_throw,
+    MARK_AS_READY: no_data,
+    START_NEW_ROUND: no_data,
+    CANCEL_GAME: no_data,
+    SHOW_HISTORY: validate_page,
+    CHANGE_NAME: validate_change_name,
+    CHANGE_TYPE: validate_change_type,
+    RESYNC: no_data,
+    SHOW_LEADERBOARD: validate_page,
+    BATCH: validate_batch,
+}
+
+
+# Проверки бросают RequestError и от assert не зависят
+def request_action(message):
+    if not isinstance(message, dict):
+        raise RequestError(NOT_AN_OBJECT, "Request is not serializable")
+
+    action = message.get("action")
+    if action is None:
+        raise RequestError(MISSING_ACTION, "Field 'action' is absent")
+    if not isinstance(action, str):
+        raise RequestError(UNKNOWN_ACTION, "Unknown action")
+
+    # поля передаются обработчику именованными аргументами
+    for key in message:
+        if not isinstance(key, str) or key == "self":
+            raise RequestError(BAD_REQUEST, "Unsupported field")
+
+    return action
 
 
 # для тестов
@@ -48,27 +148,83 @@ def serialize_response(response):
     assert isinstance(response, dict), "Response is not serializable"
     assert "action" in response, "Field 'action' is absent"
     assert "result" in response, "Field 'result' is absent"
-    assert response["action"] in [QUEUE_UPDATES, GAME_UPDATES], "Unknown action"
+    assert response["action"] in [QUEUE_UPDATES, QUEUE_SNAPSHOT, QUEUE_DELTA, GAME_UPDATES,
+                                  HISTORY_UPDATES, LEADERBOARD_UPDATES, BATCH_RESULTS], "Unknown action"
 
-    if response["action"] == "queue_updates":
+    if response["action"] in [QUEUE_UPDATES, QUEUE_SNAPSHOT]:
         assert "user" in response, "No user data in response"
-        assert isinstance(response["user"], dict), "Response is not serializable"
         assert "queue" in response, "No users list in response"
         assert isinstance(response["queue"], list), "Response is not serializable"
+        serialize_user(response["user"])
 
-        assert "uid" in response["user"], "Wrong user data"
-        assert "name" in response["user"], "Wrong user data"
-        assert "wins" in response["user"], "Wrong user data"
-        assert "games" in response["user"], "Wrong user data"
-        assert "game_type" in response["user"], "Wrong user data"
-        assert "history" in response["user"], "Wrong user data"
-
-        assert isinstance(response["user"]["history"], list), "Response is not serializable"
-
-        for entry in response["user"]["history"]:
-            assert isinstance(entry, str), "Response is not serializable"
-
+    if response["action"] == QUEUE_UPDATES:
         for gamers in response["queue"]:
             assert isinstance(gamers, list), "Response is not serializable"
             assert isinstance(gamers[0], str), "Response is not serializable"
             assert isinstance(gamers[1], bool), "Response is not serializable"
+
+    if response["action"] == QUEUE_SNAPSHOT:
+        assert isinstance(response.get("seq"), int), "No lobby version in response"
+
+        for gamers in response["queue"]:
+            assert isinstance(gamers, list), "Response is not serializable"
+            assert isinstance(gamers[0], int), "Response is not serializable"
+            assert isinstance(gamers[1], str), "Response is not serializable"
+            assert isinstance(gamers[2], bool), "Response is not serializable"
+
+    if response["action"] == QUEUE_DELTA:
+        assert isinstance(response.get("seq"), int), "No lobby version in response"
+        assert isinstance(response.get("changes"), list), "No changes in response"
+
+        if "user" in response:
+            serialize_user(response["user"])
+
+        for change in response["changes"]:
+            assert isinstance(change, dict), "Response is not serializable"
+            assert change.get("op") in [LOBBY_SET, LOBBY_REMOVE], "Unknown lobby operation"
+            assert isinstance(change.get("uid"), int), "Wrong user data"
+
+            if change["op"] == LOBBY_SET:
+                assert isinstance(change.get("name"), str), "Wrong user data"
+                assert isinstance(change.get("ready"), bool), "Wrong user data"
+
+    if response["action"] == GAME_UPDATES:
+        assert "game_stat" in response, "No game data in response"
+        assert isinstance(response["game_stat"], dict), "Response is not serializable"
+
+    if response["action"] == HISTORY_UPDATES:
+        assert isinstance(response.get("total"), int), "No history size in response"
+        assert isinstance(response.get("offset"), int), "No history offset in response"
+        assert isinstance(response.get("history"), list), "No history in response"
+
+        for entry in response["history"]:
+            assert isinstance(entry, str), "Response is not serializable"
+
+    if response["action"] == LEADERBOARD_UPDATES:
+        assert isinstance(response.get("total"), int), "No leaderboard size in response"
+        assert isinstance(response.get("leaders"), list), "No leaders in response"
+        assert response.get("rank") is None or isinstance(response["rank"], int), "Wrong rank in response"
+
+        for entry in response["leaders"]:
+            assert isinstance(entry, dict), "Response is not serializable"
+            for field in ("rank", "uid", "wins", "games"):
+                assert isinstance(entry.get(field), int), "Wrong leaderboard entry"
+            assert isinstance(entry.get("name"), str), "Wrong leaderboard entry"
+
+    if response["action"] == BATCH_RESULTS:
+        assert isinstance(response.get("results"), list), "No results in response"
+
+        for result in response["results"]:
+            assert isinstance(result, dict), "Response is not serializable"
+            assert result.get("result") in ["Done", "Fail"], "Wrong action result"
+            if result["result"] == "Fail":
+                assert "code" in result, "No error code in action result"
+
+
+def serialize_user(user):
+    assert isinstance(user, dict), "Response is not serializable"
+    assert "uid" in user, "Wrong user data"
+    assert "name" in user, "Wrong user data"
+    assert "wins" in user, "Wrong user data"
+    assert "games" in user, "Wrong user data"
+    assert "game_type" in user, "Wrong user data"
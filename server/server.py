@@ -1,31 +1,84 @@
+import argparse
+import settings
 from aiohttp import web
 from jinja2 import FileSystemLoader
 from aiohttp_jinja2 import setup as template_setup
 from aiohttp_session import SimpleCookieStorage, setup as session_setup
-from models import Arena, Games
-from views import MainWSView, init_handler
+from cluster import run_cluster
+from journal import close_state, create_state
+from logs import setup_logging
+from matchmaking import BatchMatcher
+from metrics import metrics_handler, register_state
+from profiling import install_signal, profile_handler
+from reaper import Reaper
+from views import MainWSView, ProxyWSView, init_handler
 
 
-# В качестве сервера простой websocket на базе aiohttp
-app = web.Application()
+# В качестве сервера простой websocket на базе aiohttp.
+# link - соединение с брокером, если процесс - воркер кластера
+def create_app(link=None):
+    app = web.Application()
 
-# подключаем куки сессии (без шифрования) и шаблонизатор
-session_setup(app, SimpleCookieStorage(cookie_name="AIOHTTP_SESSION"))
-template_setup(app, loader=FileSystemLoader('static/'))
+    # подключаем куки сессии (без шифрования) и шаблонизатор
+    session_setup(app, SimpleCookieStorage(cookie_name="AIOHTTP_SESSION"))
+    template_setup(app, loader=FileSystemLoader('static/'))
 
-# Вместо базы данных будем использовать
-# 2-а больших кеширующих объекта, в
-# первом хранятся данные всех игроков,
-# во втором данные по всем текущим играм.
-setattr(app, 'arena', Arena())
-setattr(app, 'games', Games())
+    if link is None:
+        # Вместо базы данных будем использовать
+        # 2-а больших кеширующих объекта, в
+        # первом хранятся данные всех игроков,
+        # во втором данные по всем текущим играм.
+        arena, games = create_state()
+        setattr(app, 'arena', arena)
+        setattr(app, 'games', games)
+        register_state(arena, games)
+        reaper = Reaper(arena, games)
+        app.on_startup.append(reaper.start)
+        app.on_cleanup.append(reaper.stop)
+        app.on_startup.append(games.timers.start)
+        app.on_cleanup.append(games.timers.stop)
+        matcher = BatchMatcher(arena, games)
+        app.on_startup.append(matcher.start)
+        app.on_cleanup.append(matcher.stop)
+        app.on_cleanup.append(close_storage)
+        ws_view = MainWSView
+    else:
+        # в кластере состояние хранит брокер
+        setattr(app, 'link', link)
+        app.on_startup.append(link.start)
+        app.on_cleanup.append(link.stop)
+        ws_view = ProxyWSView
 
-# первый маршрут загружает index и js + создает сессии
-# второй обрабатывает websocket сообщения
-app.add_routes([
-    web.get('/', init_handler, name='index'),
-    web.get('/ws', MainWSView, name='ws'),
-    web.static('/static', 'static')
-])
+    # первый маршрут загружает index и js + создает сессии
+    # второй обрабатывает websocket сообщения, третий отдает метрики
+    app.add_routes([
+        web.get('/', init_handler, name='index'),
+        web.get('/ws', ws_view, name='ws'),
+        web.get('/metrics', metrics_handler, name='metrics'),
+        web.static('/static', 'static')
+    ])
 
-web.run_app(app, port=3560)
+    # профилирование по запросу администратора или по SIGUSR1
+    if settings.ADMIN_TOKEN:
+        app.add_routes([web.post('/admin/profile', profile_handler, name='profile')])
+    app.on_startup.append(install_signal)
+
+    return app
+
+
+async def close_storage(app):
+    await close_state(app.arena)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=settings.PORT)
+    parser.add_argument('--workers', type=int, default=settings.WORKERS)
+    parser.add_argument('--broker-socket', default=settings.BROKER_SOCKET)
+    args = parser.parse_args()
+
+    if args.workers > 1:
+        run_cluster(create_app, args.workers, args.port, args.broker_socket)
+    else:
+        setup_logging()
+        web.run_app(create_app(), port=args.port)
@@ -0,0 +1,84 @@
+import os
+
+
+def env(name, default, cast=str):
+    value = os.environ.get(f"RPS_{name}")
+    return default if value is None else cast(value)
+
+
+# Окно склейки рассылок лобби и максимальная задержка рассылки, секунды
+BROADCAST_WINDOW = env("BROADCAST_WINDOW", 0.05, float)
+BROADCAST_MAX_DELAY = env("BROADCAST_MAX_DELAY", 0.2, float)
+# Сообщений в очереди соединения, после которых медленный клиент отключается
+OUTBOX_LIMIT = env("OUTBOX_LIMIT", 256, int)
+
+# Период ping websocket, секунды: соединение без pong закрывается
+HEARTBEAT = env("HEARTBEAT", 30.0, float)
+# Закрывать соединения без сообщений дольше IDLE_TIMEOUT секунд (0 - нет),
+# удалять из арены игроков, не вернувшихся за EVICT_GRACE секунд;
+# уборка раз в REAPER_INTERVAL секунд
+IDLE_TIMEOUT = env("IDLE_TIMEOUT", 0.0, float)
+EVICT_GRACE = env("EVICT_GRACE", 300.0, float)
+REAPER_INTERVAL = env("REAPER_INTERVAL", 5.0, float)
+
+# Срок броска в раунде и простоя завершенного раунда, секунды (0 - нет),
+# и шаг колеса таймеров, секунды
+ROUND_TIMEOUT = env("ROUND_TIMEOUT", 30.0, float)
+GAME_IDLE_TIMEOUT = env("GAME_IDLE_TIMEOUT", 300.0, float)
+TIMER_RESOLUTION = env("TIMER_RESOLUTION", 0.25, float)
+
+# Сколько последних раундов хранится в истории игрока
+HISTORY_LIMIT = env("HISTORY_LIMIT", 100, int)
+
+# Рейтинг: wins или win_rate (доля побед у сыгравших не меньше
+# LEADERBOARD_MIN_GAMES игр) и наибольший размер страницы
+LEADERBOARD_SCORE = env("LEADERBOARD_SCORE", "wins")
+LEADERBOARD_MIN_GAMES = env("LEADERBOARD_MIN_GAMES", 10, int)
+LEADERBOARD_LIMIT = env("LEADERBOARD_LIMIT", 100, int)
+
+# Подбор соперников: random - случайные готовые игроки того же типа игры,
+# skill - пакетный подбор по рейтингу (0..1000) раз в MATCH_INTERVAL
+# секунд. Окно рейтинга игрока - MATCH_GAP плюс MATCH_GAP_PER_SECOND за
+# секунду ожидания, не больше MATCH_MAX_GAP; ширина корзины MATCH_BUCKET
+MATCHMAKER = env("MATCHMAKER", "random")
+MATCH_INTERVAL = env("MATCH_INTERVAL", 1.0, float)
+MATCH_GAP = env("MATCH_GAP", 25.0, float)
+MATCH_GAP_PER_SECOND = env("MATCH_GAP_PER_SECOND", 10.0, float)
+MATCH_MAX_GAP = env("MATCH_MAX_GAP", 1000.0, float)
+MATCH_BUCKET = env("MATCH_BUCKET", 25, int)
+
+# Порт, число процессов-воркеров и unix-сокет брокера для режима кластера
+PORT = env("PORT", 3560, int)
+WORKERS = env("WORKERS", 1, int)
+BROKER_SOCKET = env("BROKER_SOCKET", "/tmp/rps-broker.sock")
+# Порт /metrics брокера в режиме кластера (0 - выключено)
+BROKER_METRICS_PORT = env("BROKER_METRICS_PORT", 3561, int)
+
+# Хранилище игроков: memory или sqlite, файл базы и период записи, секунды
+STORAGE = env("STORAGE", "memory")
+STORAGE_PATH = env("STORAGE_PATH", "rps.sqlite3")
+STORAGE_FLUSH_INTERVAL = env("STORAGE_FLUSH_INTERVAL", 1.0, float)
+
+# Каталог журнала событий (пусто - журнал выключен), периоды снимков
+# состояния и сброса журнала на диск, секунды, и шаг роста файла
+# журнала, байты
+JOURNAL = env("JOURNAL", "")
+JOURNAL_SNAPSHOT_INTERVAL = env("JOURNAL_SNAPSHOT_INTERVAL", 300.0, float)
+JOURNAL_FLUSH_INTERVAL = env("JOURNAL_FLUSH_INTERVAL", 1.0, float)
+JOURNAL_CHUNK = env("JOURNAL_CHUNK", 4 * 1024 * 1024, int)
+
+# Каталог логов и файл лога в нем (в кластере с суффиксом процесса),
+# уровень и доля записываемых частых событий: "событие=доля,..."
+LOG_DIR = env("LOG_DIR", "logs")
+LOG_FILE = env("LOG_FILE", "rps.log")
+LOG_LEVEL = env("LOG_LEVEL", "INFO")
+LOG_SAMPLING = env("LOG_SAMPLING", "throw=0.01")
+
+# Профилирование: токен /admin/profile (пусто - маршрут выключен),
+# каталог отчетов, длительность по умолчанию и максимум, секунды, и порог
+# медленного колбэка цикла событий, секунды
+ADMIN_TOKEN = env("ADMIN_TOKEN", "")
+PROFILE_DIR = env("PROFILE_DIR", "profiles")
+PROFILE_DURATION = env("PROFILE_DURATION", 30.0, float)
+PROFILE_MAX_DURATION = env("PROFILE_MAX_DURATION", 300.0, float)
+PROFILE_SLOW_CALLBACK = env("PROFILE_SLOW_CALLBACK", 0.05, float)
@@ -0,0 +1,220 @@
+import asyncio
+import json
+import logging
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+import settings
+
+log = logging.getLogger('rps')
+
+
+# Хранилище игроков: статистика, настройки и история раундов.
+# Строка игрока - словарь с uid, name, wins, games, game_type и
+# history (записи раундов от старых к новым, как в Player.history)
+class Storage:
+    def load_player(self, uid):
+        raise NotImplementedError
+
+    # uid уже выдан: у игрока есть сохраненная строка
+    def exists(self, uid):
+        raise NotImplementedError
+
+    def save_player(self, player):
+        raise NotImplementedError
+
+    def add_history(self, player, record):
+        raise NotImplementedError
+
+    # игрок удален из арены (см. Arena.evict)
+    def player_left(self, player):
+        pass
+
+    # (uid, name, wins, games) сохраненных игроков для рейтинга
+    def rows(self):
+        return ()
+
+    async def flush(self):
+        pass
+
+    async def close(self):
+        await self.flush()
+
+
+# Статистика живых игроков есть в самих Player, поэтому строка
+# сохраняется только при уходе игрока из арены
+class MemoryStorage(Storage):
+    def __init__(self):
+        self.players = {}
+
+    def load_player(self, uid):
+        row = self.players.get(uid)
+        return dict(row, history=list(row["history"])) if row else None
+
+    def exists(self, uid):
+        return uid in self.players
+
+    def save_player(self, player):
+        pass
+
+    def add_history(self, player, record):
+        pass
+
+    def rows(self):
+        return [(row["uid"], row["name"], row["wins"], row["games"]) for row in self.players.values()]
+
+    def player_left(self, player):
+        self.players[player.uid] = {
+            "uid": player.uid, "name": player.name, "wins": player.wins, "games": player.games,
+            "game_type": player.game_type, "history": list(player.history) if player.history else [],
+        }
+
+
+# SQLite с отложенной записью: изменения копятся в памяти цикла событий
+# и раз в interval секунд одной транзакцией пишутся в отдельном потоке.
+# Чтение идет своим соединением (WAL) и нужно только при первом
+# подключении игрока после рестарта
+class SQLiteStorage(Storage):
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS players (
+            uid INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            wins INTEGER NOT NULL,
+            games INTEGER NOT NULL,
+            game_type INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            uid INTEGER NOT NULL,
+            created REAL NOT NULL,
+            status TEXT NOT NULL,
+            round INTEGER NOT NULL,
+            participants TEXT NOT NULL,
+            winner TEXT
+        );
+        CREATE INDEX IF NOT EXISTS history_uid ON history (uid, id);
+    """
+
+    def __init__(self, path, interval=None):
+        self.path = path
+        self.interval = settings.STORAGE_FLUSH_INTERVAL if interval is None else interval
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="rps-storage")
+        self.writer = None
+        self.dirty = {}
+        self.history = []
+        self.handle = None
+        self.flushing = None
+
+        self.reader = sqlite3.connect(path)
+        self.reader.execute("PRAGMA journal_mode=WAL")
+        self.reader.executescript(self.SCHEMA)
+
+    def load_player(self, uid):
+        row = self.reader.execute("SELECT uid, name, wins, games, game_type FROM players WHERE uid = ?",
+                                  (uid,)).fetchone()
+        if row is None:
+            return None
+
+        history = self.reader.execute(
+            "SELECT created, status, round, participants, winner FROM history "
+            "WHERE uid = ? ORDER BY id DESC LIMIT ?", (uid, settings.HISTORY_LIMIT)).fetchall()
+
+        return {
+            "uid": row[0], "name": row[1], "wins": row[2], "games": row[3], "game_type": row[4],
+            "history": [(h[0], h[1], h[2], tuple(json.loads(h[3])), json.loads(h[4])) for h in reversed(history)],
+        }
+
+    # игроки без игр в рейтинг не попадают
+    def rows(self):
+        return self.reader.execute("SELECT uid, name, wins, games FROM players WHERE games > 0")
+
+    # новые игроки до записи лежат в dirty
+    def exists(self, uid):
+        if uid in self.dirty:
+            return True
+        return self.reader.execute("SELECT 1 FROM players WHERE uid = ?", (uid,)).fetchone() is not None
+
+    def save_player(self, player):
+        self.dirty[player.uid] = player
+        self.schedule()
+
+    def add_history(self, player, record):
+        self.history.append((player.uid, record))
+        self.schedule()
+
+    def schedule(self):
+        if self.handle is not None:
+            return
+
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+
+        self.handle = loop.call_later(self.interval, self.start_flush)
+
+    def start_flush(self):
+        self.handle = None
+        asyncio.ensure_future(self.flush())
+
+    # снимок изменений делается в цикле событий, запись - в потоке
+    async def flush(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+
+        # записи не перекрываются, чтобы сохранить порядок изменений
+        while self.flushing is not None:
+            await self.flushing
+
+        if not self.dirty and not self.history:
+            return
+
+        players = [(p.uid, p.name, p.wins, p.games, p.game_type) for p in self.dirty.values()]
+        history = [(uid, created, status, game_round, json.dumps(list(participants)), json.dumps(winner))
+                   for uid, (created, status, game_round, participants, winner) in self.history]
+        self.dirty, self.history = {}, []
+
+        loop = asyncio.get_running_loop()
+        self.flushing = loop.run_in_executor(self.executor, self.write, players, history)
+        try:
+            await self.flushing
+        except Exception:
+            log.exception("storage flush failed")
+        finally:
+            self.flushing = None
+
+    def write(self, players, history):
+        if self.writer is None:
+            self.writer = sqlite3.connect(self.path)
+
+        with self.writer:
+            self.writer.executemany(
+                "INSERT INTO players (uid, name, wins, games, game_type) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (uid) DO UPDATE SET name = excluded.name, wins = excluded.wins, "
+                "games = excluded.games, game_type = excluded.game_type", players)
+            self.writer.executemany(
+                "INSERT INTO history (uid, created, status, round, participants, winner) "
+                "VALUES (?, ?, ?, ?, ?, ?)", history)
+
+            # на диске, как и в памяти, хранятся только последние раунды
+            self.writer.executemany(
+                "DELETE FROM history WHERE uid = ? AND id <= ("
+                "SELECT id FROM history WHERE uid = ? ORDER BY id DESC LIMIT 1 OFFSET ?)",
+                [(uid, uid, settings.HISTORY_LIMIT) for uid in set(h[0] for h in history)])
+
+    async def close(self):
+        await self.flush()
+        await asyncio.get_running_loop().run_in_executor(self.executor, self.close_writer)
+        self.executor.shutdown()
+        self.reader.close()
+
+    def close_writer(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+def create_storage():
+    if settings.STORAGE == "sqlite":
+        return SQLiteStorage(settings.STORAGE_PATH)
+    return MemoryStorage()
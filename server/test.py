@@ -1,7 +1,29 @@
 import asyncio
+import json
+import logging
+import os
+import pstats
+import random
+import tempfile
+import time
 import unittest
+from unittest.mock import patch
 from serializers import *
 from models import *
+from broadcast import BroadcastScheduler, Outbox
+import codec
+import metrics
+import profiling
+import rules
+from aiohttp import WSMessage, WSMsgType
+from cluster import HEADER, REQUEST, Broker, BrokerLink, read_frames
+from controllers import ActionsController, WSException
+from journal import Journal
+from leaderboard import Leaderboard
+from matchmaking import BatchMatcher, SkillMatchmaker, rating
+from logs import JsonFormatter, log_context, log_path, setup_logging, stop_logging
+from reaper import Reaper
+from timers import TimerWheel
 
 
 class GameTest(unittest.TestCase):
@@ -105,6 +127,68 @@ class GameTest(unittest.TestCase):
         self.assertEqual(self.player_3.wins, 0)
         self.assertEqual(game.round, 7)
 
+    def test_many_gamers(self):
+        players = [self.player_1, self.player_2, self.player_3, Player(), Player()]
+        game = Game(players[0], players[1:])
+
+        for player, throw in zip(players, [ROCK, SCISSORS, PASS, SCISSORS, PASS]):
+            game.throw(player, throw)
+        self.assertEqual(game.winner, self.player_1.uid)
+
+        for player, throw in zip(players, [ROCK, PAPER, PAPER, PASS, ROCK]):
+            game.throw(player, throw)
+        self.assertEqual(game.winner, TIE)
+
+        self.assertEqual([p.games for p in players], [2] * 5)
+        self.assertEqual(self.player_1.wins, 1)
+
+    def test_history(self):
+        game = Game(self.player_1, [self.player_2])
+
+        with patch('settings.HISTORY_LIMIT', 5):
+            for _ in range(12):
+                game.throw(self.player_1, ROCK)
+                game.throw(self.player_2, PAPER)
+
+            # хранятся только последние раунды, свежие первыми
+            self.assertEqual(len(self.player_1.history), 5)
+            page = self.player_1.history_page(1, 2)
+
+        self.assertEqual(len(page), 2)
+        self.assertIn("rounds #11 ", page[0])
+        self.assertIn("rounds #10 ", page[1])
+        self.assertIn(f"winner: {self.player_2.uid}", page[0])
+        self.assertNotIn("history", self.player_1.to_dict())
+        self.assertEqual(self.player_2.history_size(), 5)
+        self.assertEqual(self.player_3.history_page(), [])
+
+
+class RulesTest(unittest.TestCase):
+    def test_play(self):
+        self.assertEqual(Game.play([ROCK, SCISSORS]), ROCK)
+        self.assertEqual(Game.play([PAPER, ROCK, PASS]), PAPER)
+        self.assertEqual(Game.play([PASS, PASS]), TIE)
+        self.assertEqual(Game.play([SCISSORS, PAPER, ROCK]), TIE)
+        self.assertEqual(Game.play([PASS, SCISSORS]), SCISSORS)
+
+    def test_batch(self):
+        rounds = [
+            [ROCK, SCISSORS, PASS],
+            [PAPER, PAPER, ROCK],
+            [PASS, PASS, SCISSORS],
+            [ROCK, PAPER, SCISSORS],
+        ]
+        packed = bytes(rules.pack([rules.CODES[t] for t in r]) for r in rounds)
+        expected = bytes([0, rules.NO_WINNER, 2, rules.NO_WINNER])
+
+        self.assertEqual(rules.resolve_batch(packed, 3), expected)
+        self.assertEqual(rules.resolve_batch(list(packed), 3), expected)
+
+        # большие игры считаются без таблицы
+        codes = [rules.CODES[PASS]] * 11 + [rules.CODES[ROCK]]
+        self.assertEqual(rules.resolve(codes), 11)
+        self.assertEqual(rules.resolve_batch([rules.pack(codes)], 12), bytes([11]))
+
 
 class ArenaTest(unittest.TestCase):
     def setUp(self):
@@ -126,6 +210,8 @@ class ArenaTest(unittest.TestCase):
         # проверяем список пользователей
         self.arena.create_player(name="test_2", uid=2)
         self.assertEqual(self.arena.names(), [["test_1", False], ["test_2", False]])
+        self.assertEqual([p.uid for p in self.arena.players], [1, 2])
+        self.assertIs(self.arena.by_uid[2], self.arena.get_player(2))
 
         # создаем еще 100 игроков, все готовы к игре
         for i in range(3, 100):
@@ -153,19 +239,147 @@ class ArenaTest(unittest.TestCase):
 
         self.assertEqual(len(self.arena.get_rivals(player_1)), 2)
 
+    def test_storage(self):
+        from storage import SQLiteStorage
+        path = os.path.join(tempfile.mkdtemp(), "rps.sqlite3")
+
+        async def play():
+            arena = Arena(SQLiteStorage(path, interval=60))
+            player_1 = arena.create_player(1, "test_1")
+            player_2 = arena.create_player(2, "test_2")
+            player_1.game_type = 2
+
+            game = Game(player_1, [player_2])
+            for _ in range(3):
+                game.throw(player_1, ROCK)
+                game.throw(player_2, SCISSORS)
+
+            await arena.storage.close()
+
+        async def restore():
+            arena = Arena(SQLiteStorage(path))
+            # рейтинг поднимается из базы до подключения игроков
+            leaders = arena.leaderboard.page()
+            player = arena.get_or_create_player({"id": 1, "name": "other"}, None)
+            await arena.storage.close()
+            return player, leaders
+
+        asyncio.run(play())
+        player, leaders = asyncio.run(restore())
+        self.assertEqual([(row["uid"], row["wins"]) for row in leaders], [(1, 3), (2, 0)])
+
+        # после рестарта игрок поднимается из базы со статистикой и историей
+        self.assertEqual(player.name, "test_1")
+        self.assertEqual((player.wins, player.games, player.game_type), (3, 3, 2))
+        self.assertEqual(player.history_size(), 3)
+        self.assertIn("winner: 1", player.history_page(0, 1)[0])
+
+    def test_new_uid(self):
+        self.arena.create_player(1, "test_1")
+
+        # случайный uid, совпавший с uid игрока арены, выбирается заново
+        with patch.object(Player, "new_uid", side_effect=[1, 2]):
+            player = self.arena.create_player()
+        self.assertEqual(player.uid, 2)
+        self.assertEqual(self.arena.get_player(1).name, "test_1")
+
+    def test_uid_from_storage(self):
+        player = self.arena.create_player(1, "test_1")
+        player.record_round((time.time(), "finished", 1, ("test_1", "test_2"), 1), True)
+        self.arena.evict(player)
+
+        # uid ушедшего игрока занят его строкой в хранилище
+        with patch.object(Player, "new_uid", side_effect=[1, 2]):
+            newcomer = self.arena.create_player()
+        self.assertEqual(newcomer.uid, 2)
+
+        player = self.arena.get_or_create_player({"id": 1, "name": "other"}, None)
+        self.assertEqual((player.name, player.wins, player.history_size()), ("test_1", 1, 1))
+
+    def test_socket_index(self):
+        ws_1, ws_2 = FakeWS(), FakeWS()
+        player_1 = self.arena.get_or_create_player({"id": 1, "name": "test_1"}, ws_1)
+        player_2 = self.arena.get_or_create_player({"id": 2, "name": "test_2"}, ws_2)
+
+        # переподключение заменяет сокет в индексе
+        ws_3 = FakeWS()
+        self.assertIs(self.arena.get_or_create_player({"id": 1, "name": "test_1"}, ws_3), player_1)
+        self.assertNotIn(id(ws_1), self.arena.sockets)
+
+        # удаление по старому сокету ничего не меняет
+        self.arena.remove_player(ws_1)
+        self.assertEqual(len(self.arena), 2)
+
+        self.arena.remove_player(ws_3)
+        self.assertIsNone(self.arena.get_player(1))
+        self.assertIs(self.arena.get_player(2), player_2)
+        self.assertEqual(self.arena.names(), [["test_2", False]])
+
+    def test_ready_pools(self):
+        gamer = self.arena.create_player(name="test_1", uid=1)
+        gamer.game_type = 2
+
+        for i in range(2, 5):
+            p = self.arena.create_player(name=f"test_{i}", uid=i)
+            p.ready = True
+
+        # готовые игроки другого типа игры не подходят
+        self.assertIsNone(self.arena.get_rivals(gamer))
+        self.assertEqual(self.arena.matchmaker.ready_count(1), 3)
+
+        for uid in (2, 3, 4):
+            self.arena.get_player(uid).game_type = 2
+
+        self.assertEqual(self.arena.matchmaker.ready_count(1), 0)
+        self.assertEqual(self.arena.matchmaker.ready_count(2), 3)
+
+        # соперники не повторяются и снимаются с очереди
+        rivals = self.arena.get_rivals(gamer)
+        self.assertEqual(len(set(r.uid for r in rivals)), 2)
+        self.assertNotIn(gamer, rivals)
+        self.assertTrue(all(not r.ready for r in rivals))
+        self.assertEqual(self.arena.matchmaker.ready_count(2), 1)
+
+        # удаленный игрок исчезает из пула
+        last = [p for p in self.arena if p.ready][0]
+        ws = FakeWS()
+        self.arena.attach(last, ws)
+        self.arena.remove_player(ws)
+        self.assertEqual(self.arena.matchmaker.ready_count(2), 0)
+
 
 class FakeWS:
-    @asyncio.coroutine
+    def __init__(self):
+        self.sent = []
+        self.frames = []
+        self.closed = False
+
     async def send_json(self, msg):
-        pass
+        self.sent.append(msg)
+
+    async def send_str(self, text):
+        self.sent.append(json.loads(text))
+
+    async def send_bytes(self, data):
+        self.frames.append(data)
+
+    async def close(self):
+        self.closed = True
+
+
+class BrokenWS(FakeWS):
+    async def send_str(self, text):
+        raise ConnectionResetError()
+
+
+class SlowWS(FakeWS):
+    async def send_str(self, text):
+        await asyncio.sleep(10)
 
 
 def cancel_to_async(f):
     def wrapper(*args, **kwargs):
-        coro = asyncio.coroutine(f)
-        future = coro(*args, **kwargs)
-        loop = asyncio.get_event_loop()
-        loop.run_until_complete(future)
+        asyncio.run(f(*args, **kwargs))
 
     return wrapper
 
@@ -202,6 +416,954 @@ class GamesTest(unittest.TestCase):
         await self.games.cancel_game(game)
         self.assertFalse(len(self.games.games))
 
+    @cancel_to_async
+    async def test_cancel_game(self):
+        players = [self.arena.get_player(uid) for uid in range(1, 6)]
+        for p in players:
+            p.ws = FakeWS()
+
+        game_1 = self.games.create_game(players[0], [players[1]])
+        game_2 = self.games.create_game(players[2], players[3:5])
+
+        for p in players[2:5]:
+            self.assertIs(self.games.find_game(p), game_2)
+
+        await self.games.cancel_game(game_2)
+        self.assertEqual(players[2].ws.sent[-1]["game_stat"]["status"], "canceled")
+        self.assertEqual(self.games.games, {game_1})
+        self.assertIsNone(self.games.find_game(players[3]))
+        self.assertIs(self.games.find_game(players[0]), game_1)
+
+
+    @cancel_to_async
+    async def test_deadlines(self):
+        games = Games(round_timeout=30, idle_timeout=300)
+        players = [self.arena.get_player(uid) for uid in range(1, 5)]
+        for p in players:
+            p.ws = FakeWS()
+
+        game = games.create_game(players[0], [players[1]])
+        idle = games.create_game(players[2], [players[3]])
+        self.assertEqual(len(games.timers), 2)
+        started = game.changed
+
+        # до срока ничего не меняется
+        games.expire([game, idle], started + 10)
+        self.assertEqual((game.status, len(games)), ("started", 2))
+
+        # не бросивший вовремя пасует, даже если не бросил никто
+        game.throw(players[0], ROCK)
+        games.expire([game, idle], started + 31)
+        self.assertEqual((game.status, game.winner, game.throws[players[1].uid]), ("finished", 1, PASS))
+        self.assertEqual((idle.status, idle.winner), ("finished", TIE))
+        self.assertEqual(idle.throws, {3: PASS, 4: PASS})
+        self.assertEqual(games.games, {game, idle})
+
+        await asyncio.sleep(0.01)
+        self.assertEqual(players[3].ws.sent[-1]["game_stat"]["throws"], {"3": PASS, "4": PASS})
+        self.assertEqual(players[1].ws.sent[-1]["game_stat"]["throws"], {"1": ROCK, "2": PASS})
+
+        # простаивающую игру отменяет только idle_timeout
+        games.expire([idle], idle.changed + 301)
+        self.assertEqual(idle.status, "canceled")
+        self.assertNotIn(idle, games.timers)
+        await asyncio.sleep(0.01)
+        self.assertEqual(players[3].ws.sent[-1]["game_stat"]["status"], "canceled")
+
+        # завершенный раунд ждет следующего idle_timeout секунд
+        games.expire([game], game.changed + 299)
+        self.assertIn(game, games.timers)
+        games.expire([game], game.changed + 301)
+        self.assertEqual(len(games), 0)
+        self.assertEqual(len(games.timers), 0)
+
+    @cancel_to_async
+    async def test_timer_wheel(self):
+        fired = []
+        timers = TimerWheel(fired.extend, resolution=0.01, size=8)
+        timers.schedule("a", 0.02)
+        timers.schedule("b", 0.15)
+        timers.schedule("c", 0.02)
+        timers.cancel("c")
+        await timers.start()
+
+        # b ждет второго оборота колеса
+        await asyncio.sleep(0.08)
+        self.assertEqual(fired, ["a"])
+        await asyncio.sleep(0.15)
+        self.assertEqual(fired, ["a", "b"])
+
+        # пустое колесо не будит цикл событий
+        self.assertIsNone(timers.handle)
+        await timers.stop()
+
+
+class SkillMatchmakerTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.arena = Arena()
+        self.arena.matchmaker = SkillMatchmaker(width=25, gap=25, gap_per_second=10, max_gap=1000,
+                                                clock=lambda: self.now)
+
+    def ready(self, uid, wins, games, game_type=1):
+        player = self.arena.create_player(uid, row={"wins": wins, "games": games, "game_type": game_type,
+                                                    "history": None})
+        player.ready = True
+        return player
+
+    def test_match(self):
+        matchmaker = self.arena.matchmaker
+        strong = [self.ready(1, 90, 100), self.ready(2, 88, 100)]
+        weak = [self.ready(3, 10, 100), self.ready(4, 12, 100)]
+        outlier = self.ready(5, 50, 100)
+
+        # по запросу соперников нет, игроки ждут пакетного прохода
+        self.assertIsNone(self.arena.get_rivals(outlier))
+        self.assertEqual(matchmaker.ready_count(1), 5)
+
+        groups = matchmaker.match()
+        self.assertEqual(sorted(sorted(p.uid for p in g) for g in groups), [[1, 2], [3, 4]])
+        self.assertTrue(all(not p.ready for p in strong + weak))
+        self.assertEqual(matchmaker.ready_count(1), 1)
+
+        # окно растет с ожиданием: через 20 секунд разница 400 допустима
+        rival = self.ready(6, 90, 100)
+        self.now = 10
+        self.assertEqual(matchmaker.match(), [])
+        self.now = 20
+        self.assertEqual([sorted(p.uid for p in g) for g in matchmaker.match()], [[5, 6]])
+
+    def test_rating_update(self):
+        matchmaker = self.arena.matchmaker
+        players = [self.ready(uid, 0, 0, game_type=2) for uid in (1, 2)]
+        rival = self.arena.create_player(3)
+
+        # раунд меняет рейтинг готового игрока и его корзину
+        game = Game(players[0], [rival])
+        game.throw(players[0], ROCK)
+        game.throw(rival, SCISSORS)
+        pool = matchmaker.pool(2)
+        self.assertEqual(pool.entries[1][0], rating(players[0]))
+        self.assertIn(1, pool.buckets[rating(players[0]) // 25])
+
+        # в игре на троих нужен третий, разница 166 допустима через 10 секунд
+        self.assertEqual(matchmaker.match(), [])
+        self.ready(4, 1, 1, game_type=2)
+        self.now = 10
+        self.assertEqual(len(matchmaker.match()[0]), 3)
+
+    @cancel_to_async
+    async def test_batch_matcher(self):
+        games = Games()
+        players = [self.ready(uid, 5, 10) for uid in (1, 2)]
+        for player in players:
+            self.arena.attach(player, FakeWS())
+
+        created = BatchMatcher(self.arena, games).match()
+        self.assertEqual(len(created), 1)
+        self.assertIs(games.find_game(players[1]), created[0])
+
+        await asyncio.sleep(0.01)
+        self.assertEqual(players[0].ws.sent[-1]["action"], "game_updates")
+        await self.arena.scheduler.flush()
+
+
+class BroadcastTest(unittest.TestCase):
+    def setUp(self):
+        self.arena = Arena()
+
+    @cancel_to_async
+    async def test_arena_broadcast(self):
+        sockets = [FakeWS(), BrokenWS(), SlowWS(), FakeWS()]
+        for i, ws in enumerate(sockets):
+            self.arena.get_or_create_player({"id": i + 1, "name": f"test_{i}"}, ws)
+
+        # сбой и таймаут одного сокета не мешают остальным
+        with patch('broadcast.SEND_TIMEOUT', 0.01):
+            await self.arena.broadcast()
+
+        for ws in (sockets[0], sockets[3]):
+            self.assertEqual(len(ws.sent), 1)
+            serialize_response(json.dumps(ws.sent[0]))
+            self.assertEqual(len(ws.sent[0]["queue"]), 4)
+
+        self.assertEqual(sockets[0].sent[0]["user"]["uid"], 1)
+        self.assertEqual(sockets[3].sent[0]["user"]["uid"], 4)
+
+        # старый клиент получает историю в данных игрока
+        self.assertEqual(sockets[0].sent[0]["user"]["history"], [])
+
+    @cancel_to_async
+    async def test_connect_during_broadcast(self):
+        arena = self.arena
+
+        class JoiningWS(FakeWS):
+            async def send_str(self, text):
+                await super().send_str(text)
+                arena.get_or_create_player({"id": len(arena) + 1, "name": "late"}, FakeWS())
+
+        sockets = [JoiningWS() for _ in range(3)]
+        for i, ws in enumerate(sockets):
+            arena.get_or_create_player({"id": i + 1, "name": f"test_{i}"}, ws)
+
+        # подключения посреди рассылки не ломают обход игроков
+        with patch('broadcast.SEND_CONCURRENCY', 1):
+            await arena.broadcast()
+        self.assertEqual([len(ws.sent) for ws in sockets], [1, 1, 1])
+        self.assertEqual(len(arena), 6)
+
+    @cancel_to_async
+    async def test_game_broadcast(self):
+        player = self.arena.get_or_create_player({"id": 1, "name": "test_1"}, FakeWS())
+        rival = self.arena.get_or_create_player({"id": 2, "name": "test_2"}, BrokenWS())
+        game = Game(player, [rival])
+
+        await game.broadcast()
+        self.assertEqual(player.ws.sent[0]["action"], "game_updates")
+        self.assertEqual(len(player.ws.sent[0]["game_stat"]["players"]), 2)
+
+        # кешированное сообщение обновляется при изменении игры и игроков
+        cached = game.encode()
+        self.assertIs(game.encode(), cached)
+
+        game.throw(player, ROCK)
+        self.assertEqual(json.loads(game.encode())["game_stat"]["throws"], {"1": ROCK})
+
+        rival.name = "renamed"
+        self.assertEqual(json.loads(game.encode())["game_stat"]["players"][1]["name"], "renamed")
+        self.assertEqual(json.loads(rival.encode())["name"], "renamed")
+
+        game.throw(rival, ROCK)
+        self.assertEqual(json.loads(player.encode())["games"], 1)
+
+    @unittest.skipUnless(codec.MSGPACK, "msgpack is not installed")
+    @cancel_to_async
+    async def test_binary_frames(self):
+        binary = self.arena.get_or_create_player({"id": 1, "name": "test_1"}, FakeWS(), codec.MSGPACK)
+        text = self.arena.get_or_create_player({"id": 2, "name": "test_2"}, FakeWS())
+        binary.lobby_deltas = True
+        await self.arena.send_snapshot(binary)
+
+        binary.name = "renamed"
+        await self.arena.broadcast()
+
+        # склеенные из частей кадры совпадают с обычной сериализацией
+        self.assertEqual(binary.ws.frames[-1], codec.MSGPACK.encode({
+            "action": "queue_delta", "result": "Done", "seq": 1,
+            "changes": [{"op": "set", "uid": 1, "name": "renamed", "ready": False},
+                        {"op": "set", "uid": 2, "name": "test_2", "ready": False}],
+            "user": binary.to_dict(),
+        }))
+        self.assertEqual(text.ws.sent[-1]["queue"], [["renamed", False], ["test_2", False]])
+
+        game = Game(binary, [text])
+        await game.broadcast()
+        self.assertEqual(codec.MSGPACK.decode(binary.ws.frames[-1])["game_stat"]["players"][0]["uid"], 1)
+        self.assertEqual(text.ws.sent[-1]["action"], "game_updates")
+
+
+    @cancel_to_async
+    async def test_lobby_deltas(self):
+        legacy = self.arena.get_or_create_player({"id": 1, "name": "test_1"}, FakeWS())
+        client = self.arena.get_or_create_player({"id": 2, "name": "test_2"}, FakeWS())
+        await self.arena.broadcast()
+
+        client.lobby_deltas = True
+        await self.arena.send_snapshot(client)
+        snapshot = client.ws.sent[-1]
+        serialize_response(json.dumps(snapshot))
+        self.assertEqual(snapshot["queue"], [[1, "test_1", False], [2, "test_2", False]])
+
+        legacy.name = "renamed"
+        self.arena.create_player(uid=3, name="test_3")
+        await self.arena.broadcast()
+
+        # дельта содержит только изменения и следующую версию
+        delta = client.ws.sent[-1]
+        serialize_response(json.dumps(delta))
+        self.assertEqual(delta["seq"], snapshot["seq"] + 1)
+        self.assertNotIn("user", delta)
+        self.assertEqual(delta["changes"], [
+            {"op": "set", "uid": 1, "name": "renamed", "ready": False},
+            {"op": "set", "uid": 3, "name": "test_3", "ready": False},
+        ])
+
+        # старые клиенты по-прежнему получают полный список
+        self.assertEqual(legacy.ws.sent[-1]["queue"],
+                         [["renamed", False], ["test_2", False], ["test_3", False]])
+
+        client.ready = True
+        self.arena.remove_player(legacy.ws)
+        await self.arena.broadcast()
+
+        delta = client.ws.sent[-1]
+        serialize_response(json.dumps(delta))
+        self.assertEqual(delta["seq"], snapshot["seq"] + 2)
+        self.assertTrue(delta["user"]["ready"])
+        self.assertNotIn("history", delta["user"])
+        self.assertEqual(delta["changes"], [
+            {"op": "set", "uid": 2, "name": "test_2", "ready": True},
+            {"op": "remove", "uid": 1},
+        ])
+
+        # без изменений дельта не отправляется
+        sent = len(client.ws.sent)
+        await self.arena.broadcast()
+        self.assertEqual(len(client.ws.sent), sent)
+
+
+    @cancel_to_async
+    async def test_outbox(self):
+        slow, fast = SlowWS(), FakeWS()
+        outbox = Outbox(slow, limit=3)
+        self.arena.get_or_create_player({"id": 1, "name": "test_1"}, outbox)
+        player = self.arena.get_or_create_player({"id": 2, "name": "test_2"}, Outbox(fast, limit=3))
+
+        # рассылка не ждет медленного клиента
+        for i in range(3):
+            player.name = f"test_{i}"
+            await asyncio.wait_for(self.arena.broadcast(), 1)
+            await asyncio.sleep(0)
+        self.assertEqual(len(fast.sent), 3)
+
+        # первый снимок отправляется, из остальных в очереди только последний
+        self.assertEqual(len(outbox), 1)
+        self.assertEqual(json.loads(outbox.queue[0][0])["queue"], fast.sent[-1]["queue"])
+
+        # переполненная очередь отключает клиента
+        self.assertTrue(outbox.put("{}") and outbox.put("{}"))
+        self.assertFalse(outbox.put("{}"))
+        await asyncio.sleep(0)
+        self.assertTrue(slow.closed)
+        self.assertEqual(len(outbox), 0)
+        with self.assertRaises(ConnectionResetError):
+            await outbox.send_str("{}")
+        await outbox.close()
+
+        # клиент, не принявший сообщение за SEND_TIMEOUT, отключается
+        # при следующей рассылке
+        slow = SlowWS()
+        outbox = Outbox(slow)
+        with patch('broadcast.SEND_TIMEOUT', 0.01):
+            self.assertTrue(outbox.put("{}"))
+            await asyncio.sleep(0.05)
+            self.assertFalse(outbox.put("{}", latest=True))
+        await asyncio.sleep(0)
+        self.assertTrue(outbox.closed and slow.closed)
+        await outbox.close()
+
+
+class CodecTest(unittest.TestCase):
+    def test_json(self):
+        message = {"action": "throw", "data": ROCK, "throws": {1: PASS}}
+        encoded = codec.JSON.encode(message)
+
+        self.assertIsInstance(encoded, str)
+        self.assertEqual(codec.JSON.decode(encoded)["throws"], {"1": PASS})
+        self.assertEqual(json.loads(codec.JSON.join([("a", "1"), ("b", '"x"')])), {"a": 1, "b": "x"})
+        self.assertRaises(codec.CodecError, codec.JSON.decode, "{")
+        self.assertIs(codec.negotiate(None), codec.JSON)
+
+    @unittest.skipUnless(codec.MSGPACK, "msgpack is not installed")
+    def test_msgpack(self):
+        fields = [(f"k{i}", codec.MSGPACK.encode(i)) for i in range(20)]
+
+        self.assertEqual(codec.MSGPACK.decode(codec.MSGPACK.join(fields)), {f"k{i}": i for i in range(20)})
+        self.assertRaises(codec.CodecError, codec.MSGPACK.decode, "text")
+        self.assertIs(codec.negotiate("rps.msgpack"), codec.MSGPACK)
+
+
+class ControllerTest(unittest.TestCase):
+    def setUp(self):
+        self.arena = Arena()
+        self.games = Games()
+        self.player = self.arena.get_or_create_player({"id": 1, "name": "test_1"}, FakeWS())
+        self.controller = ActionsController(self.arena, self.games, self.player, self.player.ws, codec.JSON)
+
+    async def handle(self, message):
+        data = message if isinstance(message, str) else json.dumps(message)
+        try:
+            await self.controller.receive(WSMessage(WSMsgType.TEXT, data, None))
+        except WSException as e:
+            return e.message
+
+    @cancel_to_async
+    async def test_validation(self):
+        cases = [
+            ("{", "not_serializable"),
+            ([], "not_an_object"),
+            ({"data": 1}, "missing_action"),
+            ({"action": "fly"}, "unknown_action"),
+            ({"action": ["throw"]}, "unknown_action"),
+            ({"action": "throw"}, "missing_data"),
+            ({"action": "throw", "data": "LIZARD"}, "invalid_data"),
+            ({"action": "change_type", "data": True}, "invalid_data"),
+            ({"action": "change_name", "data": "x" * 20}, "invalid_data"),
+            ({"action": "show_history", "data": {"offset": -1}}, "invalid_data"),
+            ({"action": "show_leaderboard", "data": []}, "invalid_data"),
+            ({"action": "change_type", "data": 2, "self": 1}, "bad_request"),
+        ]
+
+        for message, code in cases:
+            error = await self.handle(message)
+            self.assertEqual(error["result"], "Fail")
+            self.assertEqual(error["code"], code, message)
+
+        # у msgpack ключи бывают не строками
+        with self.assertRaises(RequestError):
+            request_action({"action": "change_type", "data": 2, 1: 1})
+
+        error = await self.handle({"action": "fly"})
+        error["data"] = None
+        self.assertEqual((await self.handle({"action": "fly"}))["data"], "Unsupported action")
+
+    @cancel_to_async
+    async def test_dispatch(self):
+        self.assertIsNone(await self.handle({"action": "change_name", "data": "renamed"}))
+        self.assertIsNone(await self.handle({"action": "change_type", "data": 2}))
+        self.assertEqual((self.player.name, self.player.game_type), ("renamed", 2))
+
+        # действие попадает в новый словарь контекста: записи лога,
+        # ждущие в очереди, сохраняют свое
+        context = {"uid": 1}
+        token = log_context.set(context)
+        self.assertIsNone(await self.handle({"action": "show_history", "data": {"limit": 5}}))
+        self.assertEqual(log_context.get(), {"uid": 1, "action": "show_history"})
+        self.assertEqual(context, {"uid": 1})
+        log_context.reset(token)
+
+        serialize_response(json.dumps(self.player.ws.sent[-1]))
+        await self.arena.scheduler.flush()
+
+    @cancel_to_async
+    async def test_closed_outbox(self):
+        outbox = Outbox(FakeWS())
+        outbox.discard()
+        controller = ActionsController(self.arena, self.games, self.player, outbox, codec.JSON)
+
+        # ответ и ошибка в закрытое соединение теряются без исключений
+        with self.assertNoLogs('rps', level=logging.ERROR):
+            await controller.process(WSMessage(WSMsgType.TEXT, json.dumps({"action": "show_history"}), None))
+            await controller.process(WSMessage(WSMsgType.TEXT, "{", None))
+        self.assertEqual(outbox.ws.sent, [])
+
+    @cancel_to_async
+    async def test_current_game(self):
+        rival = self.arena.get_or_create_player({"id": 2, "name": "test_2"}, FakeWS())
+        rival.ready = True
+
+        await self.handle({"action": "mark_as_ready"})
+        game = self.controller.current_game()
+        self.assertIs(game, self.games.find_game(self.player))
+
+        await self.handle({"action": "throw", "data": ROCK})
+        self.assertEqual(game.throws, {1: ROCK})
+
+        # после отмены игра ищется заново
+        await self.handle({"action": "cancel_game"})
+        self.assertIsNone(self.controller.current_game())
+        await self.arena.scheduler.flush()
+
+
+    @cancel_to_async
+    async def test_batch(self):
+        rival = self.arena.get_or_create_player({"id": 2, "name": "test_2"}, FakeWS())
+        rival.ready = True
+
+        self.assertIsNone(await self.handle({"action": "batch", "data": [
+            {"action": "mark_as_ready"},
+            {"action": "throw", "data": ROCK},
+            {"action": "fly"},
+            {"action": "show_history", "data": {"limit": 1}},
+        ]}))
+
+        reply = self.player.ws.sent[0]
+        serialize_response(json.dumps(reply))
+        self.assertEqual([r["result"] for r in reply["results"]], ["Done", "Done", "Fail", "Done"])
+        self.assertEqual(reply["results"][2]["code"], "unknown_action")
+        self.assertEqual(reply["results"][3]["reply"]["action"], "history_updates")
+
+        # создание игры и бросок приходят сопернику одним обновлением
+        updates = [m for m in rival.ws.sent if m["action"] == "game_updates"]
+        self.assertEqual(len(updates), 1)
+        self.assertEqual(updates[0]["game_stat"]["throws"], {"1": ROCK})
+
+        # игра, отмененная в том же пакете, рассылается один раз
+        await self.handle({"action": "batch", "data": [
+            {"action": "throw", "data": PAPER},
+            {"action": "cancel_game"},
+        ]})
+        updates = [m for m in rival.ws.sent if m["action"] == "game_updates"]
+        self.assertEqual(len(updates), 2)
+        self.assertEqual(updates[1]["game_stat"]["status"], "canceled")
+
+        for data in ([], [{"action": "batch", "data": []}], [{"action": "resync"}] * 33):
+            self.assertEqual((await self.handle({"action": "batch", "data": data}))["code"], "invalid_data")
+        await self.arena.scheduler.flush()
+
+
+class LeaderboardTest(unittest.TestCase):
+    def play(self, winner, loser, rounds=1):
+        game = Game(winner, [loser])
+        for _ in range(rounds):
+            game.throw(winner, ROCK)
+            game.throw(loser, SCISSORS)
+
+    def test_wins(self):
+        arena = Arena()
+        players = [arena.create_player(uid, f"test_{uid}") for uid in range(1, 5)]
+        self.play(players[0], players[1], 2)
+        self.play(players[2], players[3], 2)
+        self.play(players[2], players[0])
+
+        # побед поровну - выше тот, у кого меньше игр; без игр - не в рейтинге
+        leaderboard = arena.leaderboard
+        self.assertEqual([row["uid"] for row in leaderboard.page(0, 10)], [3, 1, 2, 4])
+        self.assertEqual((leaderboard.rank(3), leaderboard.rank(1)), (1, 2))
+        self.assertIsNone(leaderboard.rank(5))
+
+        players[1].name = "renamed"
+        self.assertEqual(leaderboard.page(2, 1), [{"rank": 3, "uid": 2, "name": "renamed", "wins": 0, "games": 2}])
+
+    def test_win_rate(self):
+        arena = Arena()
+        arena.leaderboard = Leaderboard("win_rate", min_games=3)
+        players = [arena.create_player(uid, f"test_{uid}") for uid in range(1, 4)]
+        self.play(players[0], players[1], 3)
+        self.play(players[2], players[1])
+
+        # у игрока 3 одна игра из трех нужных
+        self.assertEqual([row["uid"] for row in arena.leaderboard.page()], [1, 2])
+        self.assertIsNone(arena.leaderboard.rank(3))
+
+        # восстановленный игрок попадает в рейтинг сразу
+        restored = Arena()
+        restored.leaderboard = Leaderboard("win_rate", min_games=3)
+        restored.create_player(1, "test_1", row={"wins": 3, "games": 4, "game_type": 1, "history": None})
+        self.assertEqual(restored.leaderboard.rank(1), 1)
+
+    @cancel_to_async
+    async def test_action(self):
+        arena, games = Arena(), Games()
+        player = arena.get_or_create_player({"id": 1, "name": "test_1"}, FakeWS())
+        rival = arena.get_or_create_player({"id": 2, "name": "test_2"}, FakeWS())
+        self.play(rival, player)
+
+        controller = ActionsController(arena, games, player, player.ws, codec.JSON)
+        await controller.receive(WSMessage(WSMsgType.TEXT, json.dumps(
+            {"action": "show_leaderboard", "data": {"limit": 1}}), None))
+
+        reply = player.ws.sent[-1]
+        serialize_response(json.dumps(reply))
+        self.assertEqual((reply["total"], reply["rank"]), (2, 2))
+        self.assertEqual([row["uid"] for row in reply["leaders"]], [2])
+        await arena.scheduler.flush()
+
+
+class MetricsTest(unittest.TestCase):
+    def test_render(self):
+        registry = metrics.Registry()
+        counter = registry.counter("rps_test_total", "Test counter", ("code",))
+        histogram = registry.histogram("rps_test_seconds", "Test histogram", buckets=(0.1, 1.0))
+        registry.gauge("rps_test_ready", "Test gauge", ("game_type",), collect=lambda: [((1,), 5), ((2,), 0)])
+
+        counter.inc(2, "invalid_data")
+        for value in (0.05, 0.1, 0.5, 3):
+            histogram.observe(value)
+
+        lines = registry.render().splitlines()
+        self.assertIn("# TYPE rps_test_seconds histogram", lines)
+        self.assertIn('rps_test_total{code="invalid_data"} 2', lines)
+        # корзины накопительные, граница входит в корзину
+        self.assertIn('rps_test_seconds_bucket{le="0.1"} 2', lines)
+        self.assertIn('rps_test_seconds_bucket{le="1.0"} 3', lines)
+        self.assertIn('rps_test_seconds_bucket{le="+Inf"} 4', lines)
+        self.assertIn("rps_test_seconds_count 4", lines)
+        self.assertIn('rps_test_ready{game_type="2"} 0', lines)
+
+    @cancel_to_async
+    async def test_state(self):
+        arena, games = Arena(), Games()
+        registry = metrics.Registry()
+        metrics.register_state(arena, games, registry)
+
+        player = arena.get_or_create_player({"id": 1, "name": "test_1"}, FakeWS())
+        arena.get_or_create_player({"id": 2, "name": "test_2"}, FakeWS()).ready = True
+        controller = ActionsController(arena, games, player, player.ws, codec.JSON)
+
+        before = sum(metrics.ACTION_SECONDS.values.get(("mark_as_ready",), [[0]])[0])
+        await controller.receive(WSMessage(WSMsgType.TEXT, json.dumps({"action": "mark_as_ready"}), None))
+        await arena.scheduler.flush()
+
+        lines = registry.render().splitlines()
+        self.assertIn("rps_sockets 2", lines)
+        self.assertIn("rps_games 1", lines)
+        self.assertIn('rps_ready_players{game_type="1"} 0', lines)
+        self.assertEqual(sum(metrics.ACTION_SECONDS.values[("mark_as_ready",)][0]), before + 1)
+
+
+class ProfilerTest(unittest.TestCase):
+    @cancel_to_async
+    async def test_run(self):
+        arena, games = Arena(), Games()
+        player = arena.get_or_create_player({"id": 1, "name": "test_1"}, FakeWS())
+        controller = ActionsController(arena, games, player, player.ws, codec.JSON)
+
+        async def load():
+            await asyncio.sleep(0.01)
+            await controller.receive(WSMessage(WSMsgType.TEXT, json.dumps({"action": "show_history"}), None))
+            # колбэк, занимающий цикл дольше порога
+            time.sleep(0.03)
+
+        with patch('settings.PROFILE_SLOW_CALLBACK', 0.02):
+            result, _ = await asyncio.gather(profiling.PROFILER.run(0.1, tempfile.mkdtemp()), load())
+
+        self.assertFalse(profiling.PROFILER.running)
+        self.assertFalse(asyncio.get_running_loop().get_debug())
+        self.assertEqual(result["handlers"]["ActionsController.show_history"]["calls"], 1)
+        self.assertGreaterEqual(result["slow_callbacks"], 1)
+        self.assertTrue(os.path.exists(result["report"]))
+        self.assertGreater(pstats.Stats(result["profile"]).total_calls, 0)
+
+
+class LoggingTest(unittest.TestCase):
+    def test_pipeline(self):
+        records = []
+
+        class ListHandler(logging.Handler):
+            def emit(self, record):
+                records.append(record)
+
+        listener = setup_logging("rps-test", handlers=[ListHandler()], level="INFO", sampling={"throw": 0})
+        self.assertIs(setup_logging("rps-test"), listener)
+        log = logging.getLogger("rps-test")
+
+        token = log_context.set({"uid": 1, "action": "throw"})
+        log.info("throw", extra={"event": "throw"})
+        try:
+            1 / 0
+        except ZeroDivisionError:
+            log.exception("failed", extra={"event": "error"})
+        log_context.reset(token)
+        log.info("connected %s", 2)
+
+        # очередь дописывается при остановке фонового потока
+        stop_logging("rps-test")
+
+        # выборка 0 отбрасывает все броски
+        self.assertEqual([r.getMessage() for r in records], ["failed", "connected 2"])
+
+        entry = json.loads(JsonFormatter().format(records[0]))
+        self.assertEqual((entry["uid"], entry["action"], entry["event"]), (1, "throw", "error"))
+        self.assertIn("ZeroDivisionError", entry["exc"])
+        self.assertNotIn("uid", json.loads(JsonFormatter().format(records[1])))
+
+    def test_log_path(self):
+        # файлы лога лежат в каталоге логов, у процессов кластера - с суффиксом
+        self.assertEqual(log_path("rps.log", "logs"), os.path.join("logs", "rps.log"))
+        with patch("multiprocessing.current_process") as current:
+            current.return_value.name = "worker-0"
+            self.assertEqual(log_path("rps.log", "/var/log/rps"), "/var/log/rps/rps-worker-0.log")
+        with patch("settings.LOG_DIR", "/tmp"):
+            self.assertEqual(log_path("rps.log"), "/tmp/rps.log")
+
+
+class ClusterTest(unittest.TestCase):
+    @cancel_to_async
+    async def test_players_on_different_workers(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "broker.sock")
+            broker = Broker()
+            server = await broker.serve(path)
+
+            links = [BrokerLink(path), BrokerLink(path)]
+            sockets = [FakeWS(), FakeWS()]
+            for link in links:
+                await link.start()
+
+            controllers = [await link.connect(ws, {"id": uid, "name": f"test_{uid}"})
+                           for uid, link, ws in zip((1, 2), links, sockets)]
+
+            async def send(i, message):
+                await controllers[i].process(WSMessage(WSMsgType.TEXT, json.dumps(message), None))
+
+            async def wait_for(i, predicate):
+                for _ in range(100):
+                    if any(predicate(m) for m in sockets[i].sent):
+                        return
+                    await asyncio.sleep(0.01)
+                self.fail(f"no expected message in {sockets[i].sent}")
+
+            # на ошибку отвечает воркер, брокер о ней не узнает
+            await send(0, {"action": "throw", "data": "LIZARD"})
+            self.assertEqual(sockets[0].sent[-1]["code"], "invalid_data")
+
+            # игроки разных воркеров находят друг друга и играют
+            await send(0, {"action": "mark_as_ready"})
+            await wait_for(0, lambda m: m.get("action") == "queue_updates")
+            await send(1, {"action": "mark_as_ready"})
+            await wait_for(0, lambda m: m.get("action") == "game_updates")
+
+            await send(0, {"action": "throw", "data": ROCK})
+            await send(1, {"action": "throw", "data": SCISSORS})
+            await wait_for(1, lambda m: m.get("game_stat", {}).get("winner") == 1)
+
+            # uid новых игроков выдает брокер, занятые пропускаются
+            with patch.object(Player, "new_uid", side_effect=[1, 2, 3]):
+                player = await links[1].new_player()
+            self.assertEqual(player, {"id": 3, "name": "User_3"})
+            self.assertIsNotNone(broker.arena.get_player(3))
+
+            # отключение в одном воркере отменяет игру у другого
+            await links[0].disconnect(controllers[0].conn)
+            await wait_for(1, lambda m: m.get("game_stat", {}).get("status") == "canceled")
+            self.assertEqual(len(broker.games), 0)
+
+            for link in links:
+                await link.stop()
+            server.close()
+            await broker.arena.scheduler.flush()
+
+
+    @cancel_to_async
+    async def test_broker_state(self):
+        from storage import SQLiteStorage
+
+        with tempfile.TemporaryDirectory() as directory:
+            storage = SQLiteStorage(os.path.join(directory, "rps.sqlite3"), interval=60)
+            arena, games = Arena(storage), Games()
+            broker = Broker(arena, games)
+            self.assertIs(broker.arena, arena)
+            self.assertIs(broker.games, games)
+
+            # новый игрок пишется в настроенное хранилище
+            path = os.path.join(directory, "broker.sock")
+            server = await broker.serve(path)
+            link = BrokerLink(path)
+            await link.start()
+            player = await link.new_player()
+            self.assertTrue(storage.exists(player["id"]))
+
+            await link.stop()
+            server.close()
+            await storage.close()
+
+    @cancel_to_async
+    async def test_read_frames(self):
+        reader = asyncio.StreamReader()
+        data = b"".join(HEADER.pack(REQUEST, conn, len(payload)) + payload
+                        for conn, payload in ((1, b"first"), (2, b""), (3, b"x" * 100)))
+
+        # кадры разрезаны между чтениями произвольно
+        frames = []
+        with patch('cluster.READ_SIZE', 7):
+            reader.feed_data(data)
+            reader.feed_eof()
+            with self.assertRaises(asyncio.IncompleteReadError):
+                async for frame in read_frames(reader):
+                    frames.append(frame)
+
+        self.assertEqual(frames, [(REQUEST, 1, b"first"), (REQUEST, 2, b""), (REQUEST, 3, b"x" * 100)])
+
+
+class ReaperTest(unittest.TestCase):
+    @cancel_to_async
+    async def test_reap(self):
+        arena, games = Arena(), Games()
+        ws_1, ws_2 = FakeWS(), FakeWS()
+        player_1 = arena.get_or_create_player({"id": 1, "name": "test_1"}, ws_1)
+        arena.get_or_create_player({"id": 2, "name": "test_2"}, ws_2)
+        player_1.game_type = 2
+        player_1.ready = True
+
+        # закрытый сокет сразу уходит из рассылок и пулов готовых
+        arena.detach(player_1, ws_1)
+        self.assertEqual(list(arena.sockets.values()), [arena.get_player(2)])
+        self.assertEqual(arena.matchmaker.ready_count(2), 0)
+        await arena.send_lobby()
+        self.assertEqual((len(ws_1.sent), len(ws_2.sent)), (0, 1))
+
+        # до конца grace игрок остается в арене
+        reaper = Reaper(arena, games, interval=1, grace=60, idle=0)
+        self.assertEqual(await reaper.reap(time.monotonic() + 30), (0, 0))
+        self.assertIs(arena.get_player(1), player_1)
+
+        self.assertEqual(await reaper.reap(time.monotonic() + 61), (0, 1))
+        self.assertIsNone(arena.get_player(1))
+        self.assertEqual(arena.detached, {})
+
+        # вернувшийся игрок поднимается из хранилища
+        player = arena.get_or_create_player({"id": 1, "name": "test_1"}, FakeWS())
+        self.assertIsNot(player, player_1)
+        self.assertEqual(player.game_type, 2)
+
+    @cancel_to_async
+    async def test_evict_game(self):
+        arena, games = Arena(), Games()
+        player = arena.get_or_create_player({"id": 1, "name": "test_1"}, None)
+        rival = arena.get_or_create_player({"id": 2, "name": "test_2"}, FakeWS())
+        games.create_game(player, [rival])
+
+        # игра закрывается раньше, чем игрок удаляется из арены
+        evict = arena.evict
+        seen = []
+        with patch.object(arena, "evict", side_effect=lambda p: (seen.append(games.find_game(p)), evict(p))):
+            self.assertEqual(await Reaper(arena, games, grace=60, idle=0).reap(time.monotonic() + 61), (0, 1))
+
+        self.assertEqual(seen, [None])
+        self.assertEqual(len(games), 0)
+        self.assertEqual(rival.ws.sent[-1]["game_stat"]["status"], "canceled")
+
+    @cancel_to_async
+    async def test_idle(self):
+        arena = Arena()
+        ws = FakeWS()
+        player = arena.get_or_create_player({"id": 1, "name": "test_1"}, ws)
+        reaper = Reaper(arena, Games(), interval=1, grace=60, idle=10)
+
+        self.assertEqual(await reaper.reap(player.seen + 5), (0, 0))
+        # молчащее соединение закрывается, игрок ждет переподключения
+        self.assertEqual(await reaper.reap(player.seen + 11), (1, 0))
+        self.assertEqual(arena.sockets, {})
+        self.assertIn(1, arena.detached)
+
+
+class JournalTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def start(self):
+        arena, games = Arena(), Games()
+        Journal(self.directory, interval=0).restore(arena, games)
+        return arena, games
+
+    @cancel_to_async
+    async def test_restore(self):
+        arena, games = self.start()
+        players = [arena.create_player(uid, f"test_{uid}") for uid in range(1, 6)]
+        players[0].name = "renamed"
+        players[2].game_type = 2
+
+        game_1 = games.create_game(players[0], [players[1]])
+        game_1.throw(players[0], ROCK)
+        game_1.throw(players[1], SCISSORS)
+
+        # часть состояния попадает в снимок, остальное - в хвост журнала
+        await arena.journal.snapshot()
+
+        game_1.start_new_round()
+        game_1.throw(players[1], PAPER)
+        game_2 = games.create_game(players[2], [players[3], players[4]])
+        game_2.throw(players[2], ROCK)
+        game_2.throw(players[3], ROCK)
+        game_2.throw(players[4], PAPER)
+        game_3 = games.create_game(players[3], [players[4]])
+        await games.cancel_game(game_3)
+
+        # процесс падает без финального снимка
+        arena.journal.log.close()
+
+        restored, restored_games = Arena(), Games()
+        stats = Journal(self.directory).replay(restored, restored_games, check=True)
+        self.assertEqual(stats["mismatches"], 0)
+        self.assertEqual(stats["rounds"], 1)
+
+        self.assertEqual([p.to_dict() for p in restored], [p.to_dict() for p in arena])
+        self.assertEqual(restored.get_player(1).history_page(), players[0].history_page())
+        self.assertEqual(len(restored_games), 2)
+
+        for game in (game_1, game_2):
+            copy = restored_games.get_game(game.id)
+            self.assertEqual(copy.stat(), game.stat())
+            self.assertIs(restored_games.find_game(restored.get_player(game.players[0].uid)), copy)
+
+        # номера новых игр продолжаются после восстановленных
+        self.assertEqual(restored_games.create_game(restored.get_player(4), [restored.get_player(5)]).id, 4)
+
+    @cancel_to_async
+    async def test_evicted_player_in_game(self):
+        arena, games = self.start()
+        players = [arena.create_player(uid, f"test_{uid}") for uid in range(1, 4)]
+        game = games.create_game(players[0], [players[1]])
+        game.throw(players[0], ROCK)
+
+        # снимок, сделанный между удалением игрока и отменой его игры
+        arena.evict(players[0])
+        await arena.journal.snapshot()
+        game.throw(players[1], PAPER)
+        games.close_game(game)
+        arena.journal.log.close()
+
+        restored, restored_games = Arena(), Games()
+        Journal(self.directory).replay(restored, restored_games)
+        self.assertEqual(len(restored_games), 0)
+        self.assertEqual([p.uid for p in restored], [2, 3])
+
+    @cancel_to_async
+    async def test_broker_startup(self):
+        from journal import create_state
+
+        # брокер кластера пишет журнал состояния, с которым запущен
+        with patch("settings.JOURNAL", self.directory):
+            broker = Broker(*create_state())
+        journal = broker.arena.journal
+        self.assertIsNotNone(journal)
+        self.assertIs(broker.games.journal, journal)
+
+        players = [broker.arena.create_player(uid, f"test_{uid}") for uid in (1, 2)]
+        broker.games.create_game(players[0], [players[1]])
+        journal.log.close()
+
+        restored, restored_games = Arena(), Games()
+        Journal(self.directory).replay(restored, restored_games)
+        self.assertEqual(len(restored), 2)
+        self.assertEqual(restored_games.get_game(1).players[1].uid, 2)
+
+    @cancel_to_async
+    async def test_flush(self):
+        arena, games = Arena(), Games()
+        journal = Journal(self.directory, interval=0, flush_interval=0.01)
+        journal.restore(arena, games)
+
+        # после записи журнал сам сбрасывается на диск
+        with patch("journal.LogFile.flush") as flush:
+            arena.create_player(1, "test_1")
+            arena.create_player(2, "test_2")
+            await asyncio.sleep(0.05)
+        self.assertEqual(flush.call_count, 1)
+        self.assertIsNone(journal.flush_handle)
+
+        await journal.close()
+
+
+class SchedulerTest(unittest.TestCase):
+    @cancel_to_async
+    async def test_coalescing(self):
+        calls = []
+
+        async def callback():
+            calls.append(asyncio.get_event_loop().time())
+
+        scheduler = BroadcastScheduler(callback, window=0.02, max_delay=0.05)
+
+        # пачка запросов в пределах окна дает одну рассылку
+        for _ in range(10):
+            scheduler.schedule()
+        await asyncio.sleep(0.04)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(scheduler.coalesced, 9)
+
+        # непрерывный поток запросов не задерживает рассылку дольше max_delay
+        started = asyncio.get_event_loop().time()
+        for _ in range(10):
+            scheduler.schedule()
+            await asyncio.sleep(0.01)
+        await scheduler.flush()
+
+        self.assertTrue(3 <= len(calls) < 6)
+        self.assertLess(calls[1] - started, 0.08)
+        self.assertEqual(scheduler.requested, 20)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,88 @@
+import asyncio
+import logging
+import math
+import time
+import settings
+
+log = logging.getLogger('rps')
+
+
+# Хешированное колесо таймеров: size ячеек по resolution секунд, ключ
+# лежит в ячейке своего тика и ждет нужного оборота. Постановка и отмена -
+# операции со словарями, раз в resolution секунд просматривается одна
+# ячейка. Цикл событий будит один call_later и только пока есть таймеры.
+# callback получает список ключей, срок которых наступил.
+class TimerWheel:
+    def __init__(self, callback, resolution=None, size=1024):
+        self.callback = callback
+        self.resolution = resolution or settings.TIMER_RESOLUTION
+        # ячейка: ключ -> тик срабатывания
+        self.slots = [{} for _ in range(size)]
+        self.ticks = {}
+        # последний просмотренный тик
+        self.tick = self.now()
+        self.handle = None
+        self.running = False
+
+    def __len__(self):
+        return len(self.ticks)
+
+    def __contains__(self, key):
+        return key in self.ticks
+
+    def now(self):
+        return int(time.monotonic() / self.resolution)
+
+    def schedule(self, key, delay):
+        self.cancel(key)
+
+        tick = max(self.now() + math.ceil(delay / self.resolution), self.tick + 1)
+        self.ticks[key] = tick
+        self.slots[tick % len(self.slots)][key] = tick
+        self.arm()
+
+    def cancel(self, key):
+        tick = self.ticks.pop(key, None)
+        if tick is not None:
+            del self.slots[tick % len(self.slots)][key]
+
+    # Таймеры, поставленные до запуска цикла событий (восстановление из
+    # журнала), начинают срабатывать после start
+    async def start(self, app=None):
+        self.running = True
+        self.arm()
+
+    async def stop(self, app=None):
+        self.running = False
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+
+    def arm(self):
+        if self.running and self.handle is None and self.ticks:
+            self.handle = asyncio.get_running_loop().call_later(self.resolution, self.advance)
+
+    def advance(self):
+        self.handle = None
+        now = self.now()
+        expired = []
+
+        # после долгой паузы цикла достаточно одного оборота колеса
+        for tick in range(self.tick + 1, min(now, self.tick + len(self.slots)) + 1):
+            slot = self.slots[tick % len(self.slots)]
+            due = [key for key, at in slot.items() if at <= now]
+
+            for key in due:
+                del slot[key]
+                del self.ticks[key]
+            expired.extend(due)
+
+        self.tick = max(self.tick, now)
+
+        if expired:
+            try:
+                self.callback(expired)
+            except Exception:
+                log.exception("timer callback failed")
+
+        self.arm()
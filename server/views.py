@@ -1,32 +1,44 @@
-import traceback, sys
+import asyncio
+import settings
 from aiohttp import web
 from aiohttp.web_exceptions import HTTPInternalServerError
 from aiohttp_session import get_session
 from aiohttp_jinja2 import template
-from controllers import ActionsController, WSException
-from logs import create_log
+from broadcast import Outbox
+from codec import PROTOCOLS, negotiate
+from controllers import ActionsController
+from profiling import timed
 
 
 @template('index.html')
+@timed
 async def init_handler(request):
     session = await get_session(request)
 
     if 'id' not in session:
-        player = request.app.arena.create_player()
-        session["id"] = player.uid
-        session["name"] = player.name
+        arena = getattr(request.app, 'arena', None)
+
+        if arena is not None:
+            player = arena.create_player()
+            session["id"], session["name"] = player.uid, player.name
+        else:
+            # в воркере кластера игрока создает брокер
+            player = await request.app.link.new_player()
+            session["id"], session["name"] = player["id"], player["name"]
 
     return {}
 
 
 class ConnectWSView(web.View):
+    @timed
     async def get(self):
-        ws = web.WebSocketResponse()
+        ws = web.WebSocketResponse(protocols=PROTOCOLS, heartbeat=settings.HEARTBEAT or None)
         await ws.prepare(self.request)
         return ws
 
 
 class SessionWSView(ConnectWSView):
+    @timed
     async def get(self):
         ws = await super().get()
         session = await get_session(self.request)
@@ -35,47 +47,61 @@ class SessionWSView(ConnectWSView):
             return ws
 
         arena = getattr(self.request.app, 'arena', None)
-        if not arena:
+        games = getattr(self.request.app, 'games', None)
+        if arena is None or games is None:
             raise HTTPInternalServerError()
 
-        player = arena.get_or_create_player(session, ws)
-        await arena.broadcast()
+        # один контроллер на соединение вместо нового на каждое сообщение,
+        # сообщения клиенту идут через очередь соединения
+        controller = await ActionsController.connect(arena, games, session, Outbox(ws), negotiate(ws.ws_protocol),
+                                                     self.request.query.get('lobby') == 'delta')
 
-        setattr(self.request, 'user', player)
+        setattr(self.request, 'user', controller.player)
+        setattr(self.request, 'controller', controller)
 
         return ws
 
 
 class MainWSView(SessionWSView):
-    async def quit(self):
-        arena = getattr(self.request.app, 'arena', None)
-        player = getattr(self.request, 'user', None)
-        games = getattr(self.request.app, 'games', None)
-        game = games.find_game(player)
+    @timed
+    async def get(self):
+        ws = await super().get()
+        controller = getattr(self.request, 'controller', None)
 
-        if games.find_game(player):
-            await games.cancel_game(game)
+        if controller is None:
+            await ws.close()
+            return ws
 
-        # arena.remove_player(ws)
-        await arena.broadcast()
+        try:
+            async for msg in ws:
+                await controller.process(msg)
+        finally:
+            # отмена обработчика не должна прервать уборку за игроком
+            await asyncio.shield(controller.close())
 
+        return ws
+
+
+# Соединение в воркере кластера: проверенные кадры клиента пересылаются
+# брокеру
+class ProxyWSView(ConnectWSView):
+    @timed
     async def get(self):
         ws = await super().get()
+        session = await get_session(self.request)
+
+        if 'id' not in session:
+            await ws.close()
+            return ws
+
+        link = self.request.app.link
+        controller = await link.connect(Outbox(ws), {"id": session["id"], "name": session["name"]},
+                                        ws.ws_protocol, self.request.query.get('lobby') == 'delta')
 
-        async for msg in ws:
-            try:
-                controller = ActionsController(msg, self.request)
-                await controller.handle()
-            except AssertionError as e:
-                await ws.send_json({"result": "Fail", "data": e.__str__()})
-            except WSException as e:
-                await ws.send_json(e.message)
-            except Exception as e:
-                # ToDo create log as standalone and inject as request attr
-                log = create_log('rps')
-                log.exception("Unpredictable exception:\n {}".format(e))
-                await ws.send_json({"result": "Fail", "data": "Unknown error"})
-
-        await self.quit()
+        try:
+            async for msg in ws:
+                await controller.process(msg)
+        finally:
+            await link.disconnect(controller.conn)
 
         return ws